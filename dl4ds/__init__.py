@@ -25,6 +25,11 @@ INTERPOLATION_METHODS = [
     'bilinear',         # bilinear interpolation (from opencv)
     'lanczos']          # lanczos interpolation over 8x8 neighborhood (from opencv)
 
+STORAGE_DTYPES = [
+    'float32',          # single precision
+    'float16',          # half precision (IEEE)
+    'bfloat16']         # brain floating point (half precision, float32 range)
+
 LOSS_FUNCTIONS = [
     'mae',              # mean absolute error  
     'mse',              # mean squarred error  
@@ -51,4 +56,5 @@ from .dataloader import *
 from .models import *
 from .training import *
 from .preprocessing import *
+from .shards import *
 
@@ -6,6 +6,7 @@ absl.FLAGS-based command line app. To be executed run something like this:
 python -m dl4ds.app --flagfile=params.cfg
 """
 
+import os
 import numpy as np
 import xarray as xr
 import importlib.util
@@ -29,7 +30,7 @@ except ImportError:
     running_on_first_worker = True
 
 import dl4ds as dds
-from dl4ds import BACKBONE_BLOCKS, UPSAMPLING_METHODS, INTERPOLATION_METHODS, LOSS_FUNCTIONS, DROPOUT_VARIANTS
+from dl4ds import BACKBONE_BLOCKS, UPSAMPLING_METHODS, INTERPOLATION_METHODS, LOSS_FUNCTIONS, DROPOUT_VARIANTS, STORAGE_DTYPES
 
 
 FLAGS = flags.FLAGS
@@ -44,6 +45,10 @@ flags.DEFINE_bool('debug', False, 'If True a debug training run (2 epochs by def
 flags.DEFINE_enum('trainer', 'SupervisedTrainer', ['SupervisedTrainer', 'CGANTrainer'], 'Tainer')
 flags.DEFINE_enum('paired_samples', 'implicit', ['implicit', 'explicit'], 'Type of learning: implicit (PerfectProg) or explicit (MOS)')
 flags.DEFINE_string('data_module', None, 'Python module where the data pre-processing is done')
+flags.DEFINE_string('shards_path', None, 'Directory of a sharded dataset, read when `data_module` is not given')
+flags.DEFINE_bool('convert_to_shards', False, 'Convert the data of `data_module` into a sharded dataset in `shards_path` and exit')
+flags.DEFINE_integer('shard_size', 256, 'Number of time steps per shard when converting to a sharded dataset')
+flags.DEFINE_enum('shards_dtype', None, STORAGE_DTYPES, 'Data type of the shards (None to keep the dtype of the data)')
 
 ### MODEL
 flags.DEFINE_enum('backbone', 'resnet', BACKBONE_BLOCKS, 'Backbone section')
@@ -76,6 +81,30 @@ flags.DEFINE_integer('batch_size', 32, 'Batch size (of samples) used during trai
 flags.DEFINE_multi_float('learning_rate', 1e-3, 'Learning rate')
 flags.DEFINE_bool('gpu_memory_growth', True, 'To use GPU memory growth (gradual memory allocation)')
 flags.DEFINE_bool('use_multiprocessing', True, 'To use multiprocessing for data generation')
+flags.DEFINE_enum('data_pipeline', 'sequence', ['sequence', 'tfdata', 'shared_memory'], 'SupervisedTrainer - Input pipeline backend: keras Sequence, parallel tf.data or shared memory worker processes')
+flags.DEFINE_integer('num_parallel_calls', None, 'SupervisedTrainer - Batches created in parallel with the tfdata pipeline (None for autotune)')
+flags.DEFINE_integer('prefetch_depth', None, 'SupervisedTrainer - Batches prefetched with the tfdata pipeline (None for autotune)')
+flags.DEFINE_integer('num_workers', None, 'SupervisedTrainer - Worker processes with the shared_memory pipeline (None for the number of CPUs)')
+flags.DEFINE_integer('queue_depth', None, 'SupervisedTrainer - Batch slots in the ring buffer of the shared_memory pipeline (None for twice num_workers)')
+flags.DEFINE_bool('lazy_loading', False, 'SupervisedTrainer - Read lazily only the time slices needed for each batch (memmaps, zarr or dask arrays)')
+flags.DEFINE_bool('lr_cache', False, 'Coarsen once the HR training data for implicit pairs (LR cache)')
+flags.DEFINE_enum('lr_cache_dtype', 'float32', STORAGE_DTYPES, 'Data type of the LR cache')
+flags.DEFINE_string('lr_cache_path', None, 'Directory for storing the LR cache on disk (None for in-memory)')
+flags.DEFINE_float('lr_cache_max_memory', None, 'Maximum size in GB of the in-memory LR cache')
+flags.DEFINE_integer('seed', None, 'Seed for shuffling the samples every epoch and drawing the crop positions')
+flags.DEFINE_integer('shuffle_blocks', None, 'SupervisedTrainer - Shuffle the samples in blocks of consecutive time steps, mixing this number of blocks at a time (None for a full shuffle)')
+flags.DEFINE_integer('shuffle_block_size', None, 'SupervisedTrainer - Time steps per shuffled block (None for the chunk size of the lazily loaded data)')
+flags.DEFINE_bool('materialize_eval', False, 'SupervisedTrainer - Create once the validation and test samples (full domain or fixed tiling of patches) and reuse them every epoch')
+flags.DEFINE_string('materialize_eval_path', None, 'SupervisedTrainer - Directory for storing the materialized validation and test samples on disk (None for in-memory)')
+flags.DEFINE_integer('patch_mask', None, 'Index of the static variable used as mask (e.g., land-ocean) for cropping only patches with enough valid pixels')
+flags.DEFINE_float('patch_min_valid', 0.5, 'Minimum fraction of valid pixels of the cropped patches (with `patch_mask`)')
+flags.DEFINE_integer('patch_bank_size', None, 'SupervisedTrainer - Number of pre-built samples in a bank the training batches are drawn from (None for creating the batches on the fly)')
+flags.DEFINE_float('patch_bank_refresh', 0.25, 'SupervisedTrainer - Fraction of the patch bank replaced in the background after every epoch')
+flags.DEFINE_string('data_echoing', None, "Number of training steps each batch is reused for, or 'auto' for choosing it from the measured batch and step times")
+flags.DEFINE_bool('echo_augment', False, 'Whether to re-augment the echoed batches with random flips and transposes (not for geolocated fields with non-invariant variables, nor with localcon_layer)')
+flags.DEFINE_integer('frame_cache_size', None, 'Maximum number of preprocessed frames cached and reused across samples and epochs')
+flags.DEFINE_bool('use_season', False, 'Feed the season of each sample as one-hot channels (data as xr.DataArrays with a time coordinate)')
+flags.DEFINE_enum('storage_dtype', None, STORAGE_DTYPES, 'Data type of the training arrays kept in memory, batches are upcast to float32 (None to keep the dtype of the data)')
 flags.DEFINE_float('lr_decay_after', 1e5, 'Steps to tweak the learning rate using the PiecewiseConstantDecay scheduler')
 flags.DEFINE_bool('early_stopping', False, 'Early stopping')
 flags.DEFINE_integer('patience', 6, 'Patience in number of epochs w/o improvement for early stopping')
@@ -88,6 +117,10 @@ flags.DEFINE_integer('checkpoints_frequency', 2, 'CGANTrainer - Frequency for sa
 ### INFERENCE/TEST
 flags.DEFINE_bool('inference_array_in_hr', False, 'Whether the inference array is in high resolution')
 flags.DEFINE_string('inference_save_fname', None, 'Filename for saving the inference array')
+flags.DEFINE_integer('inference_tile_size', None, 'Size of the tiles (HR pixels) for tiled inference (None for full-domain inference)')
+flags.DEFINE_integer('inference_tile_overlap', None, 'Overlap between neighbouring tiles (HR pixels) for tiled inference')
+flags.DEFINE_enum('inference_blending', 'cosine', ['cosine', 'linear'], 'Weights for blending the overlapping tiles')
+flags.DEFINE_integer('inference_chunk_size', None, 'Number of time steps per chunk for streaming the inference to the netcdf file (None for in-memory inference)')
 
 
 
@@ -105,6 +138,16 @@ def dl4ds(argv):
         epochs = FLAGS.epochs
         steps_per_epoch = test_steps = validation_steps = None 
 
+    # echo factor given as an int or 'auto'
+    if FLAGS.data_echoing is None or FLAGS.data_echoing == 'auto':
+        data_echoing = FLAGS.data_echoing
+    else:
+        data_echoing = int(FLAGS.data_echoing)
+
+    # streamed inference writes the prediction to disk as it goes
+    if FLAGS.test and FLAGS.inference_chunk_size is not None and not FLAGS.save_path:
+        raise ValueError('`inference_chunk_size` requires `save_path` for writing the prediction')
+
     if running_on_first_worker:
         print('<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<< Loading data >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>\n')
     # Training data from Python script/module
@@ -112,8 +155,38 @@ def dl4ds(argv):
         spec = importlib.util.spec_from_file_location("module.name", FLAGS.data_module)
         DATA = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(DATA)
+        use_data_lr = FLAGS.paired_samples == 'explicit'
+        if FLAGS.convert_to_shards:
+            if FLAGS.shards_path is None:
+                raise ValueError('`shards_path` flag must be provided for converting to shards')
+            splits = dict(
+                train=dict(data=DATA.data_train, predictors=DATA.predictors_train,
+                           data_lr=DATA.data_train_lr if use_data_lr else None),
+                val=dict(data=DATA.data_val, predictors=DATA.predictors_val,
+                         data_lr=DATA.data_val_lr if use_data_lr else None),
+                test=dict(data=DATA.data_test, predictors=DATA.predictors_test,
+                          data_lr=DATA.data_test_lr if use_data_lr else None),
+                inference=dict(data=DATA.inference_data, predictors=DATA.inference_predictors),
+                holdout=dict(data=DATA.gt_holdout_dataset))
+            dds.create_shards(
+                FLAGS.shards_path, 
+                splits, 
+                static_vars=DATA.static_vars, 
+                mask=DATA.gt_mask, 
+                scaler=DATA.inference_scaler, 
+                scale=FLAGS.scale, 
+                interpolation=FLAGS.interpolation, 
+                precompute_lr=not use_data_lr, 
+                shard_size=FLAGS.shard_size, 
+                dtype=FLAGS.shards_dtype, 
+                verbose=running_on_first_worker)
+            return
+    # Training data from a sharded dataset (already paired)
+    elif FLAGS.shards_path is not None:
+        DATA = dds.load_shards(FLAGS.shards_path, lazy=FLAGS.lazy_loading)
+        use_data_lr = True
     else:
-        raise ValueError('`data_module` flag must be provided (path to the data preprocessing module)')
+        raise ValueError('`data_module` or `shards_path` flag must be provided (path to the data preprocessing module or to a sharded dataset)')
 
     # Architecture parameters
     if FLAGS.time_window is None:
@@ -177,9 +250,9 @@ def dl4ds(argv):
                 data_train=DATA.data_train, 
                 data_val=DATA.data_val, 
                 data_test=DATA.data_test, 
-                data_train_lr=DATA.data_train_lr if FLAGS.paired_samples == 'explicit' else None, 
-                data_val_lr=DATA.data_val_lr if FLAGS.paired_samples == 'explicit' else None, 
-                data_test_lr=DATA.data_test_lr if FLAGS.paired_samples == 'explicit' else None, 
+                data_train_lr=DATA.data_train_lr if use_data_lr else None, 
+                data_val_lr=DATA.data_val_lr if use_data_lr else None, 
+                data_test_lr=DATA.data_test_lr if use_data_lr else None, 
                 predictors_train=DATA.predictors_train, 
                 predictors_val=DATA.predictors_val, 
                 predictors_test=DATA.predictors_test, 
@@ -197,6 +270,30 @@ def dl4ds(argv):
                 device=FLAGS.device, 
                 gpu_memory_growth=FLAGS.gpu_memory_growth, 
                 use_multiprocessing=FLAGS.use_multiprocessing, 
+                data_pipeline=FLAGS.data_pipeline,
+                num_parallel_calls=FLAGS.num_parallel_calls,
+                prefetch_depth=FLAGS.prefetch_depth,
+                num_workers=FLAGS.num_workers,
+                queue_depth=FLAGS.queue_depth,
+                lazy_loading=FLAGS.lazy_loading,
+                lr_cache=FLAGS.lr_cache,
+                lr_cache_dtype=FLAGS.lr_cache_dtype,
+                lr_cache_path=FLAGS.lr_cache_path,
+                lr_cache_max_memory=FLAGS.lr_cache_max_memory,
+                seed=FLAGS.seed,
+                frame_cache_size=FLAGS.frame_cache_size,
+                storage_dtype=FLAGS.storage_dtype,
+                use_season=FLAGS.use_season,
+                patch_mask=FLAGS.patch_mask,
+                patch_min_valid=FLAGS.patch_min_valid,
+                data_echoing=data_echoing,
+                echo_augment=FLAGS.echo_augment,
+                shuffle_blocks=FLAGS.shuffle_blocks,
+                shuffle_block_size=FLAGS.shuffle_block_size,
+                materialize_eval=FLAGS.materialize_eval,
+                materialize_eval_path=FLAGS.materialize_eval_path,
+                patch_bank_size=FLAGS.patch_bank_size,
+                patch_bank_refresh=FLAGS.patch_bank_refresh,
                 learning_rate=FLAGS.learning_rate, 
                 lr_decay_after=FLAGS.lr_decay_after, 
                 early_stopping=FLAGS.early_stopping, 
@@ -223,8 +320,8 @@ def dl4ds(argv):
                 upsampling=FLAGS.upsampling,
                 data_train=DATA.data_train, 
                 data_test=DATA.data_test, 
-                data_train_lr=DATA.data_train_lr if FLAGS.paired_samples == 'explicit' else None,
-                data_test_lr=DATA.data_test_lr if FLAGS.paired_samples == 'explicit' else None,
+                data_train_lr=DATA.data_train_lr if use_data_lr else None,
+                data_test_lr=DATA.data_test_lr if use_data_lr else None,
                 predictors_train=DATA.predictors_train,
                 predictors_test=DATA.predictors_test,
                 scale=FLAGS.scale, 
@@ -239,6 +336,18 @@ def dl4ds(argv):
                 steps_per_epoch=steps_per_epoch,
                 interpolation=FLAGS.interpolation, 
                 static_vars=DATA.static_vars,
+                lr_cache=FLAGS.lr_cache,
+                lr_cache_dtype=FLAGS.lr_cache_dtype,
+                lr_cache_path=FLAGS.lr_cache_path,
+                lr_cache_max_memory=FLAGS.lr_cache_max_memory,
+                seed=FLAGS.seed,
+                frame_cache_size=FLAGS.frame_cache_size,
+                storage_dtype=FLAGS.storage_dtype,
+                use_season=FLAGS.use_season,
+                patch_mask=FLAGS.patch_mask,
+                patch_min_valid=FLAGS.patch_min_valid,
+                data_echoing=data_echoing,
+                echo_augment=FLAGS.echo_augment,
                 checkpoints_frequency=FLAGS.checkpoints_frequency, 
                 save=FLAGS.save,
                 save_path=FLAGS.save_path,
@@ -258,7 +367,18 @@ def dl4ds(argv):
         else:
             inference_scaler = DATA.inference_scaler
 
+        # time coordinate for the season channels, read from the index of a 
+        # sharded dataset (the arrays may have no coordinates)
+        if not FLAGS.use_season:
+            inference_time = None
+        elif isinstance(DATA, dds.ShardedDataset):
+            inference_time = DATA.time('inference')
+        else:
+            inference_time = DATA.inference_data.time
+
         if not has_horovod or running_on_first_worker:
+            # streamed inference writes the netcdf file chunk by chunk
+            stream_inference = FLAGS.inference_chunk_size is not None
             predictor = dds.Predictor(
                 trainer=trainer,
                 array=DATA.inference_data, 
@@ -268,23 +388,31 @@ def dl4ds(argv):
                 predictors=DATA.inference_predictors, 
                 static_vars=DATA.static_vars, 
                 time_window=FLAGS.time_window, 
+                time_metadata=inference_time,
                 batch_size=FLAGS.batch_size,
                 scaler=inference_scaler,
                 save_path=FLAGS.save_path, 
                 save_fname=FLAGS.inference_save_fname,
-                device=FLAGS.device)
+                device=FLAGS.device,
+                tile_size=FLAGS.inference_tile_size,
+                tile_overlap=FLAGS.inference_tile_overlap,
+                blending=FLAGS.inference_blending,
+                chunk_size=FLAGS.inference_chunk_size,
+                output_path=os.path.join(FLAGS.save_path, 'y_hat.nc') if stream_inference else None,
+                coords=DATA.gt_holdout_dataset if stream_inference else None)
 
             y_hat = predictor.run()
 
             # Saving the downscaled product in netcdf format
-            y_hat_datarray = xr.DataArray(data=np.squeeze(y_hat), 
-                                          dims=('time', 'lat', 'lon'), 
-                                          coords={'time':DATA.gt_holdout_dataset.time, 
-                                                  'lon':DATA.gt_holdout_dataset.lon, 
-                                                  'lat':DATA.gt_holdout_dataset.lat})
-            
-            if FLAGS.save_path is not None:
-                y_hat_datarray.to_netcdf(f'{FLAGS.save_path}y_hat.nc')
+            if not stream_inference:
+                y_hat_datarray = xr.DataArray(data=np.squeeze(y_hat), 
+                                              dims=('time', 'lat', 'lon'), 
+                                              coords={'time':DATA.gt_holdout_dataset.time, 
+                                                      'lon':DATA.gt_holdout_dataset.lon, 
+                                                      'lat':DATA.gt_holdout_dataset.lat})
+                
+                if FLAGS.save_path is not None:
+                    y_hat_datarray.to_netcdf(f'{FLAGS.save_path}y_hat.nc')
 
     if FLAGS.metrics:
         if running_on_first_worker:
@@ -292,7 +420,7 @@ def dl4ds(argv):
         if not has_horovod or running_on_first_worker:
             metrics = dds.compute_metrics(
                 y_test=DATA.gt_holdout_dataset, 
-                y_test_hat=y_hat, 
+                y_test_hat=np.asarray(y_hat), 
                 dpi=300, plot_size_px=1200, 
                 mask=DATA.gt_mask, 
                 save_path=FLAGS.save_path,
@@ -1,11 +1,35 @@
 import tensorflow as tf
 import numpy as np
-import scipy as sc
 import xarray as xr
 import ecubevis as ecv
+import copy
+import mmap
+import time
+import queue
+import traceback
+import weakref
+import warnings
+import threading
+from collections import OrderedDict
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    import zarr
+    has_zarr = True
+except ImportError:
+    has_zarr = False
+
+try:
+    import horovod.tensorflow as hvd
+    has_horovod = True
+except ImportError:
+    has_horovod = False
 
 from . import POSTUPSAMPLING_METHODS
-from .utils import crop_array, resize_array, checkarray_ndim
+from .utils import (crop_array, resize_array, checkarray_ndim, 
+                    checkarg_storage_dtype, _numpy_dtype_)
 
 
 def create_pair_hr_lr(
@@ -18,7 +42,9 @@ def create_pair_hr_lr(
     predictors=None, 
     season=None,
     debug=False, 
-    interpolation='inter_area'):
+    interpolation='inter_area',
+    rng=None,
+    patch_sampler=None):
     """
     Create a pair of HR and LR square sub-patches. In this case, the LR 
     corresponds to a coarsen version of the HR reference with land-ocean mask,
@@ -37,21 +63,40 @@ def create_pair_hr_lr(
         Scaling factor.
     patch_size : int or None
         Size of the square patches to be extracted, in pixels for the HR grid.
-    static_vars : None or list of 2D ndarrays, optional
+    static_vars : None or list of 2D ndarrays or dl4ds.StaticVarsCache, optional
         Static variables such as elevation data or a binary land-ocean mask.
     predictors : np.ndarray, optional
         Predictor variables in HR. To be concatenated to the LR version of 
         `array`.
+    season : str or None, optional
+        Season of the sample ('winter', 'spring', 'summer' or 'autumn'), 
+        encoded as one-hot channels in the auxiliary array (and in the LR array
+        for spatial samples).
     interpolation : str, optional
         Interpolation used when upsampling/downsampling the training samples.
         By default 'bicubic'. 
     debug : bool, optional
         If True, plots and debugging information are shown.
+    rng : np.random.Generator or None, optional
+        Random generator used for the crop positions. If None, the global 
+        ``np.random`` state is used.
+    patch_sampler : dl4ds.PatchSampler or None, optional
+        If not None, the crop positions are drawn among its valid patch 
+        origins.
 
+    The intermediate arrays keep the dtype of the inputs (e.g., float32 inputs
+    are not promoted to float64), and the returned arrays are float32.
     """
+    randint = np.random.randint if rng is None else rng.integers
+
     def preproc_static_vars(var):
         if patch_size is not None:
-            var_hr = crop_array(np.squeeze(var), patch_size, yx=(crop_y, crop_x))
+            # crop position in the hr grid
+            if upsampling in POSTUPSAMPLING_METHODS:
+                yx_hr = (crop_y_hr, crop_x_hr)
+            else:
+                yx_hr = (crop_y, crop_x)
+            var_hr = crop_array(np.squeeze(var), patch_size, yx=yx_hr)
             var_hr = checkarray_ndim(var_hr, 3, -1)
             if upsampling in POSTUPSAMPLING_METHODS:  
                 var_lr = resize_array(var_hr, (patch_size_lr, patch_size_lr), interpolation) 
@@ -94,25 +139,52 @@ def create_pair_hr_lr(
             else:
                 lr_y = array_lr.shape[0]
                 lr_x = array_lr.shape[1]
-            # lr grid is upsampled via interpolation
-            if is_spatiotemp:
-                lr_array = checkarray_ndim(lr_array, 4, -1)
-            lr_array_resized = resize_array(lr_array, (hr_x, hr_y), interpolation, squeezed=False)         
         else:
             lr_x, lr_y = int(hr_x / scale), int(hr_y / scale) 
-            # hr grid is downsampled and upsampled via interpolation
-            lr_array_resized = resize_array(hr_array, (lr_x, lr_y), interpolation, squeezed=False)
-            # coarsened grid is upsampled via interpolation
-            lr_array_resized = resize_array(lr_array_resized, (hr_x, hr_y), interpolation, squeezed=False)  
         
-        if patch_size is not None:
-            # cropping both hr_array and lr_array (same sizes)
-            hr_array, crop_y, crop_x = crop_array(np.squeeze(hr_array), patch_size, 
-                                                  yx=None, position=True)
-            lr_array = crop_array(np.squeeze(lr_array_resized), patch_size, yx=(crop_y, crop_x))
+        ndim = 4 if is_spatiotemp else 3
+        crop_first = patch_size is not None and _pin_crop_first_is_possible_(
+            (hr_y, hr_x), (lr_y, lr_x), patch_size, scale, interpolation, 
+            from_hr=not lr_is_given)
+        if crop_first:
+            # cropping first, only the patch region (plus a halo) is interpolated
+            if patch_sampler is not None:
+                crop_y, crop_x = patch_sampler.draw(rng, grid_shape=(hr_y, hr_x))
+            else:
+                crop_y = randint(0, hr_y - patch_size)
+                crop_x = randint(0, hr_x - patch_size)
+            hr_array = checkarray_ndim(hr_array, ndim, -1)
+            if lr_is_given:
+                lr_array = _pin_crop_first_sample_(
+                    checkarray_ndim(lr_array, ndim, -1), (crop_y, crop_x), 
+                    patch_size, scale, interpolation)
+            else:
+                lr_array = _pin_crop_first_sample_(
+                    hr_array, (crop_y, crop_x), patch_size, scale, interpolation, 
+                    from_hr=True)
+            hr_array = crop_array(hr_array, patch_size, yx=(crop_y, crop_x))
         else:
-            # no cropping
-            lr_array = lr_array_resized
+            if lr_is_given:
+                # lr grid is upsampled via interpolation
+                if is_spatiotemp:
+                    lr_array = checkarray_ndim(lr_array, 4, -1)
+                lr_array_resized = resize_array(lr_array, (hr_x, hr_y), interpolation, squeezed=False)         
+            else:
+                # hr grid is downsampled and upsampled via interpolation
+                lr_array_resized = resize_array(hr_array, (lr_x, lr_y), interpolation, squeezed=False)
+                # coarsened grid is upsampled via interpolation
+                lr_array_resized = resize_array(lr_array_resized, (hr_x, hr_y), interpolation, squeezed=False)  
+        
+            if patch_size is not None:
+                # cropping both hr_array and lr_array (same sizes)
+                hr_array, crop_y, crop_x = crop_array(checkarray_ndim(hr_array, ndim, -1), 
+                                                      patch_size, yx=None, position=True, rng=rng, 
+                                                      patch_sampler=patch_sampler)
+                lr_array = crop_array(checkarray_ndim(lr_array_resized, ndim, -1), 
+                                      patch_size, yx=(crop_y, crop_x))
+            else:
+                # no cropping
+                lr_array = lr_array_resized
         
         if is_spatiotemp:
             hr_array = checkarray_ndim(hr_array, 4, -1)
@@ -124,14 +196,19 @@ def create_pair_hr_lr(
         if predictors is not None:
             if predictors.shape[1] != lr_y or predictors.shape[2] != lr_x:
                 # we coarsen/interpolate the mid-res or high-res predictors
-                predictors = resize_array(predictors, (lr_x, lr_y), interpolation)  
+                predictors = resize_array(predictors, (lr_x, lr_y), interpolation, squeezed=False)  
 
-            predictors = resize_array(predictors, (hr_x, hr_y), interpolation)  
-            if patch_size is not None:
+            if crop_first:
+                lr_array_predictors = _pin_crop_first_sample_(
+                    checkarray_ndim(predictors, ndim, -1), (crop_y, crop_x), 
+                    patch_size, scale, interpolation)
+            elif patch_size is not None:
+                predictors = resize_array(predictors, (hr_x, hr_y), interpolation, squeezed=False)  
                 # cropping first the predictors 
                 lr_array_predictors, crop_y, crop_x = crop_array(predictors, patch_size,
                                                                  yx=(crop_y, crop_x), position=True)
             else:            
+                predictors = resize_array(predictors, (hr_x, hr_y), interpolation, squeezed=False)  
                 if is_spatiotemp:
                     lr_array_predictors = checkarray_ndim(predictors, 4, -1)
                 else:
@@ -157,24 +234,29 @@ def create_pair_hr_lr(
         if predictors is not None:
             if predictors.shape[1] != lr_y or predictors.shape[2] != lr_x:
                 # we coarsen/interpolate the mid-res or high-res predictors
-                lr_array_predictors = resize_array(predictors, (lr_x, lr_y), interpolation) 
+                lr_array_predictors = resize_array(predictors, (lr_x, lr_y), interpolation, squeezed=False) 
             else:
                 lr_array_predictors = predictors 
 
             if patch_size is not None:
                 # cropping the lr predictors 
                 lr_array_predictors, crop_y, crop_x = crop_array(lr_array_predictors, patch_size_lr,
-                                                                 yx=None, position=True)
+                                                                 yx=None, position=True, rng=rng, 
+                                                                 patch_sampler=patch_sampler)
                 crop_y_hr = int(crop_y * scale)
                 crop_x_hr = int(crop_x * scale)
                 # cropping the hr_array
-                hr_array = crop_array(np.squeeze(hr_array), patch_size, yx=(crop_y_hr, crop_x_hr))   
+                hr_array = crop_array(checkarray_ndim(hr_array, 4 if is_spatiotemp else 3, -1), 
+                                      patch_size, yx=(crop_y_hr, crop_x_hr))   
                 if lr_is_given:
                     lr_array = crop_array(lr_array, patch_size_lr, yx=(crop_y, crop_x))
 
             # downsampling the hr array to get lr_array when the lr array is not provided
             if not lr_is_given:
-                lr_array = resize_array(hr_array, (lr_x, lr_y), interpolation, squeezed=False)   
+                if patch_size is not None:
+                    lr_array = resize_array(hr_array, (patch_size_lr, patch_size_lr), interpolation, squeezed=False)
+                else:
+                    lr_array = resize_array(hr_array, (lr_x, lr_y), interpolation, squeezed=False)   
 
             if is_spatiotemp:
                 hr_array = checkarray_ndim(hr_array, 4, -1)
@@ -192,27 +274,40 @@ def create_pair_hr_lr(
                 if lr_is_given:
                     # cropping the lr array
                     lr_array, crop_y, crop_x = crop_array(lr_array, patch_size_lr,
-                                                          yx=None, position=True)
+                                                          yx=None, position=True, rng=rng, 
+                                                          patch_sampler=patch_sampler)
                     crop_y_hr = int(crop_y * scale)
                     crop_x_hr = int(crop_x * scale)
                     # cropping the hr_array
-                    hr_array = crop_array(np.squeeze(hr_array), patch_size, yx=(crop_y_hr, crop_x_hr)) 
+                    hr_array = crop_array(checkarray_ndim(hr_array, 4 if is_spatiotemp else 3, -1), 
+                                          patch_size, yx=(crop_y_hr, crop_x_hr)) 
                 else:
                     # cropping the hr array 
-                    hr_array, crop_y, crop_x = crop_array(hr_array, patch_size, yx=None, position=True)
+                    hr_array, crop_y, crop_x = crop_array(hr_array, patch_size, yx=None, position=True, rng=rng, 
+                                                          patch_sampler=patch_sampler)
+                    crop_y_hr, crop_x_hr = crop_y, crop_x
                     # downsampling the hr array to get lr_array
-                    lr_array = resize_array(hr_array, (patch_size_lr, patch_size_lr), interpolation)
+                    lr_array = resize_array(hr_array, (patch_size_lr, patch_size_lr), interpolation, squeezed=False)
             else:
                 if not lr_is_given:
                     # downsampling the hr array to get lr_array
-                    lr_array = resize_array(hr_array, (lr_x, lr_y), interpolation)    
-            hr_array = checkarray_ndim(hr_array, 3, -1)
-            lr_array = checkarray_ndim(lr_array, 3, -1)
+                    lr_array = resize_array(hr_array, (lr_x, lr_y), interpolation, squeezed=False)    
+            hr_array = checkarray_ndim(hr_array, 4 if is_spatiotemp else 3, -1)
+            lr_array = checkarray_ndim(lr_array, 4 if is_spatiotemp else 3, -1)
 
     # --------------------------------------------------------------------------
     # Including the static variables and season
     static_array_hr = []
-    if static_vars is not None:
+    if isinstance(static_vars, StaticVarsCache):
+        if patch_size is not None:
+            yx_hr = (crop_y_hr, crop_x_hr) if upsampling in POSTUPSAMPLING_METHODS else (crop_y, crop_x)
+            static_array_hr, static_array_lr = static_vars.crop(patch_size, yx_hr)
+        else:
+            static_array_hr, static_array_lr = static_vars.hr, static_vars.lr
+        # for spatial samples, the static array is concatenated to the lr one
+        if not is_spatiotemp:
+            lr_array = np.concatenate([lr_array, static_array_lr], axis=-1)
+    elif static_vars is not None:
         for staticvar in static_vars:
             staticvar_hr, staticvar_lr = preproc_static_vars(staticvar)
             static_array_hr.append(staticvar_hr)
@@ -224,23 +319,23 @@ def create_pair_hr_lr(
     if season is not None:
         if patch_size is not None:
             season_array_hr = _get_season_array_(season, patch_size, patch_size) 
-            static_array_hr = np.concatenate([static_array_hr, season_array_hr], axis=-1)
             if upsampling in POSTUPSAMPLING_METHODS:
                 season_array_lr = _get_season_array_(season, patch_size_lr, patch_size_lr) 
             else:
                 season_array_lr = season_array_hr
-            lr_array = np.concatenate([lr_array, season_array_lr], axis=-1)
         else:
             season_array_hr = _get_season_array_(season, hr_y, hr_x) 
-            static_array_hr = np.concatenate([static_array_hr, season_array_hr], axis=-1)
             if upsampling in POSTUPSAMPLING_METHODS:
                 season_array_lr = _get_season_array_(season, lr_y, lr_x) 
             else:
                 season_array_lr = season_array_hr
-
-            # for spatial samples, the season array is concatenated to the lr
-            if not is_spatiotemp:
-                lr_array = np.concatenate([lr_array, season_array_lr], axis=-1)
+        if static_vars is not None:
+            static_array_hr = np.concatenate([static_array_hr, season_array_hr], axis=-1)
+        else:
+            static_array_hr = season_array_hr
+        # for spatial samples, the season array is concatenated to the lr
+        if not is_spatiotemp:
+            lr_array = np.concatenate([lr_array, season_array_lr], axis=-1)
     else:
         season_array_lr = None
 
@@ -294,6 +389,82 @@ def create_pair_hr_lr(
         return hr_array, lr_array
 
 
+def create_lr_cache(
+    array, 
+    scale, 
+    interpolation='inter_area', 
+    dtype='float32', 
+    max_memory=None, 
+    save_path=None, 
+    chunk_size=256,
+    nan_aware=False,
+    verbose=False):
+    """
+    Coarsen the whole HR array once, in bulk, to create a LR array that can be
+    used in place of the on-the-fly coarsening of implicit (PerfectProg) pairs.
+    The LR array is computed in chunks along the first dimension.
+
+    Parameters
+    ----------
+    array : np.ndarray or dl4ds.LazyArray
+        HR gridded data with dims [time, lat, lon, vars]. 
+    scale : int
+        Scaling factor.
+    interpolation : str, optional
+        Interpolation used when downsampling the HR array.
+    dtype : str, optional
+        Data type of the cache, e.g. 'float32', 'float16' or 'bfloat16'.
+    max_memory : float or None, optional
+        Maximum size of the cache in GB. If the cache is larger and 
+        ``save_path`` is None, then no cache is created (None is returned, 
+        with a warning).
+    save_path : str or None, optional
+        If not None, the cache is stored on disk as a ``.npy`` file and returned
+        as a memory-map.
+    chunk_size : int, optional
+        Number of grids coarsened at once.
+    nan_aware : bool, optional
+        If True, missing values (NaNs) are ignored when coarsening, with a block
+        mean (``interpolation='inter_area'`` and HR sizes divisible by 
+        ``scale``). Otherwise, NaNs are propagated to the LR grid.
+    verbose : bool, optional
+        Verbosity.
+
+    Returns
+    -------
+    array_lr : np.ndarray, np.memmap or None
+        Coarsened array with dims [time, lat / scale, lon / scale, vars].
+    """
+    n, hr_y, hr_x, n_ch = array.shape
+    lr_x, lr_y = int(hr_x / scale), int(hr_y / scale)
+    shape = (n, lr_y, lr_x, n_ch)
+    dtype = _numpy_dtype_(dtype)
+    size_gb = np.prod(shape) * dtype.itemsize / 1e9
+
+    if save_path is not None:
+        if not save_path.endswith('.npy'):
+            save_path += '.npy'
+        array_lr = np.lib.format.open_memmap(save_path, mode='w+', dtype=dtype, shape=shape)
+    elif max_memory is not None and size_gb > max_memory:
+        warnings.warn(f'LR cache ({size_gb:.2f} GB) exceeds `max_memory` ({max_memory} GB), '
+                      'no cache is created and the LR samples are coarsened on the fly')
+        return None
+    else:
+        array_lr = np.empty(shape, dtype=dtype)
+
+    for i in range(0, n, chunk_size):
+        chunk = np.asarray(array[i: i + chunk_size])
+        # frames are resized in parallel directly into the cache
+        resize_array(chunk, (lr_x, lr_y), interpolation, squeezed=False, 
+                     out=array_lr[i: i + chunk_size], nan_aware=nan_aware)
+
+    if save_path is not None:
+        array_lr.flush()
+    if verbose:
+        print(f'LR cache created with shape {shape} ({size_gb:.2f} GB)')
+    return array_lr
+
+
 def create_batch_hr_lr(
     all_indices,
     index,
@@ -307,12 +478,43 @@ def create_batch_hr_lr(
     static_vars=None, 
     predictors=None,
     interpolation='inter_area',
-    time_metadata=None
+    time_metadata=None,
+    vectorized=True,
+    rng=None,
+    frame_cache=None,
+    patch_sampler=None
     ):
-    """Create a batch of HR/LR samples.
+    """Create a batch of HR/LR samples. 
+    
+    When ``vectorized`` is True and the arrays are in memory (without time 
+    metadata), the whole batch is assembled at once (see 
+    ``_create_batch_vectorized_``). Otherwise, the samples are created one by 
+    one with ``create_pair_hr_lr``. The crop positions are drawn from ``rng``
+    (a ``np.random.Generator``), or from the global ``np.random`` state if 
+    None. A ``FrameCache`` can be given for memoizing the preprocessing of the
+    frames in the vectorized path.
+
+    ``time_metadata`` can be given as a time coordinate or, preferably, as a 
+    season table already encoded with ``create_season_table``. The season of
+    each sample is then added as one-hot channels.
+
+    If a ``PatchSampler`` is given, the crop positions are drawn only among its
+    valid patch origins (e.g., patches mostly over land).
     """
     # take a batch of indices (`batch_size` indices randomized temporally)
     batch_rand_idx = all_indices[index * batch_size : (index + 1) * batch_size]
+    if time_metadata is not None and not _is_season_table_(time_metadata):
+        time_metadata = create_season_table(time_metadata, time_window)
+
+    inputs = [array, array_lr, predictors]
+    if vectorized and all(arr is None or type(arr) in (np.ndarray, np.memmap) for arr in inputs):
+        season_codes = None if time_metadata is None else time_metadata[batch_rand_idx]
+        return _create_batch_vectorized_(
+            batch_rand_idx, array, array_lr, upsampling, scale, patch_size, 
+            static_vars, predictors, interpolation, rng=rng, 
+            time_window=time_window, frame_cache=frame_cache, 
+            season_codes=season_codes, patch_sampler=patch_sampler)
+
     batch_hr = []
     batch_lr = []
     batch_aux_hr = []
@@ -324,14 +526,13 @@ def create_batch_hr_lr(
             data_i = array[i]
             data_lr_i = None if array_lr is None else array_lr[i]
             predictors_i = None if predictors is None else predictors[i]
-            season_i = _get_season_(time_metadata[i], time_window) if time_metadata is not None else None
 
         # spatio-temporal samples
         else:
             data_i = array[i:i+time_window]  
             data_lr_i = None if array_lr is None else array_lr[i:i+time_window]     
             predictors_i = None if predictors is None else predictors[i:i+time_window]
-            season_i = _get_season_(time_metadata[i:i+time_window], time_window) if time_metadata is not None else None
+        season_i = _SEASONS_[time_metadata[i]] if time_metadata is not None else None
 
         res = create_pair_hr_lr(
             array=data_i,
@@ -342,7 +543,9 @@ def create_batch_hr_lr(
             static_vars=static_vars, 
             season=season_i,
             interpolation=interpolation,
-            predictors=predictors_i)
+            predictors=predictors_i,
+            rng=rng,
+            patch_sampler=patch_sampler)
 
         if static_vars is not None or season_i is not None:
             hr_array, lr_array, static_array_hr = res
@@ -360,6 +563,990 @@ def create_batch_hr_lr(
         return [batch_lr], [batch_hr]
 
 
+def _create_batch_vectorized_(
+    indices, 
+    array, 
+    array_lr, 
+    upsampling, 
+    scale, 
+    patch_size, 
+    static_vars=None, 
+    predictors=None, 
+    interpolation='inter_area',
+    rng=None,
+    time_window=None,
+    frame_cache=None,
+    season_codes=None,
+    patch_sampler=None):
+    """Create a batch of HR/LR samples at once. The crop positions of all the
+    samples are drawn together, the patches are gathered with fancy indexing 
+    and the resizing is done for the whole stack of grids. The output arrays 
+    are preallocated in float32.
+
+    For spatiotemporal samples (``time_window`` not None), the frames of all 
+    the time windows are processed as a stack of spatial grids, with the same 
+    crop position for the frames of a sample. Only the patches are gathered 
+    from the frames (no copies of the whole windows).
+
+    If a ``FrameCache`` is given, the full-grid preprocessing of the frames 
+    (coarsening or interpolation of the whole grids, which does not depend on
+    the crop positions) is memoized across samples and batches.
+
+    The ``season_codes`` of the samples (see ``create_season_table``) are added
+    as one-hot channels, broadcast from a small lookup table.
+    """
+    randint = np.random.randint if rng is None else rng.integers
+    indices = np.asarray(indices)
+    if time_window is not None:
+        n_samples = len(indices)
+        # frame indices of each time window [n_samples * time_window]
+        indices = (indices[:, np.newaxis] + np.arange(time_window)).ravel()
+        sample_randint = randint
+        
+        def randint(low, high, size):
+            return np.repeat(sample_randint(low, high, size=n_samples), time_window)
+    n = len(indices)
+    hr_y, hr_x = array.shape[1], array.shape[2]
+
+    def draw_positions(max_y, max_x, grid_shape):
+        # crop positions, among the valid patch origins with a patch sampler
+        if patch_sampler is None:
+            return randint(0, max_y, size=n), randint(0, max_x, size=n)
+        ys, xs = patch_sampler.origins(grid_shape)
+        k = randint(0, len(ys), size=n)
+        return ys[k], xs[k]
+
+    def resize_frames(arr, name, *newsizes):
+        # frames ``indices`` of ``arr`` resized successively to ``newsizes``
+        def resize(idx):
+            frames = arr[idx]
+            for newsize in newsizes:
+                frames = resize_array(frames, newsize, interpolation, squeezed=False)
+            return frames
+        if frame_cache is None:
+            return resize(indices)
+        key = (name, interpolation) + newsizes
+        return frame_cache.get_frames(key, indices, resize)
+
+    if array_lr is not None:
+        lr_y, lr_x = array_lr.shape[1], array_lr.shape[2]
+    else:
+        lr_x, lr_y = int(hr_x / scale), int(hr_y / scale)
+    
+    if static_vars is not None and not isinstance(static_vars, StaticVarsCache):
+        static_vars = StaticVarsCache(static_vars, upsampling, scale, interpolation)
+    
+    # --------------------------------------------------------------------------
+    # Cropping/resizing the arrays  
+    if upsampling == 'pin':
+        crop_first = patch_size is not None and _pin_crop_first_is_possible_(
+            (hr_y, hr_x), (lr_y, lr_x), patch_size, scale, interpolation, 
+            from_hr=array_lr is None)
+        if crop_first:
+            # cropping first, only the patch regions (plus a halo) are interpolated
+            ys, xs = draw_positions(hr_y - patch_size, hr_x - patch_size, (hr_y, hr_x))
+            hr = _gather_patches_(array, indices, ys, xs, patch_size)
+            if array_lr is not None:
+                lr = _pin_crop_first_(array_lr, indices, ys, xs, patch_size, scale, interpolation)
+            else:
+                lr = _pin_crop_first_(array, indices, ys, xs, patch_size, scale, 
+                                      interpolation, from_hr=True)
+            if predictors is not None:
+                if predictors.shape[1] != lr_y or predictors.shape[2] != lr_x:
+                    # we coarsen/interpolate the mid-res or high-res predictors
+                    preds = resize_frames(predictors, 'predictors', (lr_x, lr_y))
+                    preds = _pin_crop_first_(preds, np.arange(n), ys, xs, patch_size, scale, interpolation)
+                else:
+                    preds = _pin_crop_first_(predictors, indices, ys, xs, patch_size, scale, interpolation)
+            if static_vars is not None:
+                static_hr, static_lr = static_vars.crop_batch(patch_size, ys, xs)
+        else:
+            if array_lr is not None:
+                # lr grids are upsampled via interpolation
+                lr = resize_frames(array_lr, 'lr', (hr_x, hr_y))
+            else:
+                # hr grids are downsampled and upsampled via interpolation
+                lr = resize_frames(array, 'hr', (lr_x, lr_y), (hr_x, hr_y))
+            if predictors is not None:
+                if predictors.shape[1] != lr_y or predictors.shape[2] != lr_x:
+                    # we coarsen/interpolate the mid-res or high-res predictors
+                    preds = resize_frames(predictors, 'predictors', (lr_x, lr_y), (hr_x, hr_y))
+                else:
+                    preds = resize_frames(predictors, 'predictors', (hr_x, hr_y))
+            
+            if patch_size is not None:
+                ys, xs = draw_positions(hr_y - patch_size, hr_x - patch_size, (hr_y, hr_x))
+                frames = np.arange(n)
+                hr = _gather_patches_(array, indices, ys, xs, patch_size)
+                lr = _gather_patches_(lr, frames, ys, xs, patch_size)
+                if predictors is not None:
+                    preds = _gather_patches_(preds, frames, ys, xs, patch_size)
+                if static_vars is not None:
+                    static_hr, static_lr = static_vars.crop_batch(patch_size, ys, xs)
+            else:
+                hr = array[indices]
+                if static_vars is not None:
+                    static_hr, static_lr = static_vars.broadcast(n)
+
+    elif upsampling in POSTUPSAMPLING_METHODS:
+        if predictors is not None:
+            if predictors.shape[1] != lr_y or predictors.shape[2] != lr_x:
+                # we coarsen/interpolate the mid-res or high-res predictors
+                preds = resize_frames(predictors, 'predictors', (lr_x, lr_y))
+            else:
+                preds = predictors[indices]
+
+        if patch_size is not None:
+            patch_size_lr = int(patch_size / scale)
+            if predictors is not None or array_lr is not None:
+                # crop positions are drawn on the lr grid
+                ys, xs = draw_positions(lr_y - patch_size_lr, lr_x - patch_size_lr, (lr_y, lr_x))
+                ys_hr, xs_hr = ys * scale, xs * scale
+            else:
+                ys_hr, xs_hr = draw_positions(hr_y - patch_size, hr_x - patch_size, (hr_y, hr_x))
+            hr = _gather_patches_(array, indices, ys_hr, xs_hr, patch_size)
+            if array_lr is not None:
+                lr = _gather_patches_(array_lr, indices, ys, xs, patch_size_lr)
+            else:
+                lr = resize_array(hr, (patch_size_lr, patch_size_lr), interpolation, squeezed=False)
+            if predictors is not None:
+                preds = _gather_patches_(preds, np.arange(n), ys, xs, patch_size_lr)
+            if static_vars is not None:
+                static_hr, static_lr = static_vars.crop_batch(patch_size, ys_hr, xs_hr)
+        else:
+            hr = array[indices]
+            if array_lr is not None:
+                lr = array_lr[indices]
+            else:
+                lr = resize_frames(array, 'hr', (lr_x, lr_y))
+            if static_vars is not None:
+                static_hr, static_lr = static_vars.broadcast(n)
+
+    # --------------------------------------------------------------------------
+    # Filling the preallocated float32 batches
+    batch_hr = np.empty(hr.shape, 'float32')
+    batch_hr[:] = hr
+    lr_blocks = [lr]
+    if predictors is not None:
+        lr_blocks.append(preds)
+    # for spatial samples, the static and season arrays are concatenated to the lr one
+    if static_vars is not None and time_window is None:
+        lr_blocks.append(static_lr)
+    if season_codes is not None and time_window is None:
+        lr_blocks.append(_get_season_channels_(season_codes, lr.shape[1], lr.shape[2]))
+    n_channels = sum(block.shape[-1] for block in lr_blocks)
+    batch_lr = np.empty(lr.shape[:-1] + (n_channels,), 'float32')
+    ch = 0
+    for block in lr_blocks:
+        batch_lr[..., ch: ch + block.shape[-1]] = block
+        ch += block.shape[-1]
+
+    if time_window is not None:
+        # [n_samples * time_window, ...] -> [n_samples, time_window, ...]
+        batch_hr = batch_hr.reshape((n_samples, time_window) + batch_hr.shape[1:])
+        batch_lr = batch_lr.reshape((n_samples, time_window) + batch_lr.shape[1:])
+        if static_vars is not None:
+            # one static array per sample
+            static_hr = static_hr[::time_window]
+
+    aux_blocks = []
+    if static_vars is not None:
+        aux_blocks.append(static_hr)
+    if season_codes is not None:
+        aux_blocks.append(_get_season_channels_(season_codes, batch_hr.shape[-3], 
+                                                batch_hr.shape[-2]))
+    if static_vars is not None and season_codes is None and patch_size is None:
+        # read-only broadcast of the cached static variables (no copies)
+        batch_aux_hr = static_hr
+        return [batch_lr, batch_aux_hr], [batch_hr]
+    elif aux_blocks:
+        n_channels = sum(block.shape[-1] for block in aux_blocks)
+        batch_aux_hr = np.empty(aux_blocks[0].shape[:-1] + (n_channels,), 'float32')
+        ch = 0
+        for block in aux_blocks:
+            batch_aux_hr[..., ch: ch + block.shape[-1]] = block
+            ch += block.shape[-1]
+        return [batch_lr, batch_aux_hr], [batch_hr]
+    else:
+        return [batch_lr], [batch_hr]
+
+
+def create_batch_lr(
+    indices,
+    array_lr,
+    upsampling,
+    scale=4,
+    static_vars=None,
+    predictors=None,
+    interpolation='inter_area',
+    time_window=None,
+    time_metadata=None):
+    """Create the model inputs of a batch straight from LR grids, for inference
+    on LR data. Unlike ``create_batch_hr_lr`` there is no HR target, so no HR 
+    array (or placeholder) is needed: the HR grid is the LR one times 
+    ``scale``. The LR grids are used as they are by post-upsampling models, 
+    and interpolated to the HR grid for pre-upsampling ('pin') ones. The 
+    channels are laid out as in the training batches.
+
+    Parameters
+    ----------
+    indices : array-like of int
+        Indices of the samples (first time step of the windows for 
+        spatio-temporal samples).
+    array_lr : ndarray
+        LR grids [n, lat, lon, vars].
+    static_vars : None, list of 2D ndarrays or dl4ds.StaticVarsCache, optional
+        Static variables on the HR grid.
+    time_metadata : None, season table or time coordinate, optional
+        Seasons of the samples (see ``create_season_table``).
+
+    Returns
+    -------
+    inputs : list of ndarrays
+        ``[lr]`` or ``[lr, aux_hr]``, with the static variables and/or season 
+        channels in ``aux_hr``.
+    """
+    indices = np.asarray(indices)
+    n_samples = len(indices)
+    if time_metadata is not None and not _is_season_table_(time_metadata):
+        time_metadata = create_season_table(time_metadata, time_window)
+    season_codes = None if time_metadata is None else time_metadata[indices]
+    if time_window is not None:
+        # frame indices of each time window [n_samples * time_window]
+        indices = (indices[:, np.newaxis] + np.arange(time_window)).ravel()
+    n = len(indices)
+
+    lr = checkarray_ndim(np.asarray(array_lr[indices]), 4, -1)
+    lr_y, lr_x = lr.shape[1], lr.shape[2]
+    hr_y, hr_x = lr_y * scale, lr_x * scale
+    if predictors is not None:
+        preds = np.asarray(predictors[indices])
+        if preds.shape[1] != lr_y or preds.shape[2] != lr_x:
+            # we coarsen/interpolate the mid-res or high-res predictors
+            preds = resize_array(preds, (lr_x, lr_y), interpolation, squeezed=False)
+    if upsampling == 'pin':
+        # lr grids (and predictors) are upsampled via interpolation
+        lr = resize_array(lr, (hr_x, hr_y), interpolation, squeezed=False)
+        if predictors is not None:
+            preds = resize_array(preds, (hr_x, hr_y), interpolation, squeezed=False)
+    if static_vars is not None:
+        if not isinstance(static_vars, StaticVarsCache):
+            static_vars = StaticVarsCache(static_vars, upsampling, scale, interpolation)
+        static_hr, static_lr = static_vars.broadcast(n)
+
+    lr_blocks = [lr]
+    if predictors is not None:
+        lr_blocks.append(preds)
+    # for spatial samples, the static and season arrays are concatenated to the lr one
+    if static_vars is not None and time_window is None:
+        lr_blocks.append(static_lr)
+    if season_codes is not None and time_window is None:
+        lr_blocks.append(_get_season_channels_(season_codes, lr.shape[1], lr.shape[2]))
+    n_channels = sum(block.shape[-1] for block in lr_blocks)
+    batch_lr = np.empty(lr.shape[:-1] + (n_channels,), 'float32')
+    ch = 0
+    for block in lr_blocks:
+        batch_lr[..., ch: ch + block.shape[-1]] = block
+        ch += block.shape[-1]
+
+    if time_window is not None:
+        batch_lr = batch_lr.reshape((n_samples, time_window) + batch_lr.shape[1:])
+        if static_vars is not None:
+            # one static array per sample
+            static_hr = static_hr[::time_window]
+
+    aux_blocks = []
+    if static_vars is not None:
+        aux_blocks.append(static_hr)
+    if season_codes is not None:
+        aux_blocks.append(_get_season_channels_(season_codes, hr_y, hr_x))
+    if static_vars is not None and season_codes is None:
+        # read-only broadcast of the cached static variables (no copies)
+        return [batch_lr, static_hr]
+    elif aux_blocks:
+        return [batch_lr, np.concatenate(aux_blocks, axis=-1).astype('float32', copy=False)]
+    else:
+        return [batch_lr]
+
+
+class PatchSampler():
+    """
+    Index of the valid patch origins of a domain, precomputed once from a mask
+    (e.g., a land-ocean mask for coastal domains, or the valid pixels of data
+    with missing values). A patch is valid when the fraction of valid pixels it
+    contains is at least ``min_valid_fraction``. The crop positions of the 
+    samples are then drawn only from this index (see ``crop_array`` and 
+    ``create_batch_hr_lr``), so that no compute goes to patches that are 
+    mostly ocean or filled missing values. The patch origins are the top-left
+    corners of the patches, i.e., the array indices [y, x] of their first row 
+    and column.
+    """
+    def __init__(self, mask, patch_size, min_valid_fraction=0.5):
+        """
+        Parameters
+        ----------
+        mask : 2D ndarray or xr.DataArray
+            Mask on the HR grid. Pixels with zero or NaN values are invalid.
+        patch_size : int
+            Size of the square patches, in pixels for the HR grid.
+        min_valid_fraction : float, optional
+            Minimum fraction of valid pixels in a patch, in [0, 1].
+        """
+        if isinstance(mask, xr.DataArray):
+            mask = mask.values
+        mask = np.squeeze(np.asarray(mask))
+        if mask.ndim != 2:
+            raise ValueError('`mask` must be a 2D array')
+        if not 0 <= min_valid_fraction <= 1:
+            raise ValueError('`min_valid_fraction` must be in [0, 1]')
+        if patch_size > min(mask.shape):
+            raise ValueError('`patch_size` larger than the mask')
+        self.shape = mask.shape
+        self.patch_size = patch_size
+        self.min_valid_fraction = min_valid_fraction
+        
+        # number of valid pixels of every patch, with a summed-area table
+        valid = np.nan_to_num(mask.astype('float64'), nan=0.0) != 0
+        table = np.pad(valid.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+        p = patch_size
+        counts = table[p:, p:] - table[:-p, p:] - table[p:, :-p] + table[:-p, :-p]
+        ys, xs = np.nonzero(counts >= min_valid_fraction * p * p)
+        if len(ys) == 0:
+            raise ValueError('No patch has enough valid pixels, decrease '
+                             '`min_valid_fraction` or `patch_size`')
+        self._origins = {1: (ys, xs)}
+
+    def __len__(self):
+        return len(self._origins[1][0])
+
+    def origins(self, grid_shape=None):
+        """ Valid patch origins (ys, xs of the top-left corners) on a grid of 
+        shape ``grid_shape``, the HR grid (default) or a LR grid coarser by an
+        integer factor. On a LR grid, only the HR origins falling on it are 
+        used.
+        """
+        factor = 1 if grid_shape is None else int(round(self.shape[0] / grid_shape[0]))
+        if factor not in self._origins:
+            ys, xs = self._origins[1]
+            keep = (ys % factor == 0) & (xs % factor == 0)
+            # the last HR rows/columns may not be covered by the LR grid
+            keep &= (ys // factor + self.patch_size // factor <= grid_shape[0])
+            keep &= (xs // factor + self.patch_size // factor <= grid_shape[1])
+            if not keep.any():
+                raise ValueError('No valid patch origin falls on the LR grid')
+            self._origins[factor] = (ys[keep] // factor, xs[keep] // factor)
+        return self._origins[factor]
+
+    def draw(self, rng=None, size=None, grid_shape=None):
+        """ Draw random crop positions among the valid patch origins.
+
+        Parameters
+        ----------
+        rng : np.random.Generator or None, optional
+            Random generator. If None, the global ``np.random`` state is used.
+        size : int or None, optional
+            Number of positions. If None, a single position is returned.
+        grid_shape : tuple or None, optional
+            Shape of the grid to crop (see ``origins``).
+        """
+        ys, xs = self.origins(grid_shape)
+        randint = np.random.randint if rng is None else rng.integers
+        k = randint(0, len(ys), size=size)
+        return ys[k], xs[k]
+
+
+class FrameCache():
+    """
+    Bounded LRU cache of preprocessed frames, e.g. grids coarsened or 
+    interpolated to the LR or HR sizes. Consecutive spatiotemporal samples 
+    share ``time_window - 1`` frames, and the same frames are processed again
+    in every epoch, so the preprocessing of a frame is reused as long as it is
+    in the cache. The cache is shared by the threads creating the batches (it
+    is emptied when it is pickled to another process).
+    """
+    def __init__(self, max_frames):
+        """
+        Parameters
+        ----------
+        max_frames : int
+            Maximum number of cached frames. The least recently used frames are
+            evicted first.
+        """
+        if max_frames < 1:
+            raise ValueError('`max_frames` must be positive')
+        self.max_frames = max_frames
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_frames'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_frames(self, key, indices, func):
+        """
+        Return the frames ``indices`` (stacked along the first dimension) 
+        processed by ``func``. 
+
+        Parameters
+        ----------
+        key : hashable
+            Identifier of the array and of the processing (e.g. the output 
+            size), combined with the frame index as the cache key.
+        indices : array-like of int
+            Frame indices. 
+        func : callable
+            Function computing the processed frames for an array of indices 
+            (the missing ones), returning them stacked along the first dimension.
+        """
+        indices = [int(i) for i in indices]
+        frames = [None] * len(indices)
+        with self._lock:
+            for j, i in enumerate(indices):
+                frame = self._frames.get((key, i))
+                if frame is not None:
+                    self._frames.move_to_end((key, i))
+                    frames[j] = frame
+        missing = sorted(set(i for i, frame in zip(indices, frames) if frame is None))
+        if missing:
+            processed = func(np.array(missing))
+            new = {i: frame.copy() for i, frame in zip(missing, processed)}
+            for j, i in enumerate(indices):
+                if frames[j] is None:
+                    frames[j] = new[i]
+            with self._lock:
+                for i, frame in new.items():
+                    self._frames[(key, i)] = frame
+                    self._frames.move_to_end((key, i))
+                while len(self._frames) > self.max_frames:
+                    self._frames.popitem(last=False)
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(indices) - len(missing)
+        return np.stack(frames)
+
+
+class StaticVarsCache():
+    """
+    HR and LR versions of the static variables (e.g., elevation or land-sea 
+    mask), computed once. These fields do not change from sample to sample, so
+    the batches only slice (or broadcast) the cached arrays.
+    """
+    def __init__(self, static_vars, upsampling, scale, interpolation='inter_area'):
+        """
+        Parameters
+        ----------
+        static_vars : list of 2D ndarrays
+            Static variables such as elevation data or a binary land-ocean mask.
+        upsampling : str
+            String with the name of the upsampling method. 
+        scale : int
+            Scaling factor.
+        interpolation : str, optional
+            Interpolation used when downsampling the static variables.
+        """
+        static_vars = [var.values if isinstance(var, xr.DataArray) else var 
+                       for var in static_vars]
+        self.n_vars = len(static_vars)
+        self.upsampling = upsampling
+        self.scale = scale
+        self.interpolation = interpolation
+        self.hr = np.concatenate([checkarray_ndim(np.squeeze(var), 3, -1) 
+                                  for var in static_vars], axis=-1).astype('float32')
+        if self.upsampling in POSTUPSAMPLING_METHODS:
+            lr_x = int(self.hr.shape[1] / self.scale)
+            lr_y = int(self.hr.shape[0] / self.scale)
+            self.lr = resize_array(self.hr, (lr_x, lr_y), interpolation, squeezed=False)
+            self.lr = self.lr.astype('float32', copy=False)
+        else:
+            self.lr = self.hr
+    
+    def __len__(self):
+        return self.n_vars
+
+    def _lr_is_aligned_(self, ys, xs):
+        """ Whether the HR crop positions fall on the LR grid.
+        """
+        return np.all(np.asarray(ys) % self.scale == 0) and np.all(np.asarray(xs) % self.scale == 0)
+
+    def crop(self, patch_size, yx):
+        """Crop the HR and LR static variables for a patch with its top-left
+        corner (first row and column of the array) at ``yx`` (HR grid).
+        """
+        hr = crop_array(self.hr, patch_size, yx=yx)
+        if self.upsampling not in POSTUPSAMPLING_METHODS:
+            return hr, hr
+        patch_size_lr = int(patch_size / self.scale)
+        y, x = yx
+        if self._lr_is_aligned_(y, x):
+            lr = crop_array(self.lr, patch_size_lr, yx=(y // self.scale, x // self.scale))
+        else:
+            lr = resize_array(hr, (patch_size_lr, patch_size_lr), self.interpolation, squeezed=False)
+        return hr, lr
+
+    def crop_batch(self, patch_size, ys, xs):
+        """Crop the HR and LR static variables for a batch of patches with 
+        top-left corners (first row and column) at ``ys, xs`` (HR grid).
+        """
+        hr = _gather_patches_(self.hr, None, ys, xs, patch_size)
+        if self.upsampling not in POSTUPSAMPLING_METHODS:
+            return hr, hr
+        patch_size_lr = int(patch_size / self.scale)
+        if self._lr_is_aligned_(ys, xs):
+            lr = _gather_patches_(self.lr, None, np.asarray(ys) // self.scale, 
+                                  np.asarray(xs) // self.scale, patch_size_lr)
+        else:
+            lr = resize_array(hr, (patch_size_lr, patch_size_lr), self.interpolation, squeezed=False)
+        return hr, lr
+
+    def broadcast(self, n):
+        """Return read-only views of the full-domain HR and LR static variables
+        broadcasted to ``n`` samples, without copies.
+        """
+        hr = np.broadcast_to(self.hr, (n,) + self.hr.shape)
+        lr = np.broadcast_to(self.lr, (n,) + self.lr.shape)
+        return hr, lr
+
+
+# halo (in LR pixels) needed by each interpolation kernel when upsampling
+_PIN_HALO_ = {
+    'nearest': 1, 
+    'bilinear': 1, 
+    'inter_area': 1, 
+    'bicubic': 2, 
+    'lanczos': 4}
+
+
+def _pin_window_size_(patch_size, scale, interpolation, from_hr=False):
+    """Size (in LR pixels) of the LR window interpolated for a HR patch in the
+    crop-first pre-upsampling path. When the window is coarsened from the HR 
+    grid (``from_hr``), the halo is doubled to account for the downsampling.
+    """
+    halo = _PIN_HALO_[interpolation] * (2 if from_hr else 1)
+    return -(-patch_size // scale) + 1 + 2 * halo, halo
+
+
+def _pin_crop_first_is_possible_(hr_shape, lr_shape, patch_size, scale, 
+                                 interpolation, from_hr=False):
+    """Whether the crop-first pre-upsampling path gives the same result as 
+    interpolating the full grids: the HR grid must be exactly ``scale`` times
+    the LR grid and the LR window must fit in the LR grid.
+    """
+    hr_y, hr_x = hr_shape
+    lr_y, lr_x = lr_shape
+    size, _ = _pin_window_size_(patch_size, scale, interpolation, from_hr)
+    return hr_y == lr_y * scale and hr_x == lr_x * scale and size <= min(lr_y, lr_x)
+
+
+def _pin_crop_first_(array, indices, ys, xs, patch_size, scale, interpolation, 
+                     from_hr=False):
+    """Interpolate to the HR grid only the LR windows (patch region plus a 
+    halo) needed for HR patches at positions ``ys, xs``, from the grids 
+    ``indices`` of ``array``. If ``from_hr`` is True, ``array`` is in HR and the
+    windows are first coarsened. The result matches (within float tolerance) 
+    the cropping of the fully interpolated grids. Returns an array with dims 
+    [n_patches, patch_size, patch_size, channels].
+    """
+    size, halo = _pin_window_size_(patch_size, scale, interpolation, from_hr)
+    ys = np.asarray(ys)
+    xs = np.asarray(xs)
+    if from_hr:
+        lr_y, lr_x = array.shape[1] // scale, array.shape[2] // scale
+    else:
+        lr_y, lr_x = array.shape[1], array.shape[2]
+    # windows are shifted inside the grid, at the borders the halo is not needed
+    win_ys = np.clip(ys // scale - halo, 0, lr_y - size)
+    win_xs = np.clip(xs // scale - halo, 0, lr_x - size)
+    if from_hr:
+        windows = _gather_patches_(array, indices, win_ys * scale, win_xs * scale, 
+                                   size * scale)
+        windows = resize_array(windows, (size, size), interpolation, squeezed=False)
+    else:
+        windows = _gather_patches_(array, indices, win_ys, win_xs, size)
+    windows = resize_array(windows, (size * scale, size * scale), interpolation, 
+                           squeezed=False)
+    return _gather_patches_(windows, np.arange(len(windows)), ys - win_ys * scale, 
+                            xs - win_xs * scale, patch_size)
+
+
+def _pin_crop_first_sample_(array, yx, patch_size, scale, interpolation, 
+                            from_hr=False):
+    """Crop-first pre-upsampling for a single sample, a 3D array [y, x, vars]
+    or a 4D array [time, y, x, vars] (all the time steps with the same crop).
+    """
+    stack = array if array.ndim == 4 else array[np.newaxis]
+    n = stack.shape[0]
+    patches = _pin_crop_first_(stack, np.arange(n), np.full(n, yx[0]), 
+                               np.full(n, yx[1]), patch_size, scale, 
+                               interpolation, from_hr)
+    return patches if array.ndim == 4 else patches[0]
+
+
+def _gather_patches_(array, indices, ys, xs, size):
+    """Gather square patches from a 4D array [time, y, x, channels] (or a 3D 
+    array [y, x, channels] when ``indices`` is None). Each patch ``i`` is taken
+    from the grid ``indices[i]`` at the position ``ys[i], xs[i]``, using a 
+    strided (sliding window) view of ``array``. Returns an array with dims 
+    [n_patches, size, size, channels].
+    """
+    if indices is None:
+        windows = sliding_window_view(array, (size, size), axis=(0, 1))
+        patches = windows[ys, xs]
+    else:
+        windows = sliding_window_view(array, (size, size), axis=(1, 2))
+        patches = windows[indices, ys, xs]
+    # [n_patches, channels, size, size] -> [n_patches, size, size, channels]
+    return np.moveaxis(patches, 1, -1)
+
+
+class LazyArray():
+    """
+    Read-only array that defers reading the data until it is needed. Slicing 
+    (integers and slices) returns a new ``LazyArray``, so that only the time 
+    slices and the spatial window of a sample are read from disk when the 
+    array is finally converted to a np.ndarray. 
+    """
+    def __init__(self, source):
+        """
+        Parameters
+        ----------
+        source : str, np.ndarray, np.memmap, zarr.Array, dask array, xr.DataArray or list
+            Data source. Strings are interpreted as paths to ``.npy`` files 
+            (opened as memory-maps), netCDF files (opened with dask chunks) or
+            zarr stores. A list of sources is concatenated (lazily) along the 
+            last dimension, e.g. a list of predictors.
+        """
+        if isinstance(source, (list, tuple)):
+            self.sources = [self._open_source_(src) for src in source]
+        else:
+            self.sources = [self._open_source_(source)]
+        
+        shape0 = self.sources[0].shape
+        for src in self.sources[1:]:
+            if src.shape[:-1] != shape0[:-1]:
+                raise ValueError('All the sources must have the same shape (except for the last dimension)')
+        n_last = sum(src.shape[-1] for src in self.sources)
+        self.index = tuple(range(n) for n in shape0[:-1] + (n_last,))
+        self.dtype = np.result_type(*[src.dtype for src in self.sources])
+
+    @staticmethod
+    def _open_source_(source):
+        """ Open a source given as a path. Other sources are returned as they are.
+        """
+        if isinstance(source, LazyArray):
+            if len(source.sources) > 1 or not all(isinstance(i, range) for i in source.index):
+                return np.asarray(source)
+            return source.sources[0]
+        if not isinstance(source, str):
+            return source
+        if source.endswith('.npy'):
+            return np.load(source, mmap_mode='r')
+        elif source.endswith('.nc'):
+            return xr.open_dataarray(source, chunks={})
+        else:
+            if not has_zarr:
+                raise ImportError('zarr must be installed for reading zarr stores')
+            return zarr.open(source, mode='r')
+
+    @property
+    def shape(self):
+        return tuple(len(i) for i in self.index if isinstance(i, range))
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            pos = key.index(Ellipsis)
+            n_fill = self.ndim - (len(key) - 1)
+            key = key[:pos] + (slice(None),) * n_fill + key[pos + 1:]
+        is_basic = all(isinstance(k, (int, np.integer)) or 
+                       (isinstance(k, slice) and (k.step is None or k.step > 0)) 
+                       for k in key)
+        if not is_basic or len(key) > self.ndim:
+            # advanced indexing, the data is read and then indexed
+            return np.asarray(self)[key]
+
+        new = LazyArray.__new__(LazyArray)
+        new.sources = self.sources
+        new.dtype = self.dtype
+        new_index = []
+        key = iter(key)
+        for i in self.index:
+            if isinstance(i, range):
+                k = next(key, slice(None))
+                i = i[int(k)] if not isinstance(k, slice) else i[k]
+            new_index.append(i)
+        new.index = tuple(new_index)
+        return new
+
+    def squeeze(self, axis=None):
+        """ Remove (lazily) the dimensions of lenght one.
+        """
+        visible = [j for j, i in enumerate(self.index) if isinstance(i, range)]
+        if axis is None:
+            axis = [j for j, d in enumerate(visible) if len(self.index[d]) == 1]
+        elif isinstance(axis, int):
+            axis = [axis]
+        new = LazyArray.__new__(LazyArray)
+        new.sources = self.sources
+        new.dtype = self.dtype
+        new_index = list(self.index)
+        for ax in axis:
+            dim = visible[ax]
+            if len(self.index[dim]) != 1:
+                raise ValueError('Cannot select an axis to squeeze out which has size not equal to one')
+            new_index[dim] = self.index[dim][0]
+        new.index = tuple(new_index)
+        return new
+
+    def __array__(self, dtype=None, copy=None):
+        key = tuple(i if not isinstance(i, range) else slice(i.start, i.stop, i.step) 
+                    for i in self.index)
+        if len(self.sources) == 1:
+            array = _read_source_(self.sources[0], key)
+        else:
+            # reading all the channels of each source, then selecting
+            subkey = key[:-1] + (slice(None),)
+            array = np.concatenate([_read_source_(src, subkey) for src in self.sources], axis=-1)
+            array = array[..., key[-1]]
+        if dtype is not None:
+            array = array.astype(dtype, copy=False)
+        return array
+    
+    def time_chunks(self):
+        """ Chunk size of the (first) source along the time dimension and offset
+        of the first time step of the array within its chunk, as a tuple. None
+        if the source is not chunked (e.g., np.ndarray or np.memmap).
+        """
+        chunks = getattr(self.sources[0], 'chunks', None)
+        first = self.index[0]
+        if not chunks or not isinstance(first, range) or first.step != 1:
+            return None
+        size = chunks[0]
+        if isinstance(size, tuple):
+            # dask chunks, e.g. ((24, 24, 12), (180,), (360,), (1,))
+            size = size[0]
+        return int(size), first.start % int(size)
+
+    def __repr__(self):
+        return f'LazyArray(shape={self.shape}, dtype={self.dtype})'
+
+
+def _read_source_(source, key):
+    """ Read a (basic) slice of an array-like source into a np.ndarray.
+    """
+    array = source[key]
+    if isinstance(array, xr.DataArray):
+        array = array.values
+    elif hasattr(array, 'compute'):
+        # dask array
+        array = array.compute()
+    return np.array(array)
+
+
+class EpochSampler():
+    """
+    Sampler of the sample indices and of the random generators of the batches.
+    The indices are reshuffled every epoch, and each batch gets its own random
+    generator (for the crop positions) derived from the seed, the epoch and the
+    batch index. A batch is therefore the same regardless of the order in which
+    the batches are created, or of the thread or process creating it.
+    """
+    def __init__(self, n, repeat=None, seed=None, shuffle=True):
+        """
+        Parameters
+        ----------
+        n : int
+            Number of samples.
+        repeat : int or None, optional
+            Factor to repeat the sample indices in each epoch.
+        seed : int or None, optional
+            Seed of the sampler. If None, it is drawn from the global 
+            ``np.random`` state (so ``np.random.seed`` is honored).
+        shuffle : bool, optional
+            If True, the order of the samples is shuffled every epoch.
+        """
+        self.n = n
+        self.repeat = repeat
+        if seed is None:
+            seed = np.random.randint(0, 2 ** 31 - 1)
+        self.seed = int(seed)
+        self.shuffle = shuffle
+        self.epoch = 0
+        self._indices = (None, None)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def get_indices(self, epoch=None):
+        """Sample indices of a given epoch (by default, the current one).
+        """
+        if epoch is None:
+            epoch = self.epoch
+        cached_epoch, indices = self._indices
+        if cached_epoch == epoch:
+            return indices
+        if self.shuffle:
+            rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(epoch,)))
+            indices = self._shuffle_(rng)
+        else:
+            indices = np.arange(self.n)
+        if self.repeat is not None and isinstance(self.repeat, int):
+            indices = np.hstack([indices for i in range(self.repeat)])
+        self._indices = (epoch, indices)
+        return indices
+
+    def get_rng(self, index, epoch=None):
+        """Random generator of the batch ``index`` of a given epoch (by default,
+        the current one).
+        """
+        if epoch is None:
+            epoch = self.epoch
+        seed_seq = np.random.SeedSequence(self.seed, spawn_key=(epoch, index))
+        return np.random.default_rng(seed_seq)
+
+    def _shuffle_(self, rng):
+        return rng.permutation(self.n)
+
+
+class BlockShuffleSampler(EpochSampler):
+    """
+    Sampler shuffling blocks of consecutive samples (e.g., the storage chunks 
+    of a zarr store or netCDF file read lazily) instead of single samples. 
+    Every epoch, the order of the blocks is shuffled and then the samples of 
+    each group of ``buffer_blocks`` consecutive blocks (in the shuffled order) 
+    are shuffled together, as in a bounded shuffle buffer. The batches are 
+    then read from a few chunks instead of being scattered across the store.
+    ``buffer_blocks`` trades locality (1, only the samples within a block are 
+    shuffled) for randomness (as many as blocks, a full random permutation).
+    """
+    def __init__(self, n, block_size, buffer_blocks=1, offset=0, repeat=None, 
+                 seed=None, shuffle=True):
+        """
+        Parameters
+        ----------
+        n : int
+            Number of samples.
+        block_size : int
+            Number of consecutive samples in each block, e.g. the chunk size 
+            along the time dimension.
+        buffer_blocks : int, optional
+            Number of blocks whose samples are shuffled together. 
+        offset : int, optional
+            Offset of the first sample within its block, so that the blocks 
+            are aligned with the storage chunks.
+        repeat : int or None, optional
+            Factor to repeat the sample indices in each epoch.
+        seed : int or None, optional
+            Seed of the sampler. If None, it is drawn from the global 
+            ``np.random`` state (so ``np.random.seed`` is honored).
+        shuffle : bool, optional
+            If True, the order of the samples is shuffled every epoch.
+        """
+        if block_size < 1 or buffer_blocks < 1:
+            raise ValueError('`block_size` and `buffer_blocks` must be positive')
+        super().__init__(n, repeat=repeat, seed=seed, shuffle=shuffle)
+        self.block_size = int(block_size)
+        self.buffer_blocks = int(buffer_blocks)
+        self.offset = int(offset) % self.block_size
+
+    def _shuffle_(self, rng):
+        bounds = np.arange(-self.offset, self.n, self.block_size)[1:]
+        blocks = np.split(np.arange(self.n), bounds)
+        order = rng.permutation(len(blocks))
+        indices = []
+        for start in range(0, len(blocks), self.buffer_blocks):
+            group = np.concatenate([blocks[j] for j in order[start: start + self.buffer_blocks]])
+            indices.append(rng.permutation(group))
+        return np.concatenate(indices)
+
+
+def get_worker_info():
+    """
+    Rank of the current worker and number of workers of a distributed training.
+    These are taken from Horovod (when initialized), or from the ``TF_CONFIG``
+    environment variable used by the multi-worker ``tf.distribute`` 
+    strategies (the chief, if any, is the rank 0). Otherwise (0, 1) is 
+    returned.
+
+    Returns
+    -------
+    rank, n_workers : int
+    """
+    if has_horovod and hvd.is_initialized():
+        return hvd.rank(), hvd.size()
+    resolver = tf.distribute.cluster_resolver.TFConfigClusterResolver()
+    cluster = resolver.cluster_spec().as_dict()
+    n_chief = len(cluster.get('chief', []))
+    n_workers = n_chief + len(cluster.get('worker', []))
+    if n_workers > 1 and resolver.task_type in ['chief', 'worker']:
+        rank = resolver.task_id + (n_chief if resolver.task_type == 'worker' else 0)
+        return rank, n_workers
+    return 0, 1
+
+
+def get_shard_range(n_samples, rank, n_workers, time_window=None):
+    """
+    Time range (slice along the first dimension of the data) of the shard of a
+    worker. The samples are split into ``n_workers`` contiguous and disjoint 
+    shards of equal size (the remainder is dropped), so that all the workers 
+    run the same number of steps per epoch. With spatiotemporal samples, the 
+    range includes the last ``time_window`` time steps needed by the last 
+    sample of the shard.
+
+    Parameters
+    ----------
+    n_samples : int
+        Number of samples.
+    rank : int
+        Rank of the worker.
+    n_workers : int
+        Number of workers.
+    time_window : int or None, optional
+        Time window of the samples.
+
+    Returns
+    -------
+    time_range : slice
+    """
+    if not 0 <= rank < n_workers:
+        raise ValueError('`rank` must be in [0, n_workers)')
+    shard_size = n_samples // n_workers
+    if shard_size == 0:
+        raise ValueError('There are less samples than workers')
+    start = rank * shard_size
+    stop = start + shard_size + (time_window if time_window is not None else 0)
+    return slice(start, stop)
+
+
+def _rank_seed_(seed, rank):
+    """ Seed of a worker (different crop positions and orders on each shard).
+    """
+    if seed is None:
+        return None
+    return int(np.random.SeedSequence(seed, spawn_key=(rank,)).generate_state(1)[0])
+
+
 class DataGenerator(tf.keras.utils.Sequence):
     """
     DataGenerator creates batches of paired training samples according to the
@@ -386,7 +1573,21 @@ class DataGenerator(tf.keras.utils.Sequence):
         static_vars=None, 
         predictors=None,
         interpolation='inter_area',
-        repeat=None
+        repeat=None,
+        lazy_loading=False,
+        lr_cache=False,
+        lr_cache_dtype='float32',
+        lr_cache_path=None,
+        lr_cache_max_memory=None,
+        seed=None,
+        frame_cache_size=None,
+        storage_dtype=None,
+        time_metadata=None,
+        shuffle_blocks=None,
+        shuffle_block_size=None,
+        shard=None,
+        patch_mask=None,
+        patch_min_valid=0.5
         ):
         """
         Parameters
@@ -418,24 +1619,107 @@ class DataGenerator(tf.keras.utils.Sequence):
         repeat : int or None, optional
             Factor to repeat the samples in ``array``. Useful when ``patch_size``
             is not None.
-
-        TO-DO
-        -----
-        * instead of the in-memory array, we could input the path and load the 
-        netcdf files lazily or memmap a numpy array
+        lazy_loading : bool, optional
+            If True, ``array``, ``array_lr`` and ``predictors`` are wrapped as
+            ``dl4ds.LazyArray`` objects and only the time slices (and spatial 
+            window) needed for each batch are read. Useful for ``.npy`` memmaps,
+            zarr stores or dask-backed xr.DataArrays larger than memory.
+        lr_cache : bool, optional
+            If True and ``array_lr`` is None, the whole ``array`` is coarsened 
+            once at setup (see ``dl4ds.create_lr_cache``) and the LR patches are
+            cropped from the cached LR array. With post-upsampling, the HR crops
+            are then aligned to the LR grid (multiples of ``scale``).
+        lr_cache_dtype : str, optional
+            Data type of the LR cache, e.g. 'float32' or 'float16'.
+        lr_cache_path : str or None, optional
+            If not None, the LR cache is stored on disk (``.npy`` memory-map).
+        lr_cache_max_memory : float or None, optional
+            Maximum size of the in-memory LR cache in GB. When exceeded, the 
+            LR arrays are coarsened on the fly.
+        seed : int or None, optional
+            Seed of the ``dl4ds.EpochSampler`` used for shuffling the samples 
+            (every epoch) and for drawing the crop positions of each batch.
+        frame_cache_size : int or None, optional
+            If not None, maximum number of preprocessed frames (grids coarsened
+            or interpolated as a whole) kept in a ``dl4ds.FrameCache`` and 
+            reused by the following samples and epochs. Useful for 
+            spatiotemporal samples, which share ``time_window - 1`` frames.
+        storage_dtype : str or None, optional
+            Data type in which ``array``, ``array_lr`` and ``predictors`` are 
+            kept in memory, one of 'float32', 'float16' or 'bfloat16'. The
+            arrays are cast once at setup and the samples are upcast to float32
+            only when the batches are emitted. Half precision halves the 
+            resident memory of large HR archives. If None, the arrays are kept
+            with their own dtype. Lazily loaded arrays are read with the dtype
+            they have on disk.
+        time_metadata : xr.DataArray, array-like of np.datetime64 or None
+            Time coordinate of ``array`` (e.g., ``array.time``). If not None, 
+            it is encoded once as a season table (see 
+            ``dl4ds.create_season_table``) and the season of each sample is 
+            added as one-hot channels to the auxiliary array (and to the LR 
+            array for spatial samples).
+        shuffle_blocks : int or None, optional
+            If not None, the samples are shuffled in blocks of consecutive time
+            steps with a ``dl4ds.BlockShuffleSampler``, mixing the samples of
+            ``shuffle_blocks`` blocks at a time. Small values keep the reads
+            of lazily loaded arrays mostly sequential, large values approach a
+            full random permutation. If None, all the samples are shuffled.
+        shuffle_block_size : int or None, optional
+            Number of time steps per block. If None, the chunk size along time
+            of the lazily loaded ``array`` (zarr, dask-backed or sharded) is 
+            used, or ``batch_size`` when the array is not chunked.
+        shard : None, 'auto' or tuple of int, optional
+            If not None, the generator only uses the shard of a worker of a 
+            distributed training, given as (rank, n_workers) or 'auto' for 
+            taking them from Horovod or ``TF_CONFIG`` (see 
+            ``dl4ds.get_worker_info``). The shards are contiguous, disjoint 
+            time ranges (see ``dl4ds.get_shard_range``), and only the time 
+            range of the shard is read (and loaded in memory, unless 
+            ``lazy_loading`` is True). The samples of the shard are reshuffled
+            every epoch, with a different seed on each worker.
+        patch_mask : None, int or 2D ndarray, optional
+            If not None (and ``patch_size`` is given), the patches are only 
+            cropped where the fraction of valid pixels of the mask is at least
+            ``patch_min_valid`` (see ``dl4ds.PatchSampler``). The mask is a 2D
+            array on the HR grid (zero or NaN pixels are invalid), or the 
+            index of the static variable to be used as mask (e.g., a binary 
+            land-ocean mask).
+        patch_min_valid : float, optional
+            Minimum fraction of valid pixels in a patch, in [0, 1].
         """        
-        if isinstance(array, xr.DataArray):
-            # self.time_metadata = array.time.copy()  # grabbing time metadata
-            self.time_metadata = None
-            self.array = array.values
-        elif isinstance(array, np.ndarray):
-            self.array = array
-            self.time_metadata = None
-
-        if isinstance(array_lr, xr.DataArray):
-            self.array_lr = array_lr.values
+        if shard is not None:
+            rank, n_workers = get_worker_info() if shard == 'auto' else shard
+            n_samples = array.shape[0] - (time_window if time_window is not None else 0)
+            time_range = get_shard_range(n_samples, rank, n_workers, time_window)
+            array = array[time_range]
+            if array_lr is not None:
+                array_lr = array_lr[time_range]
+            if predictors is not None:
+                predictors = [pred[time_range] for pred in predictors]
+            if time_metadata is not None:
+                # time coordinate or season table (one code per sample)
+                time_metadata = time_metadata[time_range]
+            seed = _rank_seed_(seed, rank)
+            self.shard = (rank, n_workers)
         else:
+            self.shard = None
+
+        self.lazy_loading = lazy_loading
+        if self.lazy_loading:
+            self.array = array if isinstance(array, LazyArray) else LazyArray(array)
+            if array_lr is not None and not isinstance(array_lr, LazyArray):
+                array_lr = LazyArray(array_lr)
             self.array_lr = array_lr
+        else:
+            if isinstance(array, xr.DataArray):
+                self.array = array.values
+            elif isinstance(array, (np.ndarray, LazyArray)):
+                self.array = np.asarray(array) if isinstance(array, LazyArray) else array
+
+            if isinstance(array_lr, (xr.DataArray, LazyArray)):
+                self.array_lr = np.asarray(array_lr)
+            else:
+                self.array_lr = array_lr
         
         self.batch_size = batch_size
         self.scale = scale
@@ -444,26 +1728,72 @@ class DataGenerator(tf.keras.utils.Sequence):
         self.patch_size = patch_size
         self.time_window = time_window
         self.static_vars = static_vars
-        if self.static_vars is not None:
-            for i in range(len(self.static_vars)):
-                if isinstance(self.static_vars[i], xr.DataArray):
-                    self.static_vars[i] = self.static_vars[i].values
+        if self.static_vars is not None and not isinstance(self.static_vars, StaticVarsCache):
+            # HR and LR static variables are computed once
+            self.static_vars = StaticVarsCache(self.static_vars, upsampling, scale, interpolation)
         self.predictors = predictors
         # concatenating list of ndarray variables along the last dimension  
         if self.predictors is not None:
-            self.predictors = np.concatenate(self.predictors, axis=-1)
+            if self.lazy_loading:
+                self.predictors = LazyArray(self.predictors)
+            else:
+                self.predictors = np.concatenate(self.predictors, axis=-1)
+        self.storage_dtype = checkarg_storage_dtype(storage_dtype)
+        if self.storage_dtype is not None and not self.lazy_loading:
+            # cast once, the batches are upcast to float32 when emitted
+            self.array = self.array.astype(self.storage_dtype, copy=False)
+            if self.array_lr is not None:
+                self.array_lr = self.array_lr.astype(self.storage_dtype, copy=False)
+            if self.predictors is not None:
+                self.predictors = self.predictors.astype(self.storage_dtype, copy=False)
         self.interpolation = interpolation
         self.repeat = repeat
+        self.lr_cache = lr_cache
+        if self.lr_cache and self.array_lr is None:
+            self.array_lr = create_lr_cache(
+                self.array, 
+                self.scale, 
+                self.interpolation, 
+                dtype=lr_cache_dtype, 
+                max_memory=lr_cache_max_memory, 
+                save_path=lr_cache_path)
         
-        # shuffling the order of the available indices (n samples)
+        # the order of the available indices (n samples) is shuffled every epoch
         if self.time_window is not None:
             self.n = self.array.shape[0] - self.time_window
         else:
             self.n = self.array.shape[0]
-        self.indices = np.random.permutation(np.arange(self.n))
-        
-        if self.repeat is not None and isinstance(self.repeat, int):
-            self.indices = np.hstack([self.indices for i in range(self.repeat)])
+        if shuffle_blocks is not None:
+            offset = 0
+            if shuffle_block_size is None:
+                chunks = self.array.time_chunks() if isinstance(self.array, LazyArray) else None
+                if chunks is not None:
+                    shuffle_block_size, offset = chunks
+                else:
+                    shuffle_block_size = self.batch_size
+            self.sampler = BlockShuffleSampler(
+                self.n, shuffle_block_size, shuffle_blocks, offset=offset, 
+                repeat=self.repeat, seed=seed)
+        else:
+            self.sampler = EpochSampler(self.n, self.repeat, seed)
+        if time_metadata is not None and not _is_season_table_(time_metadata):
+            self.time_metadata = create_season_table(time_metadata, self.time_window)
+        else:
+            self.time_metadata = time_metadata
+        if frame_cache_size is not None:
+            self.frame_cache = FrameCache(frame_cache_size)
+        else:
+            self.frame_cache = None
+        if patch_mask is not None and patch_size is not None:
+            if isinstance(patch_mask, (int, np.integer)):
+                if self.static_vars is None:
+                    raise ValueError('`static_vars` must be given when `patch_mask` is an index')
+                patch_mask = self.static_vars.hr[..., patch_mask]
+            self.patch_sampler = PatchSampler(patch_mask, patch_size, patch_min_valid)
+            if self.patch_sampler.shape != tuple(self.array.shape[-3:-1]):
+                raise ValueError('`patch_mask` must have the shape of the HR grid')
+        else:
+            self.patch_sampler = None
 
         if patch_size is not None:
             if self.upsampling in POSTUPSAMPLING_METHODS: 
@@ -482,13 +1812,26 @@ class DataGenerator(tf.keras.utils.Sequence):
         else:
             return n_batches
 
+    @property
+    def indices(self):
+        return self.sampler.get_indices()
+
     def __getitem__(self, index):
         """
         Generate one batch of data as (X, y) value pairs where X represents the 
         input and y represents the output.
         """
+        return self.get_batch(index)
+
+    def get_batch(self, index, epoch=None):
+        """
+        Generate the batch ``index`` of a given ``epoch`` (by default, the 
+        current one). The result only depends on the seed, epoch and index.
+        """
+        if epoch is None:
+            epoch = self.sampler.epoch
         res = create_batch_hr_lr(
-            self.indices,
+            self.sampler.get_indices(epoch),
             index,
             self.array, 
             self.array_lr,
@@ -500,43 +1843,853 @@ class DataGenerator(tf.keras.utils.Sequence):
             static_vars=self.static_vars, 
             predictors=self.predictors,
             interpolation=self.interpolation,
-            time_metadata=self.time_metadata)
+            time_metadata=self.time_metadata,
+            rng=self.sampler.get_rng(index, epoch),
+            frame_cache=self.frame_cache,
+            patch_sampler=self.patch_sampler)
 
         return res
 
+    def on_epoch_end(self):
+        """
+        Move to the next epoch, reshuffling the samples.
+        """
+        self.sampler.on_epoch_end()
+
+
+def create_tf_dataset(
+    datagen,
+    num_parallel_calls=None,
+    prefetch_depth=None,
+    deterministic=False,
+    repeat=False):
+    """
+    Create a ``tf.data.Dataset`` input pipeline from a ``DataGenerator``. The
+    batches are built in parallel (``tf.data`` map with several threads) and
+    prefetched, while keeping the ``[lr, aux_hr], [hr]`` structure of the
+    ``DataGenerator`` batches.
+
+    Parameters
+    ----------
+    datagen : dl4ds.DataGenerator
+        Data generator (``tf.keras.utils.Sequence``) used for creating the
+        batches.
+    num_parallel_calls : int or None, optional
+        Number of batches created in parallel. If None, the value is tuned
+        dynamically (``tf.data.AUTOTUNE``).
+    prefetch_depth : int or None, optional
+        Number of batches prefetched. If None, the value is tuned dynamically
+        (``tf.data.AUTOTUNE``).
+    deterministic : bool, optional
+        If True, the batches are produced in the order of the generator indices.
+        Otherwise, batches are yielded as soon as they are ready (the content
+        of each batch is the same, see ``dl4ds.EpochSampler``).
+    repeat : bool, optional
+        If True, the dataset is repeated indefinitely. Needed when the number of
+        steps per epoch is given explicitly.
+
+    Returns
+    -------
+    dataset : tf.data.Dataset
+        Dataset yielding tuples of (inputs, targets).
+    """
+    if num_parallel_calls is None:
+        num_parallel_calls = tf.data.AUTOTUNE
+    if prefetch_depth is None:
+        prefetch_depth = tf.data.AUTOTUNE
+
+    # probing the generator to get the structure of the batches
+    x_probe, y_probe = datagen[0]
+    n_inputs = len(x_probe)
+    probes = list(x_probe) + list(y_probe)
+
+    def epoch_indices():
+        # each iteration over the dataset is a new epoch
+        epoch = datagen.sampler.epoch
+        datagen.on_epoch_end()
+        for index in range(len(datagen)):
+            yield epoch, index
+
+    def get_batch(epoch, index):
+        x, y = datagen.get_batch(int(index), int(epoch))
+        return [np.asarray(a, 'float32') for a in list(x) + list(y)]
+
+    def map_batch(epoch, index):
+        arrays = tf.numpy_function(get_batch, [epoch, index],
+                                   Tout=[tf.float32] * len(probes))
+        for arr, probe in zip(arrays, probes):
+            arr.set_shape((None,) + probe.shape[1:])
+        return tuple(arrays[:n_inputs]), tuple(arrays[n_inputs:])
+
+    dataset = tf.data.Dataset.from_generator(
+        epoch_indices, 
+        output_signature=(tf.TensorSpec((), tf.int64), tf.TensorSpec((), tf.int64)))
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.map(map_batch, num_parallel_calls=num_parallel_calls,
+                          deterministic=deterministic)
+    dataset = dataset.prefetch(prefetch_depth)
+    return dataset
+
+
+def create_fixed_dataset(datagen, repeat=False, cache_path=None):
+    """
+    Materialize once the samples of a ``DataGenerator`` (e.g., the validation 
+    or test one) as a ``tf.data.Dataset`` reused every epoch. The samples are 
+    taken in order, over the full domain. When the generator extracts patches,
+    the full-domain samples are split into a deterministic tiling of 
+    non-overlapping patches of ``patch_size`` (the incomplete patches at the 
+    edges are dropped). No cropping, coarsening or random positioning is 
+    repeated across epochs, so the evaluation loss is computed on the same 
+    samples.
+
+    The samples are created one batch at a time and stored with the 
+    ``storage_dtype`` of the generator (float32 if None), in memory or in 
+    ``.npy`` memory-maps in ``cache_path``. The batches are cast to float32 
+    when they are read.
+
+    Parameters
+    ----------
+    datagen : dl4ds.DataGenerator
+        Data generator. It is not modified.
+    repeat : bool, optional
+        If True, the dataset is repeated indefinitely. Needed when the number of
+        steps is given explicitly.
+    cache_path : str or None, optional
+        If not None, path prefix of the ``.npy`` memory-maps storing the 
+        samples (e.g., ``/scratch/val``), for sets too large for the memory.
+
+    Returns
+    -------
+    dataset : tf.data.Dataset
+        Dataset yielding batches of ``datagen.batch_size`` samples as tuples 
+        of (inputs, targets).
+    """
+    # full-domain samples, in order
+    full = copy.copy(datagen)
+    full.patch_size = None
+    full.sampler = EpochSampler(datagen.n, seed=0, shuffle=False)
+    n_batches = int(np.ceil(datagen.n / datagen.batch_size))
+    dtype = _numpy_dtype_(datagen.storage_dtype or 'float32')
+
+    # tile origins computed once on the HR grid, and mapped to the LR grid for
+    # the LR input of post-upsampling models, so that the tiles are paired
+    if datagen.patch_size is not None:
+        patch_size = datagen.patch_size
+        hr_y, hr_x = datagen.array.shape[-3:-1]
+        origins = [(y, x) for y in range(0, hr_y - patch_size + 1, patch_size) 
+                   for x in range(0, hr_x - patch_size + 1, patch_size)]
+        if not origins:
+            raise ValueError('The patch size is larger than the grids')
+        if datagen.upsampling in POSTUPSAMPLING_METHODS:
+            lr_patch_size = patch_size // datagen.scale
+            lr_origins = [(y // datagen.scale, x // datagen.scale) for y, x in origins]
+        else:
+            lr_patch_size, lr_origins = patch_size, origins
+
+        def tile(batch):
+            (x, y) = batch
+            x = [_tile_array_(x[0], lr_patch_size, lr_origins)] + \
+                [_tile_array_(a, patch_size, origins) for a in x[1:]]
+            y = [_tile_array_(a, patch_size, origins) for a in y]
+            return x, y
+        n_per_sample = len(origins)
+    else:
+        tile = lambda batch: batch
+        n_per_sample = 1
+
+    # samples written batch by batch into preallocated arrays
+    n_samples = datagen.n * n_per_sample
+    arrays = None
+    pos = 0
+    for index in range(n_batches):
+        x, y = tile(full.get_batch(index, epoch=0))
+        batch = list(x) + list(y)
+        if arrays is None:
+            n_inputs = len(x)
+            arrays = [_allocate_(cache_path, i, (n_samples,) + a.shape[1:], dtype) 
+                      for i, a in enumerate(batch)]
+        k = len(batch[0])
+        for out, a in zip(arrays, batch):
+            out[pos:pos + k] = np.asarray(a).astype(dtype, copy=False)
+        pos += k
+    if cache_path is not None:
+        for out in arrays:
+            out.flush()
+
+    def read(start):
+        stop = min(start + datagen.batch_size, n_samples)
+        return tuple(np.asarray(out[start:stop], 'float32') for out in arrays)
+
+    def read_batch(start):
+        batch = tf.numpy_function(read, [start], [tf.float32] * len(arrays))
+        for t, out in zip(batch, arrays):
+            t.set_shape((None,) + out.shape[1:])
+        return tuple(batch[:n_inputs]), tuple(batch[n_inputs:])
+
+    dataset = tf.data.Dataset.range(0, n_samples, datagen.batch_size)
+    dataset = dataset.map(read_batch, num_parallel_calls=tf.data.AUTOTUNE, 
+                          deterministic=True)
+    if repeat:
+        dataset = dataset.repeat()
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def _allocate_(cache_path, i, shape, dtype):
+    """ Array for the samples of a fixed dataset, in memory or as a ``.npy`` 
+    memory-map (bfloat16 stored as raw 16-bit words, as in the shards).
+    """
+    if cache_path is None:
+        return np.empty(shape, dtype=dtype)
+    is_bfloat16 = np.dtype(dtype).name == 'bfloat16'
+    array = np.lib.format.open_memmap(f'{cache_path}_{i}.npy', mode='w+', 
+                                      dtype='uint16' if is_bfloat16 else dtype, 
+                                      shape=shape)
+    return array.view(dtype) if is_bfloat16 else array
+
+
+def _tile_array_(array, tile_size, origins):
+    """ Split the grids of an array [n, (time,) lat, lon, vars] into the 
+    square tiles with top-left corners at ``origins`` (list of y, x), returned
+    as more samples [n * n_tiles, (time,) tile_size, tile_size, vars] (tiles 
+    of each sample in the order of ``origins``).
+    """
+    tiles = [array[..., y:y + tile_size, x:x + tile_size, :] for y, x in origins]
+    if any(t.shape[-3:-1] != (tile_size, tile_size) for t in tiles):
+        raise ValueError('The tiles must fall within the grids')
+    tiles = np.stack(tiles, axis=1)
+    return tiles.reshape((-1,) + tiles.shape[2:])
+
+
+def echo_dataset(dataset, echo_factor, augment=False, seed=None):
+    """
+    Data echoing: each batch of ``dataset`` is reused for ``echo_factor`` 
+    consecutive training steps, which is useful when creating the batches is 
+    slower than the training step. Optionally, the echoes after the first one
+    are re-augmented in-graph with a random flip and/or transpose of the 
+    grids, the same for all the inputs and targets of the batch (see 
+    ``augment_batch``).
+
+    Parameters
+    ----------
+    dataset : tf.data.Dataset
+        Dataset yielding tuples of (inputs, targets).
+    echo_factor : int
+        Number of times each batch is used.
+    augment : bool, optional
+        If True, the echoes are re-augmented. Off by default, since geolocated
+        fields are generally not invariant to flips and transposes of the grid
+        (e.g., wind components, anisotropic fields or the static variables). 
+        It must not be used with models with a locally connected layer, whose
+        weights are tied to the grid positions.
+    seed : int or None, optional
+        Seed of the augmentations.
+
+    Returns
+    -------
+    dataset : tf.data.Dataset
+    """
+    if echo_factor < 1:
+        raise ValueError('`echo_factor` must be positive')
+    if echo_factor == 1:
+        return dataset
+
+    def echo(x, y):
+        echoes = tf.data.Dataset.from_tensors((x, y)).repeat(echo_factor)
+        if not augment:
+            return echoes
+        # the first echo is the original batch
+        return echoes.enumerate().map(
+            lambda i, batch: tf.cond(i > 0, lambda: augment_batch(*batch, seed=seed), 
+                                     lambda: batch))
+
+    return dataset.flat_map(echo)
+
+
+def augment_batch(x, y, seed=None):
+    """
+    Randomly flip (up-down and/or left-right) and, for square grids, transpose
+    the grids of a batch. The same transformation is applied to all the inputs
+    and targets, given as tuples of arrays/tensors whose last three dimensions
+    are [lat, lon, vars]. It runs in-graph (e.g., in a ``tf.data`` map). Only
+    meaningful for fields (and static variables) invariant to these 
+    transformations, and not for models with a locally connected layer.
+
+    Returns
+    -------
+    x, y : tuples of tf.Tensor
+    """
+    tensors = [tf.convert_to_tensor(t) for t in list(x) + list(y)]
+    draws = tf.random.uniform([3], 0, 2, dtype=tf.int32, seed=seed)
+    is_square = all(t.shape[-3] is not None and t.shape[-3] == t.shape[-2] 
+                    for t in tensors)
+
+    def transform(t):
+        rank = t.shape.rank
+        ax_y, ax_x = rank - 3, rank - 2
+        t = tf.cond(draws[0] > 0, lambda: tf.reverse(t, [ax_y]), lambda: t)
+        t = tf.cond(draws[1] > 0, lambda: tf.reverse(t, [ax_x]), lambda: t)
+        if is_square:
+            perm = list(range(rank))
+            perm[ax_y], perm[ax_x] = ax_x, ax_y
+            t = tf.cond(draws[2] > 0, lambda: tf.transpose(t, perm), lambda: t)
+        return t
+
+    tensors = [transform(t) for t in tensors]
+    return tuple(tensors[:len(x)]), tuple(tensors[len(x):])
+
+
+def estimate_echo_factor(batch_time, step_time, max_factor=8):
+    """
+    Echo factor for which the training steps keep up with the creation of the
+    batches: the ratio of the time for creating a batch to the time of a 
+    training step, rounded up and clipped to [1, max_factor].
+    """
+    if step_time <= 0:
+        return max_factor
+    return int(np.clip(np.ceil(batch_time / step_time), 1, max_factor))
+
+
+def measure_batch_time(loader, n_batches=3, n_parallel=1):
+    """
+    Measure the time of creating a batch with ``loader`` (a ``DataGenerator`` 
+    or a ``PatchBank``), in seconds. The first batch is not timed (warm-up). 
+    The time is divided by ``n_parallel``, the number of batches created in 
+    parallel by the input pipeline.
+    """
+    n_batches = min(n_batches, len(loader) - 1)
+    loader.get_batch(0, 0)
+    if n_batches < 1:
+        return 0.0
+    start = time.perf_counter()
+    for index in range(1, n_batches + 1):
+        loader.get_batch(index, 0)
+    return (time.perf_counter() - start) / n_batches / max(n_parallel, 1)
+
+
+class PatchBank():
+    """
+    Bank of pre-built training samples (HR, LR and auxiliary patches) kept in 
+    preallocated float32 arrays. The batches are drawn at random from the bank
+    at memory speed, while a background thread replaces a fraction of the 
+    bank after every epoch with new samples created by a ``DataGenerator``. 
+    The training step rate is then decoupled from the rate at which the 
+    samples are cropped and coarsened, and ``refresh_fraction`` controls the
+    diversity of the samples seen during training.
+
+    Iterating over the bank yields the batches of one epoch (as many as in 
+    the generator) as ``[inputs], [targets]`` lists of float32 arrays.
+    """
+    def __init__(self, datagen, bank_size, refresh_fraction=0.25, seed=None):
+        """
+        Parameters
+        ----------
+        datagen : dl4ds.DataGenerator
+            Data generator used for creating the samples. Its batches are 
+            consumed in order, epoch after epoch, to fill and refresh the bank.
+        bank_size : int
+            Number of samples in the bank. It must be at least the batch size 
+            of ``datagen``.
+        refresh_fraction : float, optional
+            Fraction of the bank replaced after every epoch, in [0, 1].
+        seed : int or None, optional
+            Seed for drawing the samples of the batches and the slots replaced
+            in each refresh. If None, it is drawn from the global ``np.random``
+            state.
+        """
+        if bank_size < datagen.batch_size:
+            raise ValueError('`bank_size` must be at least the batch size')
+        if not 0 <= refresh_fraction <= 1:
+            raise ValueError('`refresh_fraction` must be in [0, 1]')
+        self.datagen = datagen
+        self.batch_size = datagen.batch_size
+        self.bank_size = int(bank_size)
+        self.refresh_fraction = refresh_fraction
+        if seed is None:
+            seed = np.random.randint(0, 2 ** 31 - 1)
+        self.seed = int(seed)
+        self.epoch = 0
+        self.n_refreshed = 0
+
+        # probing the generator to get the structure of the samples
+        x_probe, y_probe = datagen[0]
+        self.n_inputs = len(x_probe)
+        self.sample_shapes = [np.shape(a)[1:] for a in list(x_probe) + list(y_probe)]
+        self._bank = [np.empty((self.bank_size,) + shape, 'float32') 
+                      for shape in self.sample_shapes]
+        self._lock = threading.Lock()
+        # position in the stream of generator batches (epoch, index)
+        self._next_batch = 0
+        self._fill_(np.arange(self.bank_size))
+
+        # background thread refreshing the bank
+        self._requests = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._refresh_loop_, daemon=True)
+        self._thread.start()
+
+    def _fill_(self, slots):
+        """ Write new samples, created with the generator, in the ``slots``.
+        """
+        n_batches = len(self.datagen)
+        for start in range(0, len(slots), self.batch_size):
+            epoch, index = divmod(self._next_batch, n_batches)
+            self._next_batch += 1
+            x, y = self.datagen.get_batch(index, epoch)
+            chunk = slots[start: start + self.batch_size]
+            arrays = [np.asarray(a, 'float32')[:len(chunk)] for a in list(x) + list(y)]
+            with self._lock:
+                for bank, array in zip(self._bank, arrays):
+                    bank[chunk] = array
+        self.n_refreshed += len(slots)
+
+    def _refresh_loop_(self):
+        while True:
+            epoch = self._requests.get()
+            try:
+                if epoch is None:
+                    return
+                rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(epoch, 0)))
+                n = int(round(self.refresh_fraction * self.bank_size))
+                self._fill_(rng.choice(self.bank_size, n, replace=False))
+            except Exception:
+                self._error = traceback.format_exc()
+            finally:
+                self._requests.task_done()
+
+    def __len__(self):
+        return len(self.datagen)
+
+    def get_batch(self, index, epoch=None):
+        """ Draw the batch ``index`` of a given ``epoch`` (by default, the 
+        current one) from the bank.
+        """
+        if self._error is not None:
+            raise RuntimeError(f'Error refreshing the PatchBank:\n{self._error}')
+        if epoch is None:
+            epoch = self.epoch
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(epoch, index + 1)))
+        slots = np.sort(rng.choice(self.bank_size, self.batch_size, replace=False))
+        with self._lock:
+            arrays = [bank[slots] for bank in self._bank]
+        return arrays[:self.n_inputs], arrays[self.n_inputs:]
+
+    def __iter__(self):
+        epoch = self.epoch
+        for index in range(len(self)):
+            yield self.get_batch(index, epoch)
+        # a fraction of the bank is replaced in the background
+        self.epoch += 1
+        if self.refresh_fraction > 0 and self._thread.is_alive():
+            self._requests.put(epoch)
+
+    def wait_refresh(self):
+        """ Block until the pending refreshes of the bank are done.
+        """
+        self._requests.join()
+
+    def to_dataset(self, repeat=False):
+        """
+        Return a ``tf.data.Dataset`` yielding the batches as tuples of 
+        (inputs, targets).
+
+        Parameters
+        ----------
+        repeat : bool, optional
+            If True, the dataset is repeated indefinitely. Needed when the 
+            number of steps per epoch is given explicitly.
+        """
+        signature = tuple(tf.TensorSpec((None,) + tuple(shape), tf.float32) 
+                          for shape in self.sample_shapes)
+        signature = (signature[:self.n_inputs], signature[self.n_inputs:])
+
+        def generator():
+            for x, y in self:
+                yield tuple(x), tuple(y)
+
+        dataset = tf.data.Dataset.from_generator(generator, output_signature=signature)
+        if repeat:
+            dataset = dataset.repeat()
+        return dataset
+
+    def close(self):
+        """Stop the background thread.
+        """
+        if self._thread.is_alive():
+            self._requests.put(None)
+            self._thread.join()
+
+
+class SharedMemoryLoader():
+    """
+    Multiprocess loader for a ``DataGenerator`` whose arrays live in shared
+    memory. The HR, LR, predictor and static arrays are placed once in 
+    ``multiprocessing.shared_memory`` blocks (``.npy`` memory-maps are simply 
+    re-opened), and the worker processes attach to them without copying. This
+    avoids pickling the whole ``DataGenerator`` to every worker, as done by 
+    Keras with ``use_multiprocessing=True``. The batches are written by the 
+    workers into a ring buffer of ``queue_depth`` shared memory slots.
+
+    Iterating over the loader yields the batches of one epoch, in order, as 
+    ``[inputs], [targets]`` lists of float32 arrays. The arrays are views of a
+    slot and are valid until the next batch is requested. 
+
+    The workers are started with 'spawn' by default. Forking a process where 
+    TensorFlow or other threads are already running is not safe, so 'fork' 
+    should only be used when the loader is created before importing or 
+    initializing TensorFlow. With 'spawn' and 'forkserver', the main script
+    must be guarded with ``if __name__ == '__main__'``.
+    """
+    def __init__(self, datagen, num_workers=None, queue_depth=None, 
+                 start_method='spawn'):
+        """
+        Parameters
+        ----------
+        datagen : dl4ds.DataGenerator
+            Data generator used for creating the batches.
+        num_workers : int or None, optional
+            Number of worker processes. If None, it is set to the number of CPUs.
+        queue_depth : int or None, optional
+            Number of batch slots in the ring buffer, i.e., maximum number of 
+            batches being created or waiting to be consumed. If None, it is set
+            to twice ``num_workers``.
+        start_method : str or None, optional
+            Start method of the worker processes ('spawn', 'forkserver' or 
+            'fork'). If None, the default of the platform is used.
+        """
+        self.datagen = datagen
+        self.num_workers = num_workers if num_workers is not None else (mp.cpu_count() or 1)
+        self.queue_depth = queue_depth if queue_depth is not None else 2 * self.num_workers
+        if self.num_workers < 1 or self.queue_depth < 1:
+            msg = '`num_workers` and `queue_depth` must be positive'
+            raise ValueError(msg)
+        self._shms = []
+
+        # probing the generator to get the structure of the batches
+        x_probe, y_probe = datagen[0]
+        self.n_inputs = len(x_probe)
+        self.batch_shapes = [np.shape(a) for a in list(x_probe) + list(y_probe)]
+        
+        # placing the arrays in shared memory 
+        worker_datagen = copy.copy(datagen)
+        for attr in ['array', 'array_lr', 'predictors']:
+            setattr(worker_datagen, attr, self._share_(getattr(datagen, attr)))
+        if isinstance(datagen.static_vars, StaticVarsCache):
+            static_vars = copy.copy(datagen.static_vars)
+            static_vars.hr = self._share_(datagen.static_vars.hr)
+            if datagen.static_vars.lr is datagen.static_vars.hr:
+                static_vars.lr = static_vars.hr
+            else:
+                static_vars.lr = self._share_(datagen.static_vars.lr)
+            worker_datagen.static_vars = static_vars
+        
+        # ring buffer of batch slots
+        slot_nbytes = sum(int(np.prod(shape)) * 4 for shape in self.batch_shapes)
+        self._slot_specs = []
+        self._slots = []
+        for _ in range(self.queue_depth):
+            shm = self._create_shm_(slot_nbytes)
+            self._slot_specs.append(shm.name)
+            self._slots.append(_attach_slot_(shm, self.batch_shapes))
+        
+        ctx = mp.get_context(start_method)
+        self._task_queue = ctx.Queue()
+        self._done_queue = ctx.Queue()
+        self._workers = []
+        for _ in range(self.num_workers):
+            worker = ctx.Process(
+                target=_shared_memory_worker_, 
+                args=(worker_datagen, self._slot_specs, self.batch_shapes, 
+                      self._task_queue, self._done_queue),
+                daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        self._free_slots = list(range(self.queue_depth))
+        self._n_pending = 0
+        self._finalizer = weakref.finalize(
+            self, _close_shared_memory_loader_, self._workers, self._task_queue, 
+            self._shms)
+
+    def _create_shm_(self, nbytes):
+        shm = shared_memory.SharedMemory(create=True, size=max(int(nbytes), 1))
+        self._shms.append(shm)
+        return shm
+
+    def _share_(self, array):
+        """Return a picklable version of ``array`` that the workers can attach 
+        to without copying. 
+        """
+        if isinstance(array, LazyArray):
+            array = copy.copy(array)
+            array.sources = [self._share_(src) for src in array.sources]
+            return array
+        if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap):
+            # memory-mapped files are re-opened by the workers
+            return _SharedArray_('memmap', array.filename, array.dtype, 
+                                 array.shape, array.offset, array.flags.f_contiguous)
+        if isinstance(array, np.ndarray):
+            shm = self._create_shm_(array.nbytes)
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shared[...] = array
+            return _SharedArray_('shm', shm.name, array.dtype, array.shape)
+        return array
+
+    def __len__(self):
+        return len(self.datagen)
+
+    def _submit_(self, index, epoch):
+        slot = self._free_slots.pop()
+        self._task_queue.put((slot, index, epoch))
+        self._n_pending += 1
+
+    def _receive_(self):
+        while True:
+            try:
+                slot, index, error = self._done_queue.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError('A SharedMemoryLoader worker died unexpectedly')
+                continue
+            self._n_pending -= 1
+            if error is not None:
+                self._free_slots.append(slot)
+                raise RuntimeError(f'Error in a SharedMemoryLoader worker:\n{error}')
+            return slot, index
+
+    def __iter__(self):
+        if not self._finalizer.alive:
+            raise RuntimeError('The SharedMemoryLoader is closed')
+        # dropping the batches of a previous (interrupted) epoch
+        while self._n_pending > 0:
+            slot, _ = self._receive_()
+            self._free_slots.append(slot)
+
+        # each iteration over the loader is a new epoch
+        epoch = self.datagen.sampler.epoch
+        self.datagen.on_epoch_end()
+        n = len(self)
+        next_index = 0
+        ready = {}
+        slot = None
+        try:
+            while self._free_slots and next_index < n:
+                self._submit_(next_index, epoch)
+                next_index += 1
+            for index in range(n):
+                while index not in ready:
+                    received, i = self._receive_()
+                    ready[i] = received
+                slot = ready.pop(index)
+                batch = self._slots[slot]
+                yield list(batch[:self.n_inputs]), list(batch[self.n_inputs:])
+                # the slot is reused once the consumer asks for the next batch
+                self._free_slots.append(slot)
+                slot = None
+                if next_index < n:
+                    self._submit_(next_index, epoch)
+                    next_index += 1
+        finally:
+            # when the iteration stops early, the slot being consumed and the 
+            # received batches are freed (pending ones are dropped by the next
+            # iteration)
+            if slot is not None:
+                self._free_slots.append(slot)
+            self._free_slots.extend(ready.values())
+
+    def to_dataset(self, repeat=False):
+        """
+        Return a ``tf.data.Dataset`` yielding the batches as tuples of 
+        (inputs, targets).
+
+        Parameters
+        ----------
+        repeat : bool, optional
+            If True, the dataset is repeated indefinitely. Needed when the 
+            number of steps per epoch is given explicitly.
+        """
+        signature = tuple(tf.TensorSpec((None,) + tuple(shape[1:]), tf.float32) 
+                          for shape in self.batch_shapes)
+        signature = (signature[:self.n_inputs], signature[self.n_inputs:])
+
+        def generator():
+            for x, y in self:
+                yield tuple(x), tuple(y)
+
+        dataset = tf.data.Dataset.from_generator(generator, output_signature=signature)
+        if repeat:
+            dataset = dataset.repeat()
+        return dataset
+
+    def close(self):
+        """Stop the workers and release the shared memory.
+        """
+        self._slots = []
+        self._finalizer()
+
 
-def _get_season_(time_metadata, time_window):
-    """ Get the season for a given sample.
+class _SharedArray_():
+    """Reference to an array in shared memory or in a memory-mapped file.
     """
-    if time_window is None:
-        month_int = time_metadata.dt.month.values
+    def __init__(self, kind, name, dtype, shape, offset=0, fortran=False):
+        self.kind = kind
+        self.name = name
+        # kept as a string, the bfloat16 dtype of tensorflow cannot be pickled
+        dtype = np.dtype(dtype)
+        self.dtype = 'bfloat16' if dtype.name == 'bfloat16' else dtype.str
+        self.shape = tuple(shape)
+        self.offset = offset
+        self.fortran = fortran
+
+    def attach(self, shms):
+        dtype = _numpy_dtype_(self.dtype)
+        if self.kind == 'memmap':
+            return np.memmap(self.name, dtype=dtype, mode='r', 
+                             offset=self.offset, shape=self.shape, 
+                             order='F' if self.fortran else 'C')
+        shm = shared_memory.SharedMemory(name=self.name)
+        shms.append(shm)
+        return np.ndarray(self.shape, dtype=dtype, buffer=shm.buf)
+
+
+def _attach_slot_(shm, shapes):
+    """Float32 arrays (one per batch input/target) of a ring buffer slot.
+    """
+    arrays = []
+    offset = 0
+    for shape in shapes:
+        array = np.ndarray(shape, dtype='float32', buffer=shm.buf, offset=offset)
+        arrays.append(array)
+        offset += array.nbytes
+    return arrays
+
+
+def _attach_shared_(obj, shms):
+    """Replace the ``_SharedArray_`` references of ``obj`` by arrays.
+    """
+    if isinstance(obj, _SharedArray_):
+        return obj.attach(shms)
+    if isinstance(obj, LazyArray):
+        obj.sources = [_attach_shared_(src, shms) for src in obj.sources]
+    return obj
+
+
+def _shared_memory_worker_(datagen, slot_names, batch_shapes, task_queue, 
+                           done_queue):
+    """Worker process of ``SharedMemoryLoader``. 
+    """
+    from . import utils
+    # the resize threads of the parent process are not inherited (fork)
+    utils._RESIZE_POOL_ = None
+    shms = []
+    for attr in ['array', 'array_lr', 'predictors']:
+        setattr(datagen, attr, _attach_shared_(getattr(datagen, attr), shms))
+    if isinstance(datagen.static_vars, StaticVarsCache):
+        lr_is_hr = datagen.static_vars.lr is datagen.static_vars.hr
+        datagen.static_vars.hr = _attach_shared_(datagen.static_vars.hr, shms)
+        datagen.static_vars.lr = datagen.static_vars.hr if lr_is_hr else \
+            _attach_shared_(datagen.static_vars.lr, shms)
+    slots = []
+    for name in slot_names:
+        shm = shared_memory.SharedMemory(name=name)
+        shms.append(shm)
+        slots.append(_attach_slot_(shm, batch_shapes))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        slot, index, epoch = task
+        try:
+            x, y = datagen.get_batch(index, epoch)
+            for dst, src in zip(slots[slot], list(x) + list(y)):
+                dst[...] = src
+            done_queue.put((slot, index, None))
+        except Exception:
+            done_queue.put((slot, index, traceback.format_exc()))
+    del slots
+    datagen = None
+    for shm in shms:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+
+def _close_shared_memory_loader_(workers, task_queue, shms):
+    """Stop the workers of a ``SharedMemoryLoader`` and unlink its shared 
+    memory blocks.
+    """
+    for _ in workers:
+        task_queue.put(None)
+    for worker in workers:
+        worker.join(timeout=5)
+        if worker.is_alive():
+            worker.terminate()
+    for shm in shms:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+        shm.unlink()
+
+
+_SEASONS_ = ['winter', 'spring', 'summer', 'autumn']
+# season code of each month (index 1 to 12)
+_MONTH_TO_SEASON_ = np.array([-1, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0], dtype='int8')
+# one-hot encoding of the season codes
+_SEASON_ONEHOT_ = np.eye(len(_SEASONS_), dtype='float32')
+
+
+def create_season_table(time_metadata, time_window=None):
+    """
+    Encode, once for all the samples, the season as an integer code (0 for 
+    winter, 1 for spring, 2 for summer and 3 for autumn). The batches then get
+    their one-hot season channels from a lookup, without per-sample work.
+
+    Parameters
+    ----------
+    time_metadata : xr.DataArray or array-like of np.datetime64
+        Time coordinate of the grids, e.g. ``array.time``.
+    time_window : int or None, optional
+        If not None, the season of each time window (starting at each time 
+        step) is the one of its most frequent month.
+
+    Returns
+    -------
+    season_table : np.ndarray
+        Int8 array with the season code of each sample.
+    """
+    if isinstance(time_metadata, xr.DataArray):
+        months = time_metadata.dt.month.values
     else:
-        month_int = sc.stats.mode(time_metadata.time.dt.month.values)
-        month_int = int(month_int.count)
+        months = np.asarray(time_metadata, dtype='datetime64[M]').astype('int64') % 12 + 1
+    if time_window is not None:
+        # most frequent month of each window (the first one in case of ties)
+        windows = sliding_window_view(months, time_window)
+        counts = (windows[..., np.newaxis] == np.arange(1, 13)).sum(axis=1)
+        months = counts.argmax(axis=1) + 1
+    return _MONTH_TO_SEASON_[months]
 
-    if month_int in [12, 1, 2]:
-        season = 'winter'
-    elif month_int in [3, 4, 5]:
-        season = 'spring'
-    elif month_int in [6, 7, 8]: 
-        season = 'summer'
-    elif month_int in [9, 10, 11]:
-        season = 'autumn'
-    return season
+
+def _is_season_table_(time_metadata):
+    """ Whether ``time_metadata`` is already a season table (integer codes).
+    """
+    return isinstance(time_metadata, np.ndarray) and time_metadata.dtype.kind in 'iu'
+
+
+def _get_season_channels_(season_codes, sizey, sizex):
+    """ One-hot season channels [n_samples, sizey, sizex, 4] for an array of 
+    season codes, as a read-only broadcast of the one-hot table (no copies).
+    """
+    onehot = _SEASON_ONEHOT_[np.asarray(season_codes)]
+    return np.broadcast_to(onehot[:, np.newaxis, np.newaxis, :], 
+                           (len(onehot), sizey, sizex, len(_SEASONS_)))
 
 
-def _get_season_array_(season, sizey, sizex):
-    """ Produce a multichannel array encoding the season. 
+def _get_season_array_(season, sizey, sizex, dtype='float32'):
+    """ Produce a multichannel array (float32 by default) encoding the season. 
     """
-    if season not in ['winter', 'spring', 'summer', 'autumn']:
+    if season not in _SEASONS_:
         raise ValueError('``season`` not recognized')
-    season_array = np.zeros((sizey, sizex, 4))
-    if season == 'winter':
-        season_array[:,:,0] += 1
-    elif season == 'spring':
-        season_array[:,:,1] += 1
-    elif season == 'summer':
-        season_array[:,:,2] += 1
-    elif season == 'autumn':
-        season_array[:,:,3] += 1    
-    return season_array
\ No newline at end of file
+    onehot = _SEASON_ONEHOT_[_SEASONS_.index(season)]
+    return np.broadcast_to(onehot, (sizey, sizex, len(_SEASONS_))).astype(dtype)
\ No newline at end of file
@@ -5,8 +5,24 @@ import xarray as xr
 import tensorflow as tf
 import keras
 
-from .utils import Timing, checkarray_ndim, resize_array, spatiotemporal_to_spatial_samples
-from .dataloader import create_batch_hr_lr
+try:
+    import zarr
+    has_zarr = True
+except ImportError:
+    has_zarr = False
+
+try:
+    import netCDF4
+    has_netcdf4 = True
+except ImportError:
+    has_netcdf4 = False
+
+from . import POSTUPSAMPLING_METHODS
+from .utils import Timing, checkarray_ndim, spatiotemporal_to_spatial_samples
+from .dataloader import (create_batch_hr_lr, create_batch_lr, create_season_table, 
+                         StaticVarsCache)
+
+BLENDING_METHODS = ['cosine', 'linear']
 
 
 class Predictor():
@@ -31,7 +47,13 @@ class Predictor():
         save_path=None,
         save_fname='y_hat.npy',
         return_lr=False,
-        device='GPU'):
+        device='GPU',
+        tile_size=None,
+        tile_overlap=None,
+        blending='cosine',
+        chunk_size=None,
+        output_path=None,
+        coords=None):
         """ 
         Parameters
         ----------
@@ -55,6 +77,9 @@ class Predictor():
             If None, then the function assumes the ``model`` is spatial only. If 
             an integer is given, then the ``model`` should be spatio-temporal 
             and the samples are pre-processed accordingly.
+        time_metadata : xr.DataArray, array-like of np.datetime64 or None
+            Time coordinate of ``array``, needed for models trained with 
+            one-hot season channels (``use_season``). 
         interpolation : str, optional
             Interpolation used when upsampling/downsampling the training samples.
             By default 'bicubic'. 
@@ -68,6 +93,21 @@ class Predictor():
             Filename to complete the path were the prediciton is saved.     
         return_lr : bool, optional
             If True, the LR array is returned along with the downscaled one.                                                                
+        tile_size : int, tuple of ints or None, optional
+            If not None, the domain is processed in tiles of ``tile_size`` HR 
+            pixels. See ``dl4ds.predict``.
+        tile_overlap : int or None, optional
+            Overlap between neighbouring tiles, in HR pixels. 
+        blending : {'cosine', 'linear'}, optional
+            Weights for blending the overlapping tiles.
+        chunk_size : int or None, optional
+            If not None, the inference is streamed over chunks of 
+            ``chunk_size`` time steps, written to the netCDF or zarr store 
+            ``output_path``. See ``dl4ds.predict_stream``.
+        output_path : str or None, optional
+            Path of the output store, needed when ``chunk_size`` is given.
+        coords : xr.DataArray, xr.Dataset, dict or None, optional
+            Coordinates of the streamed output (HR lat and lon, and time).
         """
         self.trainer = trainer 
         self.array_in_hr = array_in_hr
@@ -84,10 +124,41 @@ class Predictor():
         self.save_fname = save_fname
         self.return_lr = return_lr
         self.device = device
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.blending = blending
+        self.chunk_size = chunk_size
+        self.output_path = output_path
+        self.coords = coords
+        if self.chunk_size is not None:
+            if self.output_path is None:
+                raise ValueError('`output_path` must be given for streaming inference')
+            if self.return_lr:
+                raise ValueError('`return_lr` is not supported for streaming inference')
 
     def run(self): 
         """ 
         """
+        if self.chunk_size is not None:
+            return predict_stream(
+                trainer=self.trainer, 
+                array=self.array, 
+                scale=self.scale, 
+                output_path=self.output_path,
+                chunk_size=self.chunk_size,
+                array_in_hr=self.array_in_hr, 
+                static_vars=self.static_vars, 
+                predictors=self.predictors,
+                time_window=self.time_window, 
+                time_metadata=self.time_metadata, 
+                interpolation=self.interpolation, 
+                batch_size=self.batch_size, 
+                scaler=self.scaler,
+                coords=self.coords,
+                device=self.device,
+                tile_size=self.tile_size,
+                tile_overlap=self.tile_overlap,
+                blending=self.blending)
         return predict(
             trainer=self.trainer, 
             array=self.array, 
@@ -103,7 +174,10 @@ class Predictor():
             save_path=self.save_path,
             save_fname=self.save_fname, 
             return_lr=self.return_lr,
-            device=self.device) 
+            device=self.device,
+            tile_size=self.tile_size,
+            tile_overlap=self.tile_overlap,
+            blending=self.blending) 
 
 
 def predict(
@@ -121,10 +195,20 @@ def predict(
     save_path=None,
     save_fname='y_hat.npy',
     return_lr=False,
-    device='GPU'):
+    device='GPU',
+    tile_size=None,
+    tile_overlap=None,
+    blending='cosine'):
     """Inference on unseen HR or LR data. The data (``array``) is super-resolved 
     or downscaled using the trained super-resolution network (``model``). 
 
+    By default the whole domain is passed through the model at once. With 
+    ``tile_size``, the domain is split into overlapping tiles, which are
+    batched across time steps and blended into a preallocated output array. 
+    This bounds the memory needed by the model for large HR grids, and allows
+    using models with a fixed input size (``localcon_layer``), for which the 
+    tile size is the one of the model by default. 
+
     Parameters
     ----------
     trainer : dl4ds.SupervisedTrainer or dl4ds.CGANTrainer
@@ -137,7 +221,7 @@ def predict(
     array_in_hr : bool, optional
         If True, the data is assumed to be a HR groundtruth to be downsampled. 
         Otherwise, data is a LR gridded dataset to be downscaled.
-    static_vars : None or list of 2D ndarrays, optional
+    static_vars : None or list of 2D ndarrays or dl4ds.StaticVarsCache, optional
         Static variables such as elevation data or a binary land-ocean mask.
     predictors : list of ndarray, optional
         Predictor variables for trianing. Given as list of 4D ndarrays with dims 
@@ -146,6 +230,9 @@ def predict(
         If None, then the function assumes the ``model`` is spatial only. If an 
         integer is given, then the ``model`` should be spatio-temporal and the 
         samples are pre-processed accordingly.
+    time_metadata : xr.DataArray, array-like of np.datetime64 or None
+        Time coordinate of ``array``, needed for models trained with one-hot 
+        season channels (``use_season``). 
     interpolation : str, optional
         Interpolation used when upsampling/downsampling the training samples.
         By default 'bicubic'. 
@@ -159,9 +246,172 @@ def predict(
         Filename to complete the path were the prediciton is saved. 
     return_lr : bool, optional
         If True, the LR array is returned along with the downscaled one. 
+    tile_size : int, tuple of ints or None, optional
+        Size of the (square if an int is given) tiles in HR pixels. With 
+        post-upsampling models it must be divisible by ``scale``.
+    tile_overlap : int or None, optional
+        Overlap between neighbouring tiles in HR pixels, at most half of 
+        ``tile_size``. By default, a quarter of ``tile_size``. It should cover 
+        the receptive field of the model for the tiled prediction to match the
+        full-domain one away from the tile borders.
+    blending : {'cosine', 'linear'}, optional
+        Weights for blending the overlapping tiles, tapering towards the tile 
+        borders over ``tile_overlap`` pixels. See ``dl4ds.blending_weights``.
     """         
     timing = Timing()
+    model = _get_model_(trainer, time_window)
+
+    if time_metadata is not None:
+        # the seasons of the samples are encoded once
+        time_metadata = create_season_table(time_metadata, time_window)
+
+    if isinstance(array, xr.DataArray):    
+        array = array.values  
+
+    if static_vars is not None and not isinstance(static_vars, StaticVarsCache):
+        # HR and LR static variables are computed once, full-domain batches 
+        # reuse a broadcast of the cached arrays
+        static_vars = StaticVarsCache(static_vars, model.name.split('_')[-1], 
+                                      scale, interpolation)
+
+    ### Concatenating list of ndarray variables along the last dimension  
+    if predictors is not None:
+        predictors = np.concatenate(predictors, axis=-1)
+
+    out, x_test_lr = _predict_array_(
+        model, array, scale, array_in_hr, static_vars, predictors, time_window, 
+        time_metadata, interpolation, batch_size, device, tile_size, 
+        tile_overlap, blending, return_lr)
+
+    if scaler is not None:
+        out = scaler.inverse_transform(out)
 
+    if save_path is not None and save_fname is not None:
+        name = os.path.join(save_path, save_fname)
+        np.save(name, out.astype('float32'))
+    
+    timing.runtime()
+    if return_lr:
+        return out, np.array(x_test_lr)
+    else:
+        return out        
+
+
+def predict_stream(
+    trainer, 
+    array, 
+    scale, 
+    output_path,
+    chunk_size=64,
+    array_in_hr=True,
+    static_vars=None, 
+    predictors=None, 
+    time_window=None,
+    time_metadata=None,
+    interpolation='inter_area', 
+    batch_size=64,
+    scaler=None,
+    coords=None,
+    var_name='y_hat',
+    compression_level=4,
+    device='GPU',
+    tile_size=None,
+    tile_overlap=None,
+    blending='cosine'):
+    """Streaming inference over time. The samples are processed in chunks of 
+    ``chunk_size`` time steps, each one backward scaled and appended to a 
+    chunked, compressed netCDF or zarr store on disk, so the peak memory 
+    depends on the chunk size and not on the length of the record. ``array``
+    (and ``predictors``) can be lazy, e.g. memmaps or xr.DataArrays backed by
+    netCDF/zarr files, since only the time slices of each chunk are read. See 
+    ``dl4ds.predict`` for the parameters shared with the in-memory inference.
+
+    Parameters
+    ----------
+    output_path : str
+        Path of the output store. A zarr store is created when it ends with 
+        '.zarr', a netCDF file otherwise.
+    chunk_size : int, optional
+        Number of time steps processed at once (and size of the chunks of the
+        output store along time).
+    coords : xr.DataArray, xr.Dataset, dict or None, optional
+        Coordinates of the output: 'lat' and 'lon' of the HR grid and, 
+        optionally, 'time'. By default, the coordinates of ``array`` are used 
+        when it is an xr.DataArray in HR (the time coordinate in any case), and 
+        integer indices otherwise.
+    var_name : str, optional
+        Name of the output variable.
+    compression_level : int, optional
+        Compression level (zlib) of the netCDF output. Zarr stores use the 
+        default compressor of zarr.
+
+    Returns
+    -------
+    y_hat : xr.DataArray
+        Output variable, lazily opened from ``output_path``.
+    """
+    use_zarr = output_path.rstrip('/').endswith('.zarr')
+    if use_zarr and not has_zarr:
+        raise ImportError('zarr must be installed for writing zarr stores')
+    if not use_zarr and not has_netcdf4:
+        raise ImportError('netCDF4 must be installed for writing netCDF files')
+
+    timing = Timing()
+    model = _get_model_(trainer, time_window)
+
+    n_frames = array.shape[0]
+    n_samples = n_frames - (time_window - 1 if time_window is not None else 0)
+    time_coord, lat_coord, lon_coord = _output_coords_(
+        array, coords, array_in_hr, n_frames)
+
+    if time_metadata is not None:
+        # the seasons of the samples are encoded once
+        time_metadata = create_season_table(time_metadata, time_window)
+
+    if static_vars is not None and not isinstance(static_vars, StaticVarsCache):
+        static_vars = StaticVarsCache(static_vars, model.name.split('_')[-1], 
+                                      scale, interpolation)
+
+    for start in range(0, n_samples, chunk_size):
+        end = min(start + chunk_size, n_samples)
+        # spatio-temporal samples need the next time_window - 1 frames
+        stop = end + time_window - 1 if time_window is not None else end
+        array_chunk = array[start:stop]
+        if isinstance(array_chunk, xr.DataArray):
+            array_chunk = array_chunk.values
+        array_chunk = np.asarray(array_chunk)
+        if predictors is not None:
+            predictors_chunk = np.concatenate(
+                [np.asarray(pred[start:stop]) for pred in predictors], axis=-1)
+        else:
+            predictors_chunk = None
+        season_chunk = None if time_metadata is None else time_metadata[start:end]
+
+        out, _ = _predict_array_(
+            model, array_chunk, scale, array_in_hr, static_vars, predictors_chunk, 
+            time_window, season_chunk, interpolation, batch_size, device, 
+            tile_size, tile_overlap, blending, False)
+        # the first frame of each spatio-temporal sample, and all the frames 
+        # of the last one
+        if end < n_samples:
+            out = out[:end - start]
+
+        if scaler is not None:
+            out = _inverse_transform_(scaler, out)
+
+        _write_chunk_(output_path, out.astype('float32'), start, time_coord, 
+                      lat_coord, lon_coord, var_name, chunk_size, 
+                      compression_level, use_zarr)
+        del out
+
+    timing.runtime()
+    engine = 'zarr' if use_zarr else None
+    return xr.open_dataarray(output_path, engine=engine)
+
+
+def _get_model_(trainer, time_window):
+    """ Keras model of a trainer (or the model itself).
+    """
     if hasattr(trainer, 'model'):
         model = trainer.model
     elif hasattr(trainer, 'generator'):
@@ -169,64 +419,196 @@ def predict(
     else:
         model = trainer
 
-    upsampling = model.name.split('_')[-1]
-    dim = len(model.input.shape)
+    # models with auxiliary (static) inputs have a list of inputs
+    model_input = model.input[0] if isinstance(model.input, list) else model.input
+    dim = len(model_input.shape)
     if dim == 5 and time_window is None:
        raise ValueError('`time_window` must be provided for spatiotemporal model')
+    return model
 
-    time_metadata = None
-
-    if isinstance(array, xr.DataArray):    
-        array = array.values  
 
-    if static_vars is not None:
-        for i in range(len(static_vars)):
-            if isinstance(static_vars[i], xr.DataArray):
-                static_vars[i] = static_vars[i].values
+def _predict_array_(model, array, scale, array_in_hr, static_vars, predictors, 
+                    time_window, time_metadata, interpolation, batch_size, device, 
+                    tile_size, tile_overlap, blending, return_lr):
+    """ Inference on an in-memory array, at once or tiled.
+    """
+    upsampling = model.name.split('_')[-1]
+    model_input = model.input[0] if isinstance(model.input, list) else model.input
 
     n_samples = array.shape[0]
     if time_window is not None:
         n_samples -= time_window - 1
 
-    ### Concatenating list of ndarray variables along the last dimension  
-    if predictors is not None:
-        predictors = np.concatenate(predictors, axis=-1)
-
-    ### Array is upsampled according to scale when array is in LR
+    ### LR data is fed as it is, without an HR array (see create_batch_lr)
     if array_in_hr:
         array_hr = array
         array_lr = None
+        hr_grid = tuple(array_hr.shape[1:3])
     else:
-        array = checkarray_ndim(array, 4, -1)
-        hr_xy = (array.shape[2] * scale, array.shape[1] * scale)
-        array_hr = resize_array(array, hr_xy, interpolation, squeezed=False) 
-        array_lr = array
+        array_hr = None
+        array_lr = checkarray_ndim(array, 4, -1)
+        hr_grid = (array_lr.shape[1] * scale, array_lr.shape[2] * scale)
+
+    # models with a fixed input size are tiled, unless the grids match
+    if tile_size is None and model_input.shape[-3] is not None:
+        factor = scale if upsampling in POSTUPSAMPLING_METHODS else 1
+        model_grid = tuple(n * factor for n in model_input.shape[-3:-1])
+        if hr_grid != model_grid:
+            tile_size = model_grid
+
+    if tile_size is not None:
+        return _predict_tiled_(
+            model, array_hr, array_lr, n_samples, upsampling, scale, static_vars, 
+            predictors, time_window, time_metadata, interpolation, batch_size, 
+            tile_size, tile_overlap, blending, device, return_lr)
+    else:
+        return _predict_full_(
+            model, array_hr, array_lr, n_samples, upsampling, scale, static_vars, 
+            predictors, time_window, time_metadata, interpolation, batch_size, 
+            device)
+
+
+def _inverse_transform_(scaler, out):
+    """ Backward scaling of a chunk of the output, keeping its shape (the 
+    scalers squeeze their input).
+    """
+    return np.reshape(scaler.inverse_transform(out), out.shape)
 
-    batch = create_batch_hr_lr(       
-        all_indices=np.arange(n_samples),
+
+def _create_inputs_(indices, array_hr, array_lr, upsampling, scale, static_vars, 
+                    predictors, time_window, time_metadata, interpolation):
+    """ Model inputs of the samples ``indices``, created straight from the LR
+    grids when there is no HR array.
+    """
+    if array_hr is None:
+        return create_batch_lr(
+            indices, array_lr, upsampling, scale=scale, static_vars=static_vars,
+            predictors=predictors, interpolation=interpolation, 
+            time_window=time_window, time_metadata=time_metadata)
+    inputs, _ = create_batch_hr_lr(
+        all_indices=np.asarray(indices),
         index=0,
         array=array_hr, 
         array_lr=array_lr,
         upsampling=upsampling,
         scale=scale, 
-        batch_size=n_samples, 
+        batch_size=len(indices), 
         patch_size=None,
         time_window=time_window,
         static_vars=static_vars, 
         predictors=predictors,
         interpolation=interpolation,
         time_metadata=time_metadata)
+    return inputs
+
+
+def _output_coords_(array, coords, array_in_hr, n_frames):
+    """ Time, lat and lon coordinates of the streamed output (lat and lon are 
+    None when they are to be integer indices).
+    """
+    if isinstance(coords, (xr.DataArray, xr.Dataset)):
+        coords = coords.coords
+    coords = {} if coords is None else coords
+    array_coords = array.coords if isinstance(array, xr.DataArray) else {}
 
-    if static_vars is not None:
-        [batch_lr, batch_aux_hr], _ = batch
+    if 'time' in coords:
+        time_coord = np.asarray(coords['time'])
+    elif 'time' in array_coords:
+        time_coord = np.asarray(array_coords['time'])
     else:
-        [batch_lr], _ = batch
+        time_coord = np.arange(n_frames)
+    if len(time_coord) != n_frames:
+        raise ValueError('The time coordinate does not match the number of time steps')
+
+    latlon = []
+    for dim in ['lat', 'lon']:
+        if dim in coords:
+            latlon.append(np.asarray(coords[dim]))
+        elif array_in_hr and dim in array_coords:
+            latlon.append(np.asarray(array_coords[dim]))
+        else:
+            latlon.append(None)
+    return time_coord, latlon[0], latlon[1]
+
+
+def _write_chunk_(path, out, start, time_coord, lat_coord, lon_coord, var_name, 
+                  chunk_size, compression_level, use_zarr):
+    """ Write a chunk of the output [time, lat, lon, vars] starting at the time 
+    step ``start``. The store is created with the first chunk and the next 
+    ones are appended along time.
+    """
+    n, height, width, n_vars = out.shape
+    dims = ('time', 'lat', 'lon')
+    if n_vars == 1:
+        out = out[..., 0]
+    else:
+        dims += ('var',)
+    lat_coord = np.arange(height) if lat_coord is None else lat_coord
+    lon_coord = np.arange(width) if lon_coord is None else lon_coord
+    if len(lat_coord) != height or len(lon_coord) != width:
+        raise ValueError('The lat/lon coordinates do not match the HR grid')
+    times = time_coord[start:start + n]
+    chunks = (chunk_size,) + out.shape[1:]
+
+    if start == 0 or use_zarr:
+        dataset = xr.Dataset(
+            {var_name: (dims, out)}, 
+            coords={'time': times, 'lat': lat_coord, 'lon': lon_coord})
+    if use_zarr:
+        if start == 0:
+            dataset.to_zarr(path, mode='w', encoding={var_name: {'chunks': chunks}})
+        else:
+            dataset.to_zarr(path, append_dim='time')
+    elif start == 0:
+        encoding = {var_name: dict(zlib=True, complevel=compression_level, 
+                                   chunksizes=chunks)}
+        if _is_datetime_(times):
+            # integer seconds, for appending the next time steps exactly
+            encoding['time'] = dict(units='seconds since 1970-01-01', dtype='int64')
+        dataset.to_netcdf(path, mode='w', unlimited_dims=['time'], encoding=encoding)
+    else:
+        with netCDF4.Dataset(path, mode='a') as dataset:
+            time_var = dataset['time']
+            if _is_datetime_(times):
+                # encoded with the units and calendar of the stored time steps
+                if np.issubdtype(times.dtype, np.datetime64):
+                    times = times.astype('datetime64[us]').tolist()
+                times = netCDF4.date2num(
+                    times, time_var.units, 
+                    calendar=getattr(time_var, 'calendar', 'standard'))
+            dataset[var_name][start:start + n] = out
+            time_var[start:start + n] = times
+
+
+def _is_datetime_(times):
+    """ Whether the time coordinate holds dates (numpy datetime64 or cftime
+    datetimes), which are encoded with units and calendar.
+    """
+    if np.issubdtype(times.dtype, np.datetime64):
+        return True
+    return times.dtype == object and len(times) > 0 and \
+        hasattr(times[0], 'calendar')
+
+
+def _predict_full_(model, array_hr, array_lr, n_samples, upsampling, scale, 
+                   static_vars, predictors, time_window, time_metadata, 
+                   interpolation, batch_size, device):
+    """ Full-domain inference, all the samples being created at once.
+    """
+    batch = _create_inputs_(
+        np.arange(n_samples), array_hr, array_lr, upsampling, scale, static_vars,
+        predictors, time_window, time_metadata, interpolation)
+
+    if static_vars is not None or time_metadata is not None:
+        [batch_lr, batch_aux_hr] = batch
+    else:
+        [batch_lr] = batch
 
     x_test_lr = batch_lr  
 
     ### Casting as TF tensors, creating inputs ---------------------------------
     x_test_lr = tf.cast(x_test_lr, tf.float32)   
-    if static_vars is not None: 
+    if static_vars is not None or time_metadata is not None: 
         aux_vars_hr = tf.cast(batch_aux_hr, tf.float32) 
         inputs = [x_test_lr, aux_vars_hr]
     else:
@@ -240,17 +622,132 @@ def predict(
     ### 
     if out.ndim == 5 and time_window is not None:
         out = spatiotemporal_to_spatial_samples(out, time_window)
+    return out, x_test_lr
 
-    if scaler is not None:
-        out = scaler.inverse_transform(out)
 
-    if save_path is not None and save_fname is not None:
-        name = os.path.join(save_path, save_fname)
-        np.save(name, out.astype('float32'))
-    
-    timing.runtime()
-    if return_lr:
-        return out, np.array(x_test_lr)
-    else:
-        return out        
-    
+def _predict_tiled_(model, array_hr, array_lr, n_samples, upsampling, scale, 
+                    static_vars, predictors, time_window, time_metadata, 
+                    interpolation, batch_size, tile_size, tile_overlap, blending, 
+                    device, return_lr):
+    """ Tiled inference. The tiles of consecutive time steps are fed in 
+    batches of ``batch_size`` and their weighted predictions accumulated in a
+    preallocated output array, normalized by the sum of the blending weights.
+    The full-domain inputs are only created for the time steps of a batch.
+    """
+    # input grids are at LR for post-upsampling models, the aux ones at HR
+    factor = scale if upsampling in POSTUPSAMPLING_METHODS else 1
+    tile_y, tile_x = (tile_size, tile_size) if np.isscalar(tile_size) else tile_size
+    if tile_overlap is None:
+        tile_overlap = (min(tile_y, tile_x) // 4) // factor * factor
+    if tile_y % factor != 0 or tile_x % factor != 0 or tile_overlap % factor != 0:
+        raise ValueError('`tile_size` and `tile_overlap` must be divisible by `scale`')
+    if tile_overlap < 0 or 2 * tile_overlap > min(tile_y, tile_x):
+        raise ValueError('`tile_overlap` must be in [0, tile_size / 2]')
+
+    def create_inputs(steps):
+        inputs = _create_inputs_(
+            steps, array_hr, array_lr, upsampling, scale, static_vars, 
+            predictors, time_window, time_metadata, interpolation)
+        return {step: [np.asarray(x[i], dtype='float32') for x in inputs] 
+                for i, step in enumerate(steps)}
+
+    cache = create_inputs([0])
+    height, width = (dim * factor for dim in cache[0][0].shape[-3:-1])
+    origins_y = _tile_origins_(height, tile_y, tile_overlap, factor)
+    origins_x = _tile_origins_(width, tile_x, tile_overlap, factor)
+    weights = blending_weights((tile_y, tile_x), tile_overlap, blending)
+    tiles = [(step, y, x) for step in range(n_samples) 
+             for y in origins_y for x in origins_x]
+
+    # sum of the weights over the (fixed) tiling of the domain
+    weights_sum = np.zeros((height, width), dtype='float32')
+    for y in origins_y:
+        for x in origins_x:
+            weights_sum[y:y + tile_y, x:x + tile_x] += weights
+
+    out = None
+    lr_steps = [cache[0][0]] if return_lr else None
+    for start in range(0, len(tiles), batch_size):
+        batch_tiles = tiles[start:start + batch_size]
+        # full-domain inputs of the time steps in the batch (the ones of the 
+        # previous batch are reused) 
+        steps = sorted(set(step for step, _, _ in batch_tiles))
+        missing = [step for step in steps if step not in cache]
+        if missing:
+            cache.update(create_inputs(missing))
+            if return_lr:
+                lr_steps += [cache[step][0] for step in missing]
+        cache = {step: cache[step] for step in steps}
+
+        inputs = []
+        for i in range(len(cache[steps[0]])):
+            # the first input is at LR for post-upsampling models
+            f = factor if i == 0 else 1
+            inputs.append(np.stack([
+                cache[step][i][..., y // f:(y + tile_y) // f, 
+                               x // f:(x + tile_x) // f, :] 
+                for step, y, x in batch_tiles]))
+        with tf.device('/' + device + ':0'):
+            pred = np.asarray(model.predict_on_batch(inputs))
+
+        if out is None:
+            out = np.zeros((n_samples,) + pred.shape[1:-3] + (height, width, pred.shape[-1]), 
+                           dtype='float32')
+        for (step, y, x), tile in zip(batch_tiles, pred):
+            out[step, ..., y:y + tile_y, x:x + tile_x, :] += tile * weights[:, :, np.newaxis]
+
+    out /= weights_sum[:, :, np.newaxis]
+    if out.ndim == 5 and time_window is not None:
+        out = spatiotemporal_to_spatial_samples(out, time_window)
+    x_test_lr = np.stack(lr_steps) if return_lr else None
+    return out, x_test_lr
+
+
+def _tile_origins_(length, tile_size, overlap, step=1):
+    """ Origins of the tiles covering [0, length) along an axis, with at least
+    ``overlap`` pixels shared by neighbouring tiles. The origins are multiples 
+    of ``step`` (the last tile ends at ``length``).
+    """
+    if tile_size > length:
+        raise ValueError(f'`tile_size` ({tile_size}) is larger than the grid ({length})')
+    stride = tile_size - overlap
+    origins = list(range(0, length - tile_size, stride))
+    return origins + [(length - tile_size) // step * step]
+
+
+def blending_weights(tile_size, overlap, blending='cosine'):
+    """
+    Weights of a tile for blending overlapping tiles. They are one in the 
+    center and taper towards the borders over ``overlap`` pixels, with a 
+    cosine or linear ramp. The ramps of two tiles overlapping by ``overlap`` 
+    pixels sum to one.
+
+    Parameters
+    ----------
+    tile_size : int or tuple of ints
+        Size of the (square if an int is given) tile.
+    overlap : int
+        Number of pixels of the tapering ramps.
+    blending : {'cosine', 'linear'}, optional
+        Shape of the ramps.
+
+    Returns
+    -------
+    weights : 2D ndarray 
+    """
+    if blending not in BLENDING_METHODS:
+        raise ValueError(f'`blending` must be one of {BLENDING_METHODS}')
+    tile_y, tile_x = (tile_size, tile_size) if np.isscalar(tile_size) else tile_size
+    ramp = (np.arange(overlap) + 0.5) / max(overlap, 1)
+    if blending == 'cosine':
+        ramp = 0.5 - 0.5 * np.cos(np.pi * ramp)
+
+    def window(size):
+        window = np.ones(size, dtype='float32')
+        if overlap > 0:
+            window[:overlap] = ramp
+            window[size - overlap:] = ramp[::-1]
+        return window
+
+    return np.outer(window(tile_y), window(tile_x))
+
@@ -163,8 +163,9 @@ class MinMaxScaler(TransformerMixin, BaseEstimator):
             elif isinstance(X, xr.DataArray):
                 X.values[self.nan_mask] = np.nan
 
-        X -= self.min_
-        X /= self.scale_
+        # not in place, a squeezed single time step is broadcast back to the 
+        # shape of the statistics
+        X = (X - self.min_) / self.scale_
         return X
 
     def _more_tags(self):
@@ -328,10 +329,12 @@ class StandardScaler(TransformerMixin, BaseEstimator):
             elif isinstance(X, xr.DataArray):
                 X.values[self.nan_mask] = np.nan
 
+        # not in place, a squeezed single time step is broadcast back to the 
+        # shape of the statistics
         if self.with_std:
-            X *= self.std_
+            X = X * self.std_
         if self.with_mean:
-            X += self.mean_
+            X = X + self.mean_
         return X
 
     def _more_tags(self):
@@ -0,0 +1,551 @@
+"""
+Local model-serving daemon. The trained models are loaded once and kept in
+memory, and the downscaling requests (small regions and time ranges of LR
+data) are sent over HTTP on localhost. Concurrent requests for the same model
+and grid size are merged into dynamic batches, so the throughput scales with
+the concurrency instead of paying the per-request overhead of loading the
+model and running ``Predictor.run``.
+
+Run it with ``dl4ds-serve`` (or ``python -m dl4ds.serve``) and send requests
+with ``dl4ds.serve.request_prediction``. The module is not imported by
+``import dl4ds``.
+"""
+
+import io
+import json
+import time
+import asyncio
+import threading
+import collections
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+import joblib
+from absl import app, flags
+
+from .utils import spatiotemporal_to_spatial_samples, checkarray_ndim
+from .dataloader import create_batch_lr, StaticVarsCache
+from .inference import _inverse_transform_
+
+
+class ModelServer():
+    """
+    Asyncio HTTP server keeping trained models loaded and batching the
+    concurrent requests.
+
+    Endpoints:
+
+    * ``POST /predict/<model>``: the body is a ``.npz`` file (``np.savez``)
+      with the LR grids ``lr`` [n, lat, lon, vars] and, optionally, the
+      ``predictors`` on the same time steps, the ``time`` coordinate (for
+      models with season channels) and the ``offset`` [y, x] of the region on
+      the LR grid of the static variables. The response is the ``.npy`` file
+      (``np.save``) of the HR prediction [n, lat, lon, vars].
+    * ``GET /stats``: JSON with the queue depth, the batch sizes and the
+      latency statistics.
+    * ``GET /models``: JSON with the names of the loaded models.
+
+    The requests of a model with the same input shapes wait in a queue until
+    ``max_batch_size`` samples are gathered or ``max_latency`` seconds have
+    passed since the first one arrived, and are then run as a single batch.
+    """
+    def __init__(
+        self,
+        models,
+        scale,
+        static_vars=None,
+        time_window=None,
+        interpolation='inter_area',
+        scaler=None,
+        max_batch_size=32,
+        max_latency=0.01,
+        host='127.0.0.1',
+        port=8765,
+        device='GPU',
+        region_cache_size=64,
+        max_request_size=256,
+        verbose=True):
+        """
+        Parameters
+        ----------
+        models : dict
+            Names and trained models, given as tf.keras models or paths to
+            SavedModels. The models must share the same domain and scaling
+            factor.
+        scale : int
+            Scaling factor.
+        static_vars : None or list of 2D ndarrays, optional
+            Static variables on the HR grid of the whole domain. The requests
+            use the region given by their ``offset``.
+        time_window : int or None, optional
+            Time window of spatio-temporal models.
+        interpolation : str, optional
+            Interpolation used when creating the model inputs.
+        scaler : None or dl4ds scaler object, optional
+            Scaler for backward scaling the predictions.
+        max_batch_size : int, optional
+            Maximum number of samples in a batch. Requests larger than that are
+            run as a batch on their own.
+        max_latency : float, optional
+            Maximum time (in seconds) a request waits for other requests to be
+            batched with.
+        host : str, optional
+            Host of the server. Localhost by default.
+        port : int, optional
+            Port of the server.
+        device : str, optional
+            Device for the inference, 'GPU' or 'CPU'.
+        region_cache_size : int, optional
+            Number of regions whose static variables are kept in memory.
+        max_request_size : float, optional
+            Maximum size of the body of a request in MB. Larger requests are
+            rejected (413).
+        verbose : bool, optional
+            Verbosity.
+        """
+        self.models = {}
+        for name, model in models.items():
+            if isinstance(model, str):
+                model = tf.keras.models.load_model(model, compile=False)
+            self.models[name] = model
+        self.scale = scale
+        if static_vars is not None:
+            # static variables stacked along the last dimension [lat, lon, vars]
+            static_vars = np.concatenate(
+                [checkarray_ndim(np.squeeze(np.asarray(var)), 3, -1) for var in static_vars],
+                axis=-1).astype('float32')
+        self.static_vars = static_vars
+        self.time_window = time_window
+        self.interpolation = interpolation
+        self.scaler = scaler
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.host = host
+        self.port = port
+        self.device = device
+        self.region_cache_size = region_cache_size
+        self.max_request_size = max_request_size
+        self.verbose = verbose
+
+        # the region cache is used from the threads creating the inputs
+        self._regions = collections.OrderedDict()
+        self._regions_lock = threading.Lock()
+        # queues and batcher tasks of the event loop in use
+        self._loop = None
+        self._queues = {}
+        self._batchers = []
+        # a single thread runs the models, the inputs are created in others
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._n_requests = 0
+        self._n_pending = 0
+        self._n_errors = 0
+        self._batch_sizes = collections.deque(maxlen=1000)
+        self._latencies = collections.deque(maxlen=1000)
+        self._start_time = time.time()
+
+    def _static_vars_(self, upsampling, offset, lr_shape):
+        """ Cached static variables of a region, with its ``offset`` on the LR
+        grid and the ``lr_shape`` of the request.
+        """
+        key = (upsampling, tuple(int(v) for v in offset), tuple(lr_shape))
+        with self._regions_lock:
+            if key in self._regions:
+                self._regions.move_to_end(key)
+                return self._regions[key]
+
+        y0, x0 = (v * self.scale for v in key[1])
+        hr_y, hr_x = lr_shape[0] * self.scale, lr_shape[1] * self.scale
+        if (y0 < 0 or x0 < 0 or y0 + hr_y > self.static_vars.shape[0] or
+            x0 + hr_x > self.static_vars.shape[1]):
+            raise ValueError('The region is outside the domain of the static variables')
+        region = self.static_vars[y0:y0 + hr_y, x0:x0 + hr_x]
+        static_vars = StaticVarsCache(
+            [region[..., i] for i in range(region.shape[-1])], upsampling,
+            self.scale, self.interpolation)
+        with self._regions_lock:
+            self._regions[key] = static_vars
+            self._regions.move_to_end(key)
+            if len(self._regions) > self.region_cache_size:
+                self._regions.popitem(last=False)
+        return static_vars
+
+    def _create_inputs_(self, model_name, lr, predictors=None, time=None,
+                        offset=None):
+        """ Model inputs of a request (see ``dl4ds.create_batch_lr``).
+        """
+        if model_name not in self.models:
+            raise KeyError(f'Unknown model: {model_name}')
+        upsampling = self.models[model_name].name.split('_')[-1]
+        lr = np.asarray(lr)
+        if lr.ndim == 3:
+            lr = lr[..., np.newaxis]
+        if lr.ndim != 4:
+            raise ValueError('`lr` must be given as [n, lat, lon, vars]')
+        n_samples = lr.shape[0]
+        if self.time_window is not None:
+            n_samples -= self.time_window - 1
+        if n_samples < 1:
+            raise ValueError('Not enough time steps for the time window')
+
+        if self.static_vars is not None:
+            offset = (0, 0) if offset is None else offset
+            static_vars = self._static_vars_(upsampling, offset, lr.shape[1:3])
+        else:
+            static_vars = None
+        return create_batch_lr(
+            np.arange(n_samples), lr, upsampling, scale=self.scale,
+            static_vars=static_vars, predictors=predictors,
+            interpolation=self.interpolation, time_window=self.time_window,
+            time_metadata=time)
+
+    def _run_batch_(self, model_name, requests):
+        """ Run the inputs of several requests as a single batch, and split
+        the prediction back into the requests.
+        """
+        inputs = [np.concatenate([inp[i] for inp in requests])
+                  for i in range(len(requests[0]))]
+        with tf.device('/' + self.device + ':0'):
+            out = np.asarray(self.models[model_name].predict_on_batch(inputs))
+        bounds = np.cumsum([0] + [len(inp[0]) for inp in requests])
+        return [out[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def _postprocess_(self, out):
+        """ Spatio-temporal to spatial samples and backward scaling of the
+        prediction of a request.
+        """
+        if out.ndim == 5 and self.time_window is not None:
+            out = spatiotemporal_to_spatial_samples(out, self.time_window)
+        if self.scaler is not None:
+            out = _inverse_transform_(self.scaler, out)
+        return out
+
+    async def predict(self, model_name, lr, predictors=None, time=None,
+                      offset=None):
+        """
+        Downscale the LR grids of a request. Concurrent calls are batched.
+
+        Parameters
+        ----------
+        model_name : str
+            Name of the model.
+        lr : ndarray
+            LR grids [n, lat, lon, vars].
+        predictors : ndarray or None, optional
+            Predictors on the same time steps [n, lat, lon, vars].
+        time : array-like of np.datetime64 or None, optional
+            Time coordinate, for models trained with season channels.
+        offset : tuple of ints or None, optional
+            Position [y, x] of the region on the LR grid of the static
+            variables.
+
+        Returns
+        -------
+        y_hat : ndarray
+            HR prediction [n, lat, lon, vars].
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self._n_requests += 1
+        self._n_pending += 1
+        try:
+            inputs = await loop.run_in_executor(
+                None, self._create_inputs_, model_name, lr, predictors, time,
+                offset)
+            key = (model_name,) + tuple(x.shape[1:] for x in inputs)
+            if self._loop is not loop:
+                # the queues of a previous event loop are not usable anymore
+                self._loop, self._queues, self._batchers = loop, {}, []
+            if key not in self._queues:
+                self._queues[key] = asyncio.Queue()
+                self._batchers.append(loop.create_task(self._batcher_(key)))
+            future = loop.create_future()
+            await self._queues[key].put((start, inputs, future))
+            out = await future
+            out = await loop.run_in_executor(None, self._postprocess_, out)
+        except Exception:
+            self._n_errors += 1
+            raise
+        finally:
+            self._n_pending -= 1
+        self._latencies.append(loop.time() - start)
+        return out
+
+    async def _batcher_(self, key):
+        """ Gather the requests of a queue into batches, run them and hand out
+        the predictions.
+        """
+        loop = asyncio.get_running_loop()
+        queue = self._queues[key]
+        carry = None
+        while True:
+            item = carry if carry is not None else await queue.get()
+            carry = None
+            batch = [item]
+            n = len(item[1][0])
+            deadline = item[0] + self.max_latency
+            while n < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0 and queue.empty():
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    break
+                if n + len(item[1][0]) > self.max_batch_size:
+                    # left for the next batch
+                    carry = item
+                    break
+                batch.append(item)
+                n += len(item[1][0])
+
+            # any failure is handed to the requests of the batch, and the
+            # batcher keeps serving the queue
+            futures = [future for _, _, future in batch]
+            try:
+                outs = await loop.run_in_executor(
+                    self._executor, self._run_batch_, key[0],
+                    [inputs for _, inputs, _ in batch])
+            except asyncio.CancelledError:
+                for future in futures:
+                    future.cancel()
+                raise
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self._batch_sizes.append(n)
+            for future, out in zip(futures, outs):
+                if not future.done():
+                    future.set_result(out)
+
+    def stats(self):
+        """
+        Serving statistics: number of requests, queue depth (requests being
+        processed or waiting to be batched), batch sizes and latencies (in
+        milliseconds, over the last 1000 requests).
+        """
+        latencies = np.asarray(self._latencies) * 1000
+        batch_sizes = np.asarray(self._batch_sizes)
+        stats = dict(
+            n_requests=self._n_requests,
+            n_errors=self._n_errors,
+            queue_depth=self._n_pending,
+            queued_requests=sum(queue.qsize() for queue in self._queues.values()),
+            n_batches=len(batch_sizes),
+            mean_batch_size=float(batch_sizes.mean()) if len(batch_sizes) else 0.0,
+            uptime=time.time() - self._start_time)
+        if len(latencies):
+            stats.update(
+                latency_mean=float(latencies.mean()),
+                latency_p50=float(np.percentile(latencies, 50)),
+                latency_p95=float(np.percentile(latencies, 95)),
+                latency_max=float(latencies.max()))
+        return stats
+
+    async def _handle_(self, reader, writer):
+        """ Handle an HTTP request (one per connection).
+        """
+        try:
+            status, body, content_type = await self._respond_(reader)
+        except Exception as e:
+            status, body, content_type = 500, json.dumps({'error': str(e)}).encode(), 'application/json'
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                   413: 'Payload Too Large', 500: 'Internal Server Error'}
+        header = (f'HTTP/1.1 {status} {reasons.get(status, "")}\r\n'
+                  f'Content-Type: {content_type}\r\n'
+                  f'Content-Length: {len(body)}\r\n'
+                  'Connection: close\r\n\r\n')
+        writer.write(header.encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _respond_(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) < 2:
+            return 400, b'{"error": "Malformed request"}', 'application/json'
+        method, path = request_line[0], request_line[1]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        def as_json(obj, status=200):
+            return status, json.dumps(obj).encode(), 'application/json'
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return as_json({'error': 'Invalid Content-Length'}, 400)
+        if length > self.max_request_size * 2 ** 20:
+            return as_json({'error': f'The request is larger than {self.max_request_size} MB'}, 413)
+        body = await reader.readexactly(length)
+        loop = asyncio.get_running_loop()
+
+        if method == 'GET' and path == '/stats':
+            return as_json(self.stats())
+        if method == 'GET' and path == '/models':
+            return as_json(list(self.models))
+        if method == 'POST' and path.startswith('/predict/'):
+            model_name = path[len('/predict/'):]
+            if model_name not in self.models:
+                return as_json({'error': f'Unknown model: {model_name}'}, 404)
+            try:
+                request = await loop.run_in_executor(None, _decode_request_, body)
+                out = await self.predict(
+                    model_name, request['lr'], request.get('predictors'),
+                    request.get('time'), request.get('offset'))
+            except (ValueError, KeyError, OSError) as e:
+                return as_json({'error': str(e)}, 400)
+            body = await loop.run_in_executor(None, _encode_array_, out)
+            return 200, body, 'application/octet-stream'
+        return as_json({'error': f'Not found: {method} {path}'}, 404)
+
+    async def serve(self):
+        """ Start the server and serve until cancelled.
+        """
+        server = await asyncio.start_server(self._handle_, self.host, self.port)
+        if self.verbose:
+            print(f'Serving {list(self.models)} on http://{self.host}:{self.port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in self._batchers:
+                task.cancel()
+
+    def run(self):
+        """ Run the server (blocking).
+        """
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._executor.shutdown()
+
+
+def _decode_request_(body):
+    """ Arrays of a request, sent as a ``.npz`` file.
+    """
+    with np.load(io.BytesIO(body), allow_pickle=False) as data:
+        request = {key: data[key] for key in data.files}
+    if 'lr' not in request:
+        raise ValueError('The request must contain the `lr` array')
+    return request
+
+
+def _encode_array_(array):
+    """ ``.npy`` file of an array, as bytes.
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(array, dtype='float32'), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def request_prediction(
+    model_name,
+    lr,
+    predictors=None,
+    time=None,
+    offset=None,
+    host='127.0.0.1',
+    port=8765,
+    timeout=60):
+    """
+    Send a downscaling request to a ``dl4ds.serve.ModelServer``.
+
+    Parameters
+    ----------
+    model_name : str
+        Name of the model.
+    lr : ndarray
+        LR grids [n, lat, lon, vars].
+    predictors : ndarray or None, optional
+        Predictors on the same time steps [n, lat, lon, vars].
+    time : array-like of np.datetime64 or None, optional
+        Time coordinate, for models trained with season channels.
+    offset : tuple of ints or None, optional
+        Position [y, x] of the region on the LR grid of the static variables.
+    host, port : str and int, optional
+        Address of the server.
+    timeout : float, optional
+        Timeout of the request in seconds.
+
+    Returns
+    -------
+    y_hat : ndarray
+        HR prediction [n, lat, lon, vars].
+    """
+    arrays = dict(lr=np.asarray(lr, dtype='float32'))
+    if predictors is not None:
+        arrays['predictors'] = np.asarray(predictors, dtype='float32')
+    if time is not None:
+        arrays['time'] = np.asarray(time, dtype='datetime64[ns]')
+    if offset is not None:
+        arrays['offset'] = np.asarray(offset, dtype='int64')
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    request = urllib.request.Request(
+        f'http://{host}:{port}/predict/{model_name}', data=buffer.getvalue(),
+        headers={'Content-Type': 'application/octet-stream'}, method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return np.load(io.BytesIO(response.read()), allow_pickle=False)
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f'The server returned {e.code}: {e.read().decode()}') from None
+
+
+def main():
+    """ ``dl4ds-serve`` command line entry point.
+    """
+    flags.DEFINE_multi_string('model', None, 'Model to serve, as name=path to the SavedModel (can be repeated)')
+    flags.DEFINE_integer('scale', None, 'Scaling factor')
+    flags.DEFINE_string('static_vars_path', None, 'Path to a .npy file with the HR static variables of the domain [lat, lon, vars]')
+    flags.DEFINE_integer('time_window', None, 'Time window of spatio-temporal models')
+    flags.DEFINE_string('interpolation', 'inter_area', 'Interpolation used when creating the model inputs')
+    flags.DEFINE_string('scaler_path', None, 'Path to a joblib file with the scaler for backward scaling the predictions')
+    flags.DEFINE_integer('max_batch_size', 32, 'Maximum number of samples in a batch')
+    flags.DEFINE_float('max_latency_ms', 10, 'Maximum time (ms) a request waits to be batched with others')
+    flags.DEFINE_string('host', '127.0.0.1', 'Host of the server')
+    flags.DEFINE_integer('port', 8765, 'Port of the server')
+    flags.DEFINE_string('device', 'GPU', 'Device for the inference, GPU or CPU')
+    flags.DEFINE_float('max_request_size', 256, 'Maximum size (MB) of the body of a request')
+    flags.mark_flags_as_required(['model', 'scale'])
+    FLAGS = flags.FLAGS
+
+    def serve(argv):
+        models = dict(model.split('=', 1) for model in FLAGS.model)
+        if FLAGS.static_vars_path is not None:
+            static_vars = np.load(FLAGS.static_vars_path)
+            static_vars = [static_vars[..., i] for i in range(static_vars.shape[-1])]
+        else:
+            static_vars = None
+        scaler = joblib.load(FLAGS.scaler_path) if FLAGS.scaler_path is not None else None
+        server = ModelServer(
+            models,
+            scale=FLAGS.scale,
+            static_vars=static_vars,
+            time_window=FLAGS.time_window,
+            interpolation=FLAGS.interpolation,
+            scaler=scaler,
+            max_batch_size=FLAGS.max_batch_size,
+            max_latency=FLAGS.max_latency_ms / 1000,
+            host=FLAGS.host,
+            port=FLAGS.port,
+            device=FLAGS.device,
+            max_request_size=FLAGS.max_request_size)
+        server.run()
+
+    app.run(serve)
+
+
+if __name__ == '__main__':
+    main()
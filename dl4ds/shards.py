@@ -0,0 +1,418 @@
+"""
+Sharded on-disk format for the training data. The data preparation (reading
+netCDF files, scaling, coarsening the HR grids, etc) is done once, and the
+result is stored as ``.npy`` shards of ``shard_size`` time steps plus a JSON
+index. The shards are read as memory-maps, so experiments start without
+re-deriving the paired samples and the reads are sequential and cheap.
+"""
+
+import os
+import json
+import numpy as np
+import xarray as xr
+
+from . import preprocessing
+from .utils import resize_array, checkarg_storage_dtype, _numpy_dtype_
+from .dataloader import LazyArray
+
+
+SHARDS_FORMAT_VERSION = 1
+SHARDS_SPLITS = ['train', 'val', 'test', 'inference', 'holdout']
+
+
+def create_shards(
+    path,
+    splits,
+    static_vars=None,
+    mask=None,
+    scaler=None,
+    scale=None,
+    interpolation='inter_area',
+    precompute_lr=True,
+    nan_aware=False,
+    shard_size=256,
+    dtype=None,
+    verbose=True):
+    """
+    Convert HR, LR, predictor and static inputs into a sharded dataset. Each
+    array is written as ``.npy`` shards of ``shard_size`` time steps, in
+    ``path/<split>/<array>/``, and described in ``path/index.json``.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the sharded dataset.
+    splits : dict
+        Data of each split, as a dictionary with keys in ['train', 'val',
+        'test', 'inference', 'holdout']. The values are dictionaries with the
+        keys 'data' (HR data, or the array to be downscaled for 'inference'),
+        and optionally 'data_lr' (LR data) and 'predictors' (list of
+        predictors). The arrays are np.ndarrays, xr.DataArrays (dims and
+        coordinates are stored as well) or ``dl4ds.LazyArray`` objects.
+    static_vars : None or list of 2D ndarrays, optional
+        Static variables such as elevation data or a binary land-ocean mask.
+    mask : None, 2D ndarray or xr.DataArray, optional
+        Mask used when computing the verification metrics.
+    scaler : None or dl4ds scaler object, optional
+        Fitted scaler (e.g., ``dl4ds.StandardScaler``), its parameters are
+        stored for restoring the original distribution at inference.
+    scale : int or None, optional
+        Scaling factor. Needed when ``precompute_lr`` is True.
+    interpolation : str, optional
+        Interpolation used when coarsening the HR data.
+    precompute_lr : bool, optional
+        If True, the LR data of the 'train', 'val' and 'test' splits without
+        'data_lr' is precomputed by coarsening the HR data (as with
+        ``dl4ds.create_lr_cache``).
+    nan_aware : bool, optional
+        If True, missing values (NaNs) are ignored when coarsening the HR data.
+    shard_size : int, optional
+        Number of time steps per shard.
+    dtype : str or None, optional
+        Data type of the stored arrays ('float32', 'float16' or 'bfloat16').
+        If None, the arrays keep their dtype.
+    verbose : bool, optional
+        Verbosity.
+
+    Returns
+    -------
+    index : dict
+        Index of the sharded dataset.
+    """
+    for split in splits:
+        if split not in SHARDS_SPLITS:
+            msg = f'`splits` keys must be in {SHARDS_SPLITS}, got {split}'
+            raise ValueError(msg)
+        if splits[split].get('data') is None:
+            raise ValueError(f"The split '{split}' must contain 'data'")
+    if precompute_lr and scale is None:
+        raise ValueError('`scale` must be given when `precompute_lr` is True')
+    if shard_size < 1:
+        raise ValueError('`shard_size` must be positive')
+    dtype = checkarg_storage_dtype(dtype)
+    os.makedirs(path, exist_ok=True)
+
+    index = dict(
+        format_version=SHARDS_FORMAT_VERSION,
+        scale=scale,
+        interpolation=interpolation,
+        shard_size=shard_size,
+        splits={})
+    for split, arrays in splits.items():
+        split_path = os.path.join(path, split)
+        os.makedirs(split_path, exist_ok=True)
+        data = arrays['data']
+        split_index = dict(arrays={})
+        split_index['arrays']['hr'] = _write_array_shards_(
+            os.path.join(split_path, 'hr'), data, shard_size, dtype)
+        if arrays.get('data_lr') is not None:
+            split_index['arrays']['lr'] = _write_array_shards_(
+                os.path.join(split_path, 'lr'), arrays['data_lr'], shard_size, dtype)
+            split_index['arrays']['lr']['kind'] = 'explicit'
+        elif precompute_lr and split in ['train', 'val', 'test']:
+            split_index['arrays']['lr'] = _write_array_shards_(
+                os.path.join(split_path, 'lr'), data, shard_size, dtype,
+                coarsen=(scale, interpolation, nan_aware))
+            split_index['arrays']['lr']['kind'] = 'coarsened'
+        if arrays.get('predictors') is not None:
+            split_index['n_predictors'] = len(arrays['predictors'])
+            for i, pred in enumerate(arrays['predictors']):
+                split_index['arrays'][f'predictors_{i}'] = _write_array_shards_(
+                    os.path.join(split_path, f'predictors_{i}'), pred, shard_size, dtype)
+        # dims and coordinates of xr.DataArrays
+        if isinstance(data, xr.DataArray):
+            split_index['dims'] = list(data.dims)
+            # without the dtype metadata of pandas-backed coordinates
+            coords = {dim: data[dim].values.astype(data[dim].dtype.str)
+                      for dim in data.dims if dim in data.coords}
+            np.savez(os.path.join(split_path, 'coords.npz'), **coords)
+            split_index['coords'] = list(coords)
+        index['splits'][split] = split_index
+        if verbose:
+            print(f"Split '{split}': {', '.join(split_index['arrays'])}")
+
+    if static_vars is not None:
+        for i, var in enumerate(static_vars):
+            var = var.values if isinstance(var, xr.DataArray) else np.asarray(var)
+            np.save(os.path.join(path, f'static_{i}.npy'), var)
+        index['n_static_vars'] = len(static_vars)
+    if mask is not None:
+        mask = mask.values if isinstance(mask, xr.DataArray) else np.asarray(mask)
+        np.save(os.path.join(path, 'mask.npy'), mask)
+        index['mask'] = True
+    if scaler is not None:
+        index['scaler'] = _save_scaler_(scaler, os.path.join(path, 'scaler.npz'))
+
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    if verbose:
+        print(f'Sharded dataset created in {path}')
+    return index
+
+
+def _write_array_shards_(path, array, shard_size, dtype=None, coarsen=None):
+    """Write ``array`` as ``.npy`` shards along the first dimension. If
+    ``coarsen`` is given as (scale, interpolation, nan_aware), the coarsened
+    array is written instead.
+    """
+    n = array.shape[0]
+    if n == 0:
+        raise ValueError(f'Cannot write the shards of an empty array ({path})')
+    os.makedirs(path, exist_ok=True)
+    n_shards = 0
+    for start in range(0, n, shard_size):
+        chunk = array[start: start + shard_size]
+        chunk = chunk.values if isinstance(chunk, xr.DataArray) else np.asarray(chunk)
+        if coarsen is not None:
+            scale, interpolation, nan_aware = coarsen
+            lr_x, lr_y = int(chunk.shape[2] / scale), int(chunk.shape[1] / scale)
+            chunk = resize_array(chunk, (lr_x, lr_y), interpolation, squeezed=False,
+                                 nan_aware=nan_aware)
+        if dtype is not None:
+            chunk = chunk.astype(_numpy_dtype_(dtype), copy=False)
+        stored_dtype = chunk.dtype.name
+        if stored_dtype == 'bfloat16':
+            # not a native numpy type, stored as raw bytes (see ShardedArray)
+            chunk = chunk.view('V2')
+        np.save(os.path.join(path, f'{n_shards:05d}.npy'), chunk)
+        n_shards += 1
+    return dict(shape=[n] + list(chunk.shape[1:]), dtype=stored_dtype,
+                n_shards=n_shards)
+
+
+def _save_scaler_(scaler, filename):
+    """Store the fitted attributes of a scaler (``.npz``), and return its class
+    and parameters.
+    """
+    attrs = {k: np.asarray(v) for k, v in vars(scaler).items()
+             if k.endswith('_') or k == 'nan_mask'}
+    np.savez(filename, **attrs)
+    return dict(cls=type(scaler).__name__, params=_to_json_(scaler.get_params()))
+
+
+def _load_scaler_(info, filename):
+    """Restore a scaler saved with ``_save_scaler_``.
+    """
+    scaler = getattr(preprocessing, info['cls'])(**info['params'])
+    with np.load(filename) as attrs:
+        for k in attrs.files:
+            value = attrs[k]
+            setattr(scaler, k, value.item() if value.ndim == 0 else value)
+    return scaler
+
+
+def _to_json_(params):
+    """JSON-compatible version of the parameters of a scaler.
+    """
+    return {k: list(v) if isinstance(v, tuple) else v for k, v in params.items()}
+
+
+class ShardedArray():
+    """
+    Read-only array stored as ``.npy`` shards along the first dimension (see
+    ``dl4ds.create_shards``). The shards are opened as memory-maps, and basic
+    slicing only reads the shards overlapping the requested time steps. It can
+    be wrapped in a ``dl4ds.LazyArray`` (lazy loading in ``DataGenerator``), or
+    converted to a np.ndarray.
+    """
+    def __init__(self, path, dtype=None):
+        """
+        Parameters
+        ----------
+        path : str
+            Directory with the shards of the array.
+        dtype : str or None, optional
+            Stored data type. Only needed for 'bfloat16', which is not a native
+            numpy type (the shards are read as raw bytes and viewed as
+            bfloat16).
+        """
+        self.path = path
+        self.stored_dtype = dtype
+        self._open_()
+
+    def _open_(self):
+        fnames = sorted(f for f in os.listdir(self.path) if f.endswith('.npy'))
+        if not fnames:
+            raise ValueError(f'No shards found in {self.path}')
+        self._shards = [np.load(os.path.join(self.path, f), mmap_mode='r') for f in fnames]
+        if self.stored_dtype == 'bfloat16':
+            bfloat16 = _numpy_dtype_('bfloat16')
+            self._shards = [shard.view(bfloat16) for shard in self._shards]
+        self._offsets = np.cumsum([0] + [len(shard) for shard in self._shards])
+        self.dtype = self._shards[0].dtype
+        self.shape = (int(self._offsets[-1]),) + self._shards[0].shape[1:]
+        # a shard is a chunk along the first dimension (as in zarr)
+        self.chunks = (len(self._shards[0]),) + self.shape[1:]
+
+    def __getstate__(self):
+        # the shards are re-opened (not pickled) in other processes
+        state = self.__dict__.copy()
+        del state['_shards'], state['dtype']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, (int, np.integer)):
+            if first < 0:
+                first += len(self)
+            i = np.searchsorted(self._offsets, first, side='right') - 1
+            return np.asarray(self._shards[i][(first - self._offsets[i],) + rest])
+        if not isinstance(first, slice) or (first.step not in [None, 1]):
+            # advanced indexing, the data is read and then indexed
+            return np.asarray(self)[key]
+        start, stop, _ = first.indices(len(self))
+        parts = []
+        for i, shard in enumerate(self._shards):
+            lo, hi = self._offsets[i], self._offsets[i + 1]
+            if hi <= start or lo >= stop:
+                continue
+            parts.append(shard[(slice(max(start, lo) - lo, min(stop, hi) - lo),) + rest])
+        if not parts:
+            return np.asarray(self._shards[0][(slice(0, 0),) + rest])
+        return np.concatenate(parts, axis=0)
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.concatenate(self._shards, axis=0)
+        if dtype is not None:
+            array = array.astype(dtype, copy=False)
+        return array
+
+    def __repr__(self):
+        return f'ShardedArray(shape={self.shape}, dtype={self.dtype}, n_shards={len(self._shards)})'
+
+
+class ShardedDataset():
+    """
+    Sharded dataset created with ``dl4ds.create_shards``. The arrays are
+    exposed with the names used by the data modules of the command line app
+    (``data_train``, ``data_train_lr``, ``predictors_train``, ...,
+    ``static_vars``, ``inference_data``, ``inference_predictors``,
+    ``inference_scaler``, ``gt_holdout_dataset`` and ``gt_mask``), so that they
+    can be passed directly to ``dl4ds.DataGenerator``, ``dl4ds.SupervisedTrainer``
+    or ``dl4ds.CGANTrainer``. Missing arrays are None.
+    """
+    def __init__(self, path, lazy=False):
+        """
+        Parameters
+        ----------
+        path : str
+            Directory of the sharded dataset.
+        lazy : bool, optional
+            If True, the HR, LR and predictor arrays of the 'train', 'val' and
+            'test' splits are ``dl4ds.LazyArray`` objects reading only the
+            needed shards (to be used with ``lazy_loading``). Otherwise, they
+            are loaded in memory, as xr.DataArrays when coordinates were stored.
+        """
+        self.path = path
+        self.lazy = lazy
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        if self.index.get('format_version', 0) > SHARDS_FORMAT_VERSION:
+            msg = f'Unsupported format version {self.index["format_version"]}'
+            raise ValueError(msg)
+        self.scale = self.index.get('scale')
+        self.interpolation = self.index.get('interpolation')
+
+        for split in ['train', 'val', 'test']:
+            data, data_lr, predictors = self._load_split_(split, lazy)
+            setattr(self, f'data_{split}', data)
+            setattr(self, f'data_{split}_lr', data_lr)
+            setattr(self, f'predictors_{split}', predictors)
+        self.inference_data, _, self.inference_predictors = self._load_split_('inference')
+        self.gt_holdout_dataset, _, _ = self._load_split_('holdout')
+
+        n_static = self.index.get('n_static_vars')
+        if n_static is not None:
+            self.static_vars = [np.load(os.path.join(path, f'static_{i}.npy'))
+                                for i in range(n_static)]
+        else:
+            self.static_vars = None
+        if self.index.get('mask', False):
+            self.gt_mask = np.load(os.path.join(path, 'mask.npy'))
+        else:
+            self.gt_mask = None
+        if 'scaler' in self.index:
+            self.inference_scaler = _load_scaler_(self.index['scaler'],
+                                                  os.path.join(path, 'scaler.npz'))
+        else:
+            self.inference_scaler = None
+
+    def lr_kind(self, split='train'):
+        """Kind of the LR data of a split: 'explicit' (given LR data),
+        'coarsened' (precomputed from the HR data) or None.
+        """
+        split_index = self.index['splits'].get(split)
+        if split_index is None or 'lr' not in split_index['arrays']:
+            return None
+        return split_index['arrays']['lr']['kind']
+
+    def time(self, split):
+        """Time coordinate of a split (e.g., for the season channels of lazily
+        loaded data, which has no coordinates), or None if it was not stored.
+        """
+        split_index = self.index['splits'].get(split)
+        if split_index is None or 'time' not in split_index.get('coords', []):
+            return None
+        with np.load(os.path.join(self.path, split, 'coords.npz')) as coords:
+            return xr.DataArray(coords['time'], dims='time', name='time')
+
+    def open_array(self, split, name):
+        """Open the array ``name`` ('hr', 'lr' or 'predictors_<i>') of a split
+        as a ``dl4ds.ShardedArray``.
+        """
+        info = self.index['splits'][split]['arrays'][name]
+        return ShardedArray(os.path.join(self.path, split, name), dtype=info['dtype'])
+
+    def _load_split_(self, split, lazy=False):
+        split_index = self.index['splits'].get(split)
+        if split_index is None:
+            return None, None, None
+
+        def load(name, is_data=False):
+            if name not in split_index['arrays']:
+                return None
+            array = self.open_array(split, name)
+            if lazy:
+                return LazyArray(array)
+            array = np.asarray(array)
+            if is_data and 'dims' in split_index:
+                with np.load(os.path.join(self.path, split, 'coords.npz')) as coords:
+                    coords = {k: coords[k] for k in coords.files}
+                array = xr.DataArray(array, dims=split_index['dims'], coords=coords)
+            return array
+
+        data = load('hr', is_data=True)
+        data_lr = load('lr')
+        if 'n_predictors' in split_index:
+            predictors = [load(f'predictors_{i}') for i in range(split_index['n_predictors'])]
+        else:
+            predictors = None
+        return data, data_lr, predictors
+
+
+def load_shards(path, lazy=False):
+    """
+    Open a sharded dataset created with ``dl4ds.create_shards``. See
+    ``dl4ds.ShardedDataset``.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the sharded dataset.
+    lazy : bool, optional
+        If True, the training, validation and test arrays are read lazily.
+    """
+    return ShardedDataset(path, lazy=lazy)
@@ -17,6 +17,7 @@ try:
 except ImportError:
     has_horovod = False
 
+from ..dataloader import LazyArray
 from ..utils import (list_devices, set_gpu_memory_growth, plot_history, checkarg_loss,
                      set_visible_gpus, check_compatibility_upsbackb)
 
@@ -48,16 +49,16 @@ class Trainer(ABC):
         """
         # checking training data split (both hr and lr)
         self.data_train = data_train
-        if not isinstance(self.data_train, (xr.DataArray, np.ndarray)):
-            msg = '`data_train` object must be of np.ndarray or xr.DataArray type'
+        if not isinstance(self.data_train, (xr.DataArray, np.ndarray, LazyArray)):
+            msg = '`data_train` object must be of np.ndarray, xr.DataArray or dl4ds.LazyArray type'
             raise TypeError(msg)
         if not self.data_train.ndim > 3:
             msg = '`data_train` must be at least 4D [samples, lat, lon, variables]'
             raise ValueError(msg)
         self.data_train_lr = data_train_lr
         if self.data_train_lr is not None:
-            if not isinstance(self.data_train_lr, (xr.DataArray, np.ndarray)):
-                msg = '`data_train_lr` must be a np.ndarray or xr.DataArray object'
+            if not isinstance(self.data_train_lr, (xr.DataArray, np.ndarray, LazyArray)):
+                msg = '`data_train_lr` must be a np.ndarray, xr.DataArray or dl4ds.LazyArray object'
                 raise TypeError(msg)
             if self.data_train_lr.shape[0] != self.data_train.shape[0]:
                 msg = '`data_train_lr` and `data_train` must contain '
@@ -131,6 +132,11 @@ class Trainer(ABC):
             self.running_on_first_worker = True
         else:
             self.running_on_first_worker = False
+        # rank and number of Horovod workers, each one trains on a shard of the data
+        if has_horovod:
+            self.rank, self.n_workers = hvd.rank(), hvd.size()
+        else:
+            self.rank, self.n_workers = 0, 1
         
         ### Checking scale wrt image size
         if self.patch_size is not None: 
@@ -3,6 +3,7 @@ Training procedure for Conditional GAN models. Follows Isola et al. 2016
 """
 
 import os
+import time
 import datetime
 import numpy as np
 import xarray as xr
@@ -17,8 +18,11 @@ try:
 except ImportError:
     has_horovod = False
 
-from ..utils import Timing
-from ..dataloader import create_batch_hr_lr
+from ..utils import Timing, checkarg_storage_dtype
+from ..dataloader import (create_batch_hr_lr, create_lr_cache, StaticVarsCache, 
+                          EpochSampler, FrameCache, create_season_table, 
+                          get_shard_range, PatchSampler, _rank_seed_, 
+                          augment_batch, estimate_echo_factor, LazyArray)
 from ..models import (net_pin, recnet_pin, net_postupsampling, 
                      recnet_postupsampling, residual_discriminator)
 from ..models import (net_postupsampling, recnet_postupsampling, net_pin, 
@@ -53,6 +57,18 @@ class CGANTrainer(Trainer):
         steps_per_epoch=None,
         interpolation='inter_area', 
         static_vars=None,
+        lr_cache=False,
+        lr_cache_dtype='float32',
+        lr_cache_path=None,
+        lr_cache_max_memory=None,
+        seed=None,
+        frame_cache_size=None,
+        storage_dtype=None,
+        use_season=False,
+        patch_mask=None,
+        patch_min_valid=0.5,
+        data_echoing=None,
+        echo_augment=False,
         checkpoints_frequency=0, 
         save=False,
         save_path=None,
@@ -72,11 +88,13 @@ class CGANTrainer(Trainer):
         upsampling : str
             String with the name of the upsampling method used for the CGAN 
             generator.
-        data_train : 4D ndarray or xr.DataArray
+        data_train : 4D ndarray, xr.DataArray or dl4ds.LazyArray
             Training dataset with dims [nsamples, lat, lon, 1]. These grids must 
             correspond to the observational reference at HR, from which a 
-            coarsened version will be created to produce paired samples. 
-        data_test : 4D ndarray or xr.DataArray
+            coarsened version will be created to produce paired samples. Lazy
+            arrays (e.g., from ``dl4ds.load_shards``) are read in memory when 
+            the training starts.
+        data_test : 4D ndarray, xr.DataArray or dl4ds.LazyArray
             Testing dataset with dims [nsamples, lat, lon, 1]. Holdout not used
             during training, but only to compute metrics with the final model.
         predictors_train : list of ndarray, optional
@@ -105,6 +123,54 @@ class CGANTrainer(Trainer):
             generator and the discriminator (in that order).
         static_vars : None or list of 2D ndarrays, optional
             Static variables such as elevation data or a binary land-ocean mask.
+        lr_cache : bool, optional
+            If True, for implicit pairs (``data_train_lr`` is None) the HR 
+            training data is coarsened once at setup and the LR patches are 
+            cropped from the cached LR array, instead of coarsening each sample
+            in every epoch.
+        lr_cache_dtype : str, optional
+            Data type of the LR cache, e.g. 'float32' or 'float16'.
+        lr_cache_path : str or None, optional
+            If not None, directory where the LR cache is stored on disk 
+            (``.npy`` memory-map, one per Horovod rank).
+        lr_cache_max_memory : float or None, optional
+            Maximum size of the in-memory LR cache in GB. When exceeded, the LR
+            arrays are coarsened on the fly.
+        seed : int or None, optional
+            Seed for shuffling the training samples (every epoch) and drawing
+            the crop positions of each batch. See ``dl4ds.EpochSampler``.
+        frame_cache_size : int or None, optional
+            If not None, maximum number of preprocessed training frames (e.g., 
+            coarsened or interpolated grids) cached and reused across samples
+            and epochs. See ``dl4ds.FrameCache``.
+        storage_dtype : str or None, optional
+            Data type in which the training data and predictors are kept in 
+            memory, e.g. 'float16' or 'bfloat16' for halving the resident 
+            memory. Batches are upcast to float32. If None, the arrays keep 
+            their dtype.
+        use_season : bool, optional
+            If True, the season of each sample is fed to the generator as 
+            one-hot channels (4 auxiliary channels, also concatenated to the LR
+            input of spatial models). ``data_train`` and ``data_test`` must be
+            xr.DataArrays with a time coordinate.
+        patch_mask : None, int or 2D ndarray, optional
+            If not None (and ``patch_size`` is given), the training patches are
+            only cropped where the fraction of valid pixels of the mask is at 
+            least ``patch_min_valid``. The mask is a 2D array on the HR grid 
+            (zero or NaN pixels are invalid), or the index of the static 
+            variable used as mask. See ``dl4ds.PatchSampler``.
+        patch_min_valid : float, optional
+            Minimum fraction of valid pixels in a patch, in [0, 1].
+        data_echoing : None, int or 'auto', optional
+            If not None, each training batch is reused for ``data_echoing`` 
+            consecutive training steps (data echoing). If 'auto', the echo 
+            factor is chosen from the times of creating a batch and of a 
+            training step, measured during the first steps.
+        echo_augment : bool, optional
+            If True, the echoed batches are re-augmented with random flips and
+            transposes (of square grids). Off by default, geolocated fields are
+            not invariant to these transformations. Not allowed with a 
+            ``localcon_layer``. See ``dl4ds.augment_batch``.
         checkpoints_frequency : int, optional
             The training loop saves a checkpoint every ``checkpoints_frequency`` 
             epochs. If None, then no checkpoints are saved during training. 
@@ -155,11 +221,35 @@ class CGANTrainer(Trainer):
             for i in range(len(self.static_vars)):
                 if isinstance(self.static_vars[i], xr.DataArray):
                     self.static_vars[i] = self.static_vars[i].values
+        self.lr_cache = lr_cache
+        self.lr_cache_dtype = lr_cache_dtype
+        self.lr_cache_path = lr_cache_path
+        self.lr_cache_max_memory = lr_cache_max_memory
+        self.seed = seed
+        self.frame_cache_size = frame_cache_size
+        self.storage_dtype = checkarg_storage_dtype(storage_dtype)
+        self.use_season = use_season
+        self.patch_mask = patch_mask
+        self.patch_min_valid = patch_min_valid
+        self.data_echoing = data_echoing
+        if self.data_echoing is not None and self.data_echoing != 'auto':
+            if not isinstance(self.data_echoing, int) or self.data_echoing < 1:
+                raise ValueError("`data_echoing` must be a positive int or 'auto'")
+        self.echo_augment = echo_augment
+        if self.use_season:
+            for data in [self.data_train, self.data_test]:
+                if not isinstance(data, xr.DataArray) or 'time' not in data.coords:
+                    msg = 'With `use_season`, the data must be xr.DataArrays with a time coordinate'
+                    raise TypeError(msg)
         self.checkpoints_frequency = checkpoints_frequency
         self.save_loss_history = save_loss_history
         self.save_logs = save_logs
         self.generator_params = generator_params
         self.discriminator_params = discriminator_params
+        if self.data_echoing is not None and self.echo_augment:
+            if self.generator_params.get('localcon_layer', False):
+                msg = '`echo_augment` cannot be used with a locally connected layer'
+                raise ValueError(msg)
         self.gentotal = []
         self.gengan = []
         self.gen_pxloss = []
@@ -191,6 +281,11 @@ class CGANTrainer(Trainer):
                 n_aux_channels = len(self.static_vars)
             if self.predictors_train is not None:
                 n_channels += len(self.predictors_train)
+        # one-hot season channels
+        if self.use_season:
+            n_aux_channels += 4
+            if not self.model_is_spatiotemporal:
+                n_channels += 4
         
         if self.patch_size is None:
             lr_height = int(self.data_train.shape[1] / self.scale)
@@ -291,6 +386,26 @@ class CGANTrainer(Trainer):
                                              discriminator_optimizer=discriminator_optimizer,
                                              generator=self.generator, discriminator=self.discriminator)   
 
+        # with Horovod, each worker trains on a disjoint shard (time range) of 
+        # the training data, reshuffled every epoch with its own seed
+        seed = self.seed
+        if self.n_workers > 1:
+            n_samples = self.data_train.shape[0] - (self.time_window if self.time_window is not None else 0)
+            time_range = get_shard_range(n_samples, self.rank, self.n_workers, self.time_window)
+            self.data_train = self.data_train[time_range]
+            if self.data_train_lr is not None:
+                self.data_train_lr = self.data_train_lr[time_range]
+            if self.predictors_train is not None:
+                self.predictors_train = [pred[time_range] for pred in self.predictors_train]
+            seed = _rank_seed_(self.seed, self.rank)
+
+        # the training loop works on in-memory arrays, lazily loaded data (e.g.,
+        # a sharded dataset) is read once (only the shard of this worker)
+        self.data_train = _in_memory_(self.data_train)
+        self.data_train_lr = _in_memory_(self.data_train_lr)
+        if self.predictors_train is not None:
+            self.predictors_train = [_in_memory_(pred) for pred in self.predictors_train]
+
         # creating a single ndarray concatenating list of ndarray predictors along the last dimension 
         if self.predictors_train is not None:
             self.predictors_train = np.concatenate(self.predictors_train, axis=-1)
@@ -302,17 +417,82 @@ class CGANTrainer(Trainer):
             self.n = self.data_train.shape[0] - self.time_window
         else:
             self.n = self.data_train.shape[0]
-        self.indices_train = np.random.permutation(np.arange(self.n))
+        self.sampler_train = EpochSampler(self.n, seed=seed)
 
         if self.steps_per_epoch is None:
             self.steps_per_epoch = int(self.n / self.batch_size)
+        elif self.n_workers > 1:
+            self.steps_per_epoch = self.steps_per_epoch // self.n_workers
+
+        # the seasons of the samples are encoded once
+        if self.use_season:
+            season_table_train = create_season_table(self.data_train.time, self.time_window)
+        else:
+            season_table_train = None
 
         if isinstance(self.data_train, xr.DataArray):
-            # self.time_metadata = self.data_train.time.copy()  # get time metadata
             self.data_train = self.data_train.values
         if isinstance(self.data_train_lr, xr.DataArray):
             self.data_train_lr = self.data_train_lr.values
 
+        # training arrays stored in reduced precision (batches are float32)
+        if self.storage_dtype is not None:
+            self.data_train = self.data_train.astype(self.storage_dtype, copy=False)
+            if self.data_train_lr is not None:
+                self.data_train_lr = self.data_train_lr.astype(self.storage_dtype, copy=False)
+            if self.predictors_train is not None:
+                self.predictors_train = self.predictors_train.astype(self.storage_dtype, copy=False)
+
+        # coarsening once the whole training array for implicit pairs
+        data_train_lr = self.data_train_lr
+        if self.lr_cache and self.data_train_lr is None:
+            if self.lr_cache_path is not None:
+                os.makedirs(self.lr_cache_path, exist_ok=True)
+                lr_cache_fname = os.path.join(self.lr_cache_path, f'lr_cache_train_r{self.rank}.npy')
+            else:
+                lr_cache_fname = None
+            data_train_lr = create_lr_cache(
+                self.data_train, 
+                self.scale, 
+                self.interpolation, 
+                dtype=self.lr_cache_dtype, 
+                max_memory=self.lr_cache_max_memory, 
+                save_path=lr_cache_fname, 
+                verbose=self.verbose)
+
+        if self.frame_cache_size is not None:
+            frame_cache = FrameCache(self.frame_cache_size)
+        else:
+            frame_cache = None
+
+        # HR and LR static variables are computed once
+        if self.static_vars is not None:
+            static_vars = StaticVarsCache(self.static_vars, self.upsampling, 
+                                          self.scale, self.interpolation)
+        else:
+            static_vars = None
+
+        # crop positions drawn only among the valid patch origins
+        if self.patch_mask is not None and self.patch_size is not None:
+            patch_mask = self.patch_mask
+            if isinstance(patch_mask, (int, np.integer)):
+                if static_vars is None:
+                    raise ValueError('`static_vars` must be given when `patch_mask` is an index')
+                patch_mask = static_vars.hr[..., patch_mask]
+            patch_sampler = PatchSampler(patch_mask, self.patch_size, self.patch_min_valid)
+        else:
+            patch_sampler = None
+
+        # with data echoing, each batch is used for several training steps. In
+        # 'auto' mode the factor is set after timing the first steps (the very
+        # first one, with the tracing of the graph, is excluded)
+        if self.data_echoing is None or self.data_echoing == 'auto':
+            self.echo_factor = 1
+        else:
+            self.echo_factor = self.data_echoing
+        n_timed_steps = 3
+        batch_times, step_times = [], []
+
         for epoch in range(self.epochs):
             print(f'\nEpoch {epoch+1}/{self.epochs}')
             pb_i = Progbar(self.steps_per_epoch, 
@@ -320,39 +500,70 @@ class CGANTrainer(Trainer):
                                              'gen_mae_loss', 'disc_loss'])
 
             for i in range(self.steps_per_epoch):
+                start = time.perf_counter()
                 res = create_batch_hr_lr(
-                    self.indices_train,
+                    self.sampler_train.get_indices(epoch),
                     i,
                     self.data_train, 
-                    self.data_train_lr,
+                    data_train_lr,
                     upsampling=self.upsampling,
                     scale=self.scale, 
                     batch_size=self.batch_size, 
                     patch_size=self.patch_size,
                     time_window=self.time_window,
-                    static_vars=self.static_vars, 
+                    static_vars=static_vars, 
                     predictors=self.predictors_train,
                     interpolation=self.interpolation,
-                    time_metadata=None)
+                    time_metadata=season_table_train,
+                    rng=self.sampler_train.get_rng(i, epoch),
+                    frame_cache=frame_cache,
+                    patch_sampler=patch_sampler)
                
-                if self.static_vars is not None:
+                if self.static_vars is not None or self.use_season:
                     [lr_array, aux_hr], [hr_array] = res
                 else:
                     [lr_array], [hr_array] = res
+                    aux_hr = None
+                batch_time = time.perf_counter() - start
+
+                echo_losses = []
+                for echo in range(self.echo_factor):
+                    if echo > 0 and self.echo_augment:
+                        x = (lr_array,) if aux_hr is None else (lr_array, aux_hr)
+                        x, (hr_echo,) = augment_batch(x, (hr_array,), seed=self.seed)
+                        lr_echo, aux_echo = x[0], x[1] if aux_hr is not None else None
+                    else:
+                        lr_echo, aux_echo, hr_echo = lr_array, aux_hr, hr_array
+
+                    start = time.perf_counter()
+                    echo_losses.append(train_step(
+                        lr_echo, 
+                        hr_echo, 
+                        generator=self.generator, 
+                        discriminator=self.discriminator, 
+                        generator_optimizer=generator_optimizer, 
+                        discriminator_optimizer=discriminator_optimizer, 
+                        epoch=epoch, 
+                        gen_pxloss_function=self.lossf,
+                        summary_writer=summary_writer, 
+                        first_batch=True if epoch==0 and i==0 and echo==0 else False,
+                        static_array=aux_echo))
+                    step_time = time.perf_counter() - start
+                # the progress bar shows the losses averaged over the echoes
+                losses = [np.mean([float(loss[j]) for loss in echo_losses]) 
+                          for j in range(4)]
+
+                if self.data_echoing == 'auto' and epoch == 0 and 0 < i <= n_timed_steps:
+                    batch_times.append(batch_time)
+                    step_times.append(step_time)
+                    if i == n_timed_steps or i == self.steps_per_epoch - 1:
+                        self.echo_factor = estimate_echo_factor(
+                            np.mean(batch_times), np.mean(step_times))
+                        if self.verbose and self.running_on_first_worker:
+                            print(f'\nData echoing: {np.mean(batch_times):.4f}s per batch, '
+                                  f'{np.mean(step_times):.4f}s per step, '
+                                  f'echo factor {self.echo_factor}')
 
-                losses = train_step(
-                    lr_array, 
-                    hr_array, 
-                    generator=self.generator, 
-                    discriminator=self.discriminator, 
-                    generator_optimizer=generator_optimizer, 
-                    discriminator_optimizer=discriminator_optimizer, 
-                    epoch=epoch, 
-                    gen_pxloss_function=self.lossf,
-                    summary_writer=summary_writer, 
-                    first_batch=True if epoch==0 and i==0 else False,
-                    static_array=aux_hr)
-                
                 gen_total_loss, gen_gan_loss, gen_px_loss, disc_loss = losses
                 lossvals = [('gen_total_loss', gen_total_loss), 
                             ('gen_crosentr_loss', gen_gan_loss), 
@@ -388,16 +599,20 @@ class CGANTrainer(Trainer):
         self.timing.checktime()
 
         ### Loss on the Test set
+        self.data_test = _in_memory_(self.data_test)
+        self.data_test_lr = _in_memory_(self.data_test_lr)
         if self.predictors_test is not None:
-            self.predictors_test = np.concatenate(self.predictors_test, axis=-1)
+            self.predictors_test = np.concatenate(
+                [_in_memory_(pred) for pred in self.predictors_test], axis=-1)
         else:
             self.predictors_test = None
 
+        if self.use_season:
+            season_table_test = create_season_table(self.data_test.time, self.time_window)
+        else:
+            season_table_test = None
         if isinstance(self.data_test, xr.DataArray):
-            # self.time_metadata_test = self.data_test.time.copy()  # time metadata
             self.data_test = self.data_test.values
-        else:
-            self.time_metadata_test = None
         if isinstance(self.data_test_lr, xr.DataArray):
             self.data_test_lr = self.data_test_lr.values
 
@@ -419,12 +634,12 @@ class CGANTrainer(Trainer):
                 batch_size=self.n_test, 
                 patch_size=self.patch_size,
                 time_window=self.time_window,
-                static_vars=self.static_vars, 
+                static_vars=static_vars, 
                 predictors=self.predictors_test,
                 interpolation=self.interpolation,
-                time_metadata=None)
+                time_metadata=season_table_test)
             
-            if self.static_vars is not None:
+            if self.static_vars is not None or self.use_season:
                 [lr_array, aux_hr], [hr_array] = res
                 hr_arrtest = tf.cast(hr_array, tf.float32)
                 lr_arrtest = tf.cast(lr_array, tf.float32)
@@ -432,6 +647,7 @@ class CGANTrainer(Trainer):
                 input_test = [lr_arrtest, auxhr_arrtest]
             else:
                 [lr_array], [hr_array] = res
+                hr_arrtest = tf.cast(hr_array, tf.float32)
                 lr_arrtest = tf.cast(lr_array, tf.float32)
                 input_test = [lr_arrtest]
             
@@ -444,6 +660,15 @@ class CGANTrainer(Trainer):
         self.save_results(self.generator, folder_prefix='cgan_')
 
 
+def _in_memory_(array):
+    """ Read a ``dl4ds.LazyArray`` into a np.ndarray. Other arrays are 
+    returned as they are.
+    """
+    if isinstance(array, LazyArray):
+        return np.asarray(array)
+    return array
+
+
 def load_checkpoint(
     checkpoint_dir, 
     checkpoint_number, 
@@ -3,6 +3,7 @@ Training procedure for supervised models
 """
 
 import os
+import time
 import xarray as xr
 import tensorflow as tf
 from tensorflow.keras.optimizers import Adam
@@ -18,8 +19,10 @@ except ImportError:
     has_horovod = False
 
 from .. import POSTUPSAMPLING_METHODS
-from ..utils import Timing
-from ..dataloader import DataGenerator
+from ..utils import Timing, has_localcon_layer
+from ..dataloader import (DataGenerator, SharedMemoryLoader, create_tf_dataset, 
+                          create_fixed_dataset, PatchBank, echo_dataset,
+                          estimate_echo_factor, measure_batch_time)
 from ..models import (net_pin, recnet_pin, unet_pin, net_postupsampling, 
                      recnet_postupsampling)
 from .base import Trainer
@@ -55,6 +58,30 @@ class SupervisedTrainer(Trainer):
         device='GPU', 
         gpu_memory_growth=True,
         use_multiprocessing=False, 
+        data_pipeline='sequence',
+        num_parallel_calls=None,
+        prefetch_depth=None,
+        num_workers=None,
+        queue_depth=None,
+        lazy_loading=False,
+        lr_cache=False,
+        lr_cache_dtype='float32',
+        lr_cache_path=None,
+        lr_cache_max_memory=None,
+        seed=None,
+        frame_cache_size=None,
+        storage_dtype=None,
+        use_season=False,
+        shuffle_blocks=None,
+        shuffle_block_size=None,
+        materialize_eval=False,
+        materialize_eval_path=None,
+        patch_mask=None,
+        patch_min_valid=0.5,
+        patch_bank_size=None,
+        patch_bank_refresh=0.25,
+        data_echoing=None,
+        echo_augment=False,
         model_list=None,
         learning_rate=(1e-3, 1e-4), 
         lr_decay_after=1e5,
@@ -153,6 +180,107 @@ class SupervisedTrainer(Trainer):
             the process.
         use_multiprocessing : bool, optional
             Used for data generator. If True, use process-based threading.
+        data_pipeline : {'sequence', 'tfdata', 'shared_memory'}, optional
+            Input pipeline backend. With 'sequence' the ``DataGenerator`` is 
+            passed directly to ``model.fit``. With 'tfdata' the batches are
+            created in parallel and prefetched by a ``tf.data.Dataset``. With
+            'shared_memory' the batches are created by worker processes 
+            attached to the data in shared memory (see 
+            ``dl4ds.SharedMemoryLoader``).
+        num_parallel_calls : int or None, optional
+            Number of batches created in parallel when ``data_pipeline`` is 
+            'tfdata'. If None, it is tuned dynamically (autotune).
+        prefetch_depth : int or None, optional
+            Number of batches prefetched when ``data_pipeline`` is 'tfdata'. If
+            None, it is tuned dynamically (autotune).
+        num_workers : int or None, optional
+            Number of worker processes when ``data_pipeline`` is 
+            'shared_memory'. If None, it is set to the number of CPUs.
+        queue_depth : int or None, optional
+            Number of batches being created or waiting to be consumed when 
+            ``data_pipeline`` is 'shared_memory'. If None, it is set to twice
+            ``num_workers``.
+        lazy_loading : bool, optional
+            If True, the data generators read lazily only the time slices (and 
+            spatial windows) needed for each batch. The data (and predictors) 
+            can be given as ``.npy`` memmaps, zarr arrays, dask-backed 
+            xr.DataArrays or ``dl4ds.LazyArray`` objects.
+        lr_cache : bool, optional
+            If True, for implicit pairs (LR data not provided) the HR data is 
+            coarsened once at setup and the LR patches are cropped from the 
+            cached LR arrays, instead of coarsening each sample in every epoch.
+        lr_cache_dtype : str, optional
+            Data type of the LR cache, e.g. 'float32' or 'float16'.
+        lr_cache_path : str or None, optional
+            If not None, directory where the LR caches are stored on disk 
+            (``.npy`` memory-maps, one per split and Horovod rank).
+        lr_cache_max_memory : float or None, optional
+            Maximum size of each in-memory LR cache in GB. When exceeded, the
+            LR arrays are coarsened on the fly.
+        seed : int or None, optional
+            Seed for shuffling the samples (every epoch) and drawing the crop 
+            positions of each batch. See ``dl4ds.EpochSampler``.
+        frame_cache_size : int or None, optional
+            If not None, maximum number of preprocessed frames (e.g., coarsened
+            or interpolated grids) cached by each data generator and reused 
+            across samples and epochs. See ``dl4ds.FrameCache``.
+        storage_dtype : str or None, optional
+            Data type in which the data generators keep the (in-memory) data 
+            and predictors, e.g. 'float16' or 'bfloat16' for halving the 
+            resident memory. Batches are upcast to float32. If None, the arrays
+            keep their dtype. See ``dl4ds.DataGenerator``.
+        use_season : bool, optional
+            If True, the season of each sample is fed to the model as one-hot
+            channels (4 auxiliary channels, also concatenated to the LR input of
+            spatial models). The time metadata is encoded once per dataset (see
+            ``dl4ds.create_season_table``), so ``data_train``, ``data_val`` and
+            ``data_test`` must be xr.DataArrays with a time coordinate.
+        shuffle_blocks : int or None, optional
+            If not None, the samples are shuffled in blocks of consecutive time
+            steps, mixing ``shuffle_blocks`` blocks at a time, so that the reads
+            of lazily loaded archives stay mostly sequential. See 
+            ``dl4ds.BlockShuffleSampler``.
+        shuffle_block_size : int or None, optional
+            Number of time steps per block. If None, the chunk size along time
+            of the lazily loaded data is used. See ``dl4ds.DataGenerator``.
+        materialize_eval : bool, optional
+            If True, the validation and test samples are created once 
+            (full-domain samples, or a fixed tiling of patches when 
+            ``patch_size`` is given), and reused every epoch. The validation 
+            loss is then computed on the same samples. They are stored with 
+            ``storage_dtype``, in memory or, when ``materialize_eval_path`` is
+            given, as memory-maps in that directory. See 
+            ``dl4ds.create_fixed_dataset``.
+        materialize_eval_path : str or None, optional
+            If not None, directory where the materialized validation and test 
+            samples are stored (``.npy`` memory-maps, one set per split and 
+            Horovod rank).
+        patch_mask : None, int or 2D ndarray, optional
+            If not None (and ``patch_size`` is given), the patches are only cropped
+            where the fraction of valid pixels of the mask is at least 
+            ``patch_min_valid``. The mask is a 2D array on the HR grid 
+            (zero or NaN pixels are invalid), or the index of the static 
+            variable used as mask. See ``dl4ds.PatchSampler``.
+        patch_min_valid : float, optional
+            Minimum fraction of valid pixels in a patch, in [0, 1].
+        patch_bank_size : int or None, optional
+            If not None, the training batches are drawn from a bank of 
+            ``patch_bank_size`` pre-built samples, refreshed in the background
+            after every epoch. See ``dl4ds.PatchBank``.
+        patch_bank_refresh : float, optional
+            Fraction of the patch bank replaced after every epoch, in [0, 1].
+        data_echoing : None, int or 'auto', optional
+            If not None, each training batch is reused for ``data_echoing`` 
+            consecutive steps (data echoing), which is useful when the input 
+            pipeline is the bottleneck. If 'auto', the echo factor is chosen 
+            from the measured times of creating a batch and of a training step.
+            See ``dl4ds.echo_dataset``.
+        echo_augment : bool, optional
+            If True, the echoed batches are re-augmented with random flips and
+            transposes (of square grids). Off by default, geolocated fields are
+            not invariant to these transformations (e.g., wind components or 
+            anisotropic fields). Not allowed with a ``localcon_layer``, whose 
+            weights are tied to the grid positions.
         show_plot : bool, optional
             If True the static plot is shown after training. 
         save_plot : bool, optional
@@ -202,6 +330,49 @@ class SupervisedTrainer(Trainer):
                 if isinstance(self.static_vars[i], xr.DataArray):
                     self.static_vars[i] = self.static_vars[i].values
         self.interpolation = interpolation 
+        self.data_pipeline = data_pipeline
+        if self.data_pipeline not in ['sequence', 'tfdata', 'shared_memory']:
+            msg = f"`data_pipeline` must be one of ['sequence', 'tfdata', 'shared_memory'], got {self.data_pipeline}"
+            raise ValueError(msg)
+        self.num_parallel_calls = num_parallel_calls
+        self.prefetch_depth = prefetch_depth
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth
+        self.shm_loaders = []
+        self.patch_bank = None
+        self.lazy_loading = lazy_loading
+        self.lr_cache = lr_cache
+        self.lr_cache_dtype = lr_cache_dtype
+        self.lr_cache_path = lr_cache_path
+        self.lr_cache_max_memory = lr_cache_max_memory
+        self.seed = seed
+        self.frame_cache_size = frame_cache_size
+        self.storage_dtype = storage_dtype
+        self.use_season = use_season
+        self.shuffle_blocks = shuffle_blocks
+        self.shuffle_block_size = shuffle_block_size
+        self.materialize_eval = materialize_eval
+        self.materialize_eval_path = materialize_eval_path
+        self.patch_mask = patch_mask
+        self.patch_min_valid = patch_min_valid
+        self.patch_bank_size = patch_bank_size
+        self.patch_bank_refresh = patch_bank_refresh
+        self.data_echoing = data_echoing
+        if self.data_echoing is not None and self.data_echoing != 'auto':
+            if not isinstance(self.data_echoing, int) or self.data_echoing < 1:
+                raise ValueError("`data_echoing` must be a positive int or 'auto'")
+        self.echo_augment = echo_augment
+        if self.data_echoing is not None and self.echo_augment:
+            if architecture_params.get('localcon_layer', False) or \
+               (trained_model is not None and has_localcon_layer(trained_model)):
+                msg = '`echo_augment` cannot be used with a locally connected layer'
+                raise ValueError(msg)
+        self.echo_factor = 1
+        if self.use_season:
+            for data in [self.data_train, self.data_val, self.data_test]:
+                if not isinstance(data, xr.DataArray) or 'time' not in data.coords:
+                    msg = 'With `use_season`, the data must be xr.DataArrays with a time coordinate'
+                    raise TypeError(msg)
         self.epochs = epochs
         self.steps_per_epoch = steps_per_epoch
         self.validation_steps = validation_steps
@@ -228,16 +399,154 @@ class SupervisedTrainer(Trainer):
             static_vars=self.static_vars, 
             patch_size=self.patch_size, 
             interpolation=self.interpolation,
-            time_window=self.time_window)
+            time_window=self.time_window,
+            lazy_loading=self.lazy_loading,
+            lr_cache=self.lr_cache,
+            lr_cache_dtype=self.lr_cache_dtype,
+            lr_cache_max_memory=self.lr_cache_max_memory,
+            frame_cache_size=self.frame_cache_size,
+            storage_dtype=self.storage_dtype,
+            shuffle_blocks=self.shuffle_blocks,
+            shuffle_block_size=self.shuffle_block_size,
+            patch_mask=self.patch_mask,
+            patch_min_valid=self.patch_min_valid)
+        # a different seed for each split (if given)
+        seeds = [None, None, None] if self.seed is None else [self.seed + i for i in range(3)]
+        if self.lr_cache_path is not None:
+            os.makedirs(self.lr_cache_path, exist_ok=True)
+            # one file per worker, each rank caches its own shard
+            lr_cache_paths = [os.path.join(self.lr_cache_path, f'lr_cache_{split}_r{self.rank}.npy') 
+                              for split in ['train', 'val', 'test']]
+        else:
+            lr_cache_paths = [None, None, None]
+        # season tables are encoded once by each data generator
+        if self.use_season:
+            times = [data.time for data in [self.data_train, self.data_val, self.data_test]]
+        else:
+            times = [None, None, None]
+        # with Horovod, each worker gets a disjoint shard of the training data
+        shard = (self.rank, self.n_workers) if self.n_workers > 1 else None
         self.ds_train = DataGenerator(
             self.data_train, self.data_train_lr, 
-            predictors=self.predictors_train, **datagen_params)
+            predictors=self.predictors_train, lr_cache_path=lr_cache_paths[0], 
+            seed=seeds[0], time_metadata=times[0], shard=shard, **datagen_params)
         self.ds_val = DataGenerator(
             self.data_val, self.data_val_lr, 
-            predictors=self.predictors_val, **datagen_params)
+            predictors=self.predictors_val, lr_cache_path=lr_cache_paths[1], 
+            seed=seeds[1], time_metadata=times[1], **datagen_params)
         self.ds_test = DataGenerator(
             self.data_test, self.data_test_lr,
-            predictors=self.predictors_test, **datagen_params)
+            predictors=self.predictors_test, lr_cache_path=lr_cache_paths[2], 
+            seed=seeds[2], time_metadata=times[2], **datagen_params)
+
+        # with a patch bank, the training batches are drawn from a bank of 
+        # samples refreshed in the background by the training data generator
+        if self.patch_bank_size is not None:
+            self.patch_bank = PatchBank(
+                self.ds_train, self.patch_bank_size, 
+                refresh_fraction=self.patch_bank_refresh, seed=self.seed)
+            self.ds_train = self.patch_bank.to_dataset(
+                repeat=self.steps_per_epoch is not None)
+        train_in_pipeline = self.patch_bank_size is None
+        # for measuring the time of creating a batch (data echoing)
+        self.train_loader = self.patch_bank if self.patch_bank is not None else self.ds_train
+        self.train_loader_parallelism = 1
+        eval_in_pipeline = not self.materialize_eval
+
+        if self.data_pipeline == 'tfdata':
+            tfdata_params = dict(
+                num_parallel_calls=self.num_parallel_calls,
+                prefetch_depth=self.prefetch_depth)
+            # datasets are repeated when the number of steps is given explicitly
+            if train_in_pipeline:
+                self.ds_train = create_tf_dataset(
+                    self.ds_train, repeat=self.steps_per_epoch is not None, 
+                    **tfdata_params)
+                self.train_loader_parallelism = self.num_parallel_calls or os.cpu_count() or 1
+            if eval_in_pipeline:
+                self.ds_val = create_tf_dataset(
+                    self.ds_val, repeat=self.validation_steps is not None, 
+                    **tfdata_params)
+                self.ds_test = create_tf_dataset(
+                    self.ds_test, repeat=self.test_steps is not None, 
+                    **tfdata_params)
+        elif self.data_pipeline == 'shared_memory':
+            def shared_memory_dataset(datagen, repeat):
+                loader = SharedMemoryLoader(datagen, num_workers=self.num_workers, 
+                                            queue_depth=self.queue_depth)
+                self.shm_loaders.append(loader)
+                return loader.to_dataset(repeat=repeat)
+            # datasets are repeated when the number of steps is given explicitly
+            if train_in_pipeline:
+                self.ds_train = shared_memory_dataset(
+                    self.ds_train, repeat=self.steps_per_epoch is not None)
+                self.train_loader_parallelism = self.shm_loaders[-1].num_workers
+            if eval_in_pipeline:
+                self.ds_val = shared_memory_dataset(
+                    self.ds_val, repeat=self.validation_steps is not None)
+                self.ds_test = shared_memory_dataset(
+                    self.ds_test, repeat=self.test_steps is not None)
+
+        if self.materialize_eval:
+            # validation and test samples created once, reused every epoch
+            if self.materialize_eval_path is not None:
+                os.makedirs(self.materialize_eval_path, exist_ok=True)
+                fixed_paths = [os.path.join(self.materialize_eval_path, f'fixed_{split}_r{self.rank}') 
+                               for split in ['val', 'test']]
+            else:
+                fixed_paths = [None, None]
+            self.ds_val = create_fixed_dataset(
+                self.ds_val, repeat=self.validation_steps is not None, 
+                cache_path=fixed_paths[0])
+            self.ds_test = create_fixed_dataset(
+                self.ds_test, repeat=self.test_steps is not None, 
+                cache_path=fixed_paths[1])
+
+    def setup_echoing(self):
+        """Setting up the data echoing of the training batches
+        """
+        if self.data_echoing == 'auto':
+            batch_time = measure_batch_time(
+                self.train_loader, n_parallel=self.train_loader_parallelism)
+            step_time = self.measure_step_time()
+            self.echo_factor = estimate_echo_factor(batch_time, step_time)
+            if self.verbose and self.running_on_first_worker:
+                print(f'Data echoing: {batch_time:.4f}s per batch, {step_time:.4f}s '
+                      f'per step, echo factor {self.echo_factor}')
+        else:
+            self.echo_factor = self.data_echoing
+
+        if self.echo_factor > 1:
+            if not isinstance(self.ds_train, tf.data.Dataset):
+                self.ds_train = create_tf_dataset(
+                    self.ds_train, num_parallel_calls=1, deterministic=True,
+                    repeat=self.steps_per_epoch is not None)
+            self.ds_train = echo_dataset(self.ds_train, self.echo_factor, 
+                                         augment=self.echo_augment, seed=self.seed)
+
+    def measure_step_time(self, n_steps=3):
+        """Time of a training step (forward and backward passes), in seconds. 
+        The non-trainable variables (e.g., BatchNorm moving statistics) updated
+        by the forward passes are restored afterwards.
+        """
+        x, y = self.train_loader.get_batch(0, 0)
+        variables = self.model.trainable_variables
+        state = [v.numpy() for v in self.model.non_trainable_variables]
+
+        @tf.function
+        def step(x, y):
+            with tf.GradientTape() as tape:
+                loss = self.lossf(y[0], self.model(x, training=True))
+            return tape.gradient(loss, variables)
+
+        step(x, y)   # tracing
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            tf.nest.map_structure(lambda g: g.numpy(), step(x, y))
+        step_time = (time.perf_counter() - start) / n_steps
+        for v, value in zip(self.model.non_trainable_variables, state):
+            v.assign(value)
+        return step_time
 
     def setup_model(self):
         """Setting up the model
@@ -258,6 +567,11 @@ class SupervisedTrainer(Trainer):
                 n_aux_channels = len(self.static_vars)
             if self.predictors_train is not None:
                 n_channels += len(self.predictors_train)
+        # one-hot season channels
+        if self.use_season:
+            n_aux_channels += 4
+            if not self.model_is_spatiotemporal:
+                n_channels += 4
 
         if self.patch_size is None:
             lr_height = int(self.data_train.shape[1] / self.scale)
@@ -394,6 +708,8 @@ class SupervisedTrainer(Trainer):
             self.steps_per_epoch = self.steps_per_epoch // hvd.size()
 
         self.model.compile(optimizer=self.optimizer, loss=self.lossf)
+        if self.data_echoing is not None:
+            self.setup_echoing()
         self.fithist = self.model.fit(
             self.ds_train, 
             epochs=self.epochs, 
@@ -413,4 +729,9 @@ class SupervisedTrainer(Trainer):
             
             self.timing.runtime()
 
+        # stopping the workers and releasing the shared memory
+        for loader in self.shm_loaders:
+            loader.close()
+        if self.patch_bank is not None:
+            self.patch_bank.close()
         self.save_results(self.model)
@@ -2,31 +2,35 @@ import numpy as np
 import tensorflow as tf
 import xarray as xr
 import cv2
+from numpy.lib.stride_tricks import sliding_window_view
 from datetime import datetime
 
 import matplotlib.pyplot as plt
 from typing import List, Dict, Type, Union, Tuple, Callable
 import os
 import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from matplotlib.axes import Axes
 from matplotlib.figure import Figure
 from tensorflow.keras.callbacks import History
 
-from . import BACKBONE_BLOCKS, DROPOUT_VARIANTS, LOSS_FUNCTIONS, UPSAMPLING_METHODS, INTERPOLATION_METHODS
+from . import (BACKBONE_BLOCKS, DROPOUT_VARIANTS, LOSS_FUNCTIONS, UPSAMPLING_METHODS, 
+               INTERPOLATION_METHODS, STORAGE_DTYPES)
 from . import losses
 
 
 def spatial_to_spatiotemporal_samples(array, time_window):
     """Add one dimension to spatial array [n_samples or time, lat, lon, vars] 
-    in order to have [n_samples, time_window, lat, lon, vars].
+    in order to have [n_samples, time_window, lat, lon, vars]. A new array is
+    returned, built from a strided window view of ``array``.
     """
-    n_samples, y, x, n_channels = array.shape
-    n_t_samples = n_samples - (time_window - 1)
-    array_out = np.zeros((n_t_samples, time_window, y, x, n_channels))
-    for i in range(n_t_samples):
-        array_out[i] = array[i: i+time_window]
-    return array_out
+    if array.ndim != 4:
+        raise ValueError('`array` must be a 4D ndarray [n_samples, lat, lon, vars]')
+    # [n_t_samples, lat, lon, vars, time_window] -> [n_t_samples, time_window, lat, lon, vars]
+    array_out = np.moveaxis(sliding_window_view(array, time_window, axis=0), -1, 1)
+    return array_out.copy()
 
 
 def spatiotemporal_to_spatial_samples(array, time_window):
@@ -171,6 +175,49 @@ def checkarg_loss(loss):
         raise TypeError('`loss` must be a string, one of {LOSS_FUNCTIONS}')
 
 
+def checkarg_storage_dtype(storage_dtype):
+    """Check the argument ``storage_dtype`` and return it as a numpy dtype
+    (None is returned as it is).
+
+    Parameters
+    ----------
+    storage_dtype : str, np.dtype or None
+        Data type used for storing the training arrays. 
+    """
+    if storage_dtype is None:
+        return None
+    name = storage_dtype if isinstance(storage_dtype, str) else np.dtype(storage_dtype).name
+    if name not in STORAGE_DTYPES:
+        msg = f'`storage_dtype` not recognized. Must be None or one of the '
+        msg += f'following: {STORAGE_DTYPES}. Got {storage_dtype}'
+        raise ValueError(msg)
+    return _numpy_dtype_(name)
+
+
+def _numpy_dtype_(dtype):
+    """Return ``dtype`` as a numpy dtype, including 'bfloat16' (not a native
+    numpy type, the one registered by tensorflow is used).
+    """
+    if isinstance(dtype, str) and dtype == 'bfloat16':
+        return np.dtype(tf.bfloat16.as_numpy_dtype)
+    return np.dtype(dtype)
+
+
+def _is_half_float_(dtype):
+    """Whether ``dtype`` is a half precision float (float16 or bfloat16), which
+    are not supported by opencv.
+    """
+    return np.dtype(dtype).name in ['float16', 'bfloat16']
+
+
+def has_localcon_layer(model):
+    """Whether a Keras ``model`` contains a locally connected layer, whose 
+    weights are tied to the grid positions.
+    """
+    return any(isinstance(layer, tf.keras.layers.LocallyConnected2D) 
+               for layer in model.submodules)
+
+
 def set_gpu_memory_growth():
     physical_devices = list_devices(verbose=False) 
     for gpu in physical_devices:
@@ -249,7 +296,7 @@ class Timing():
 
 
 def crop_array(array, size, yx=None, position=False, exclude_borders=False, 
-               get_copy=False):
+               get_copy=False, rng=None, patch_sampler=None):
     """
     Return a square cropped version of a 2D, 3D or 4D or 5D ndarray.
     
@@ -260,13 +307,20 @@ def crop_array(array, size, yx=None, position=False, exclude_borders=False,
     size : int
         Size of the cropped image.
     yx : tuple of int or None, optional
-        Y,X coordinate of the bottom-left corner. If None then a random
+        Y,X coordinate of the top-left corner (array indices of the first row
+        and column of the crop). If None then a random
         position will be chosen.
     position : bool, optional
-        If set to True return also the coordinates of the bottom-left corner.
+        If set to True return also the coordinates of the top-left corner.
     get_copy : bool, optional
         If True a cropped copy of the intial array is returned. By default a
         sliced view of the array is returned.
+    rng : np.random.Generator or None, optional
+        Random generator used for the random position. If None, the global
+        ``np.random`` state is used.
+    patch_sampler : dl4ds.PatchSampler or None, optional
+        If not None, the random position is drawn among the valid patch 
+        origins of the sampler (e.g., patches mostly over land).
     
     Returns
     -------
@@ -298,14 +352,19 @@ def crop_array(array, size, yx=None, position=False, exclude_borders=False,
 
     if yx is not None and isinstance(yx, tuple):
         y, x = yx
+    elif patch_sampler is not None:
+        # random location among the valid patch origins
+        y, x = patch_sampler.draw(rng, grid_shape=(array_size_y, array_size_x))
+        y, x = int(y), int(x)
     else:
         # random location
+        randint = np.random.randint if rng is None else rng.integers
         if exclude_borders:
-            y = np.random.randint(1, array_size_y - size - 1)
-            x = np.random.randint(1, array_size_x - size - 1)
+            y = randint(1, array_size_y - size - 1)
+            x = randint(1, array_size_x - size - 1)
         else:
-            y = np.random.randint(0, array_size_y - size)
-            x = np.random.randint(0, array_size_x - size)
+            y = randint(0, array_size_y - size)
+            x = randint(0, array_size_x - size)
 
     y0, y1 = y, int(y + size)
     x0, x1 = x, int(x + size)
@@ -338,11 +397,121 @@ def crop_array(array, size, yx=None, position=False, exclude_borders=False,
         return cropped_array
 
 
+def _resize_frames_(array, out, start, stop, newsize, intmethod):
+    """Resize the frames ``start:stop`` of a 4D ``array`` [frames,y,x,channels]
+    into ``out``. ``cv2.resize`` releases the GIL, so several of these calls 
+    can run concurrently in a thread pool.
+    """
+    for i in range(start, stop):
+        ti = cv2.resize(array[i], newsize, interpolation=intmethod)
+        out[i] = ti.reshape(out.shape[1:])
+
+
+def _get_resize_pool_():
+    """Return the (module-level, lazily created) thread pool for resizing 
+    frames. The pool is shared by all the callers (e.g., the tf.data map 
+    threads or a patch bank refresh thread) and never shut down, the 
+    parallelism of a call is given by the number of chunks it submits.
+    """
+    global _RESIZE_POOL_
+    with _RESIZE_POOL_LOCK_:
+        if _RESIZE_POOL_ is None:
+            _RESIZE_POOL_ = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, 
+                                               thread_name_prefix='resize_array')
+    return _RESIZE_POOL_
+
+
+def _get_block_factors_(shape_yx, newsize):
+    """Return the integer downsampling factors (in Y,X) from ``shape_yx`` to 
+    ``newsize`` (X,Y), or None if the sizes are not integer multiples.
+    """
+    (y, x), (size_x, size_y) = shape_yx, newsize
+    if size_y < 1 or size_x < 1 or y % size_y != 0 or x % size_x != 0:
+        return None
+    return (y // size_y, x // size_x)
+
+
+def _block_sum_(array, factors, ax_y, dtype):
+    """Sum non-overlapping blocks of ``factors`` (Y,X) pixels, with the Y 
+    dimension at ``ax_y``. The strided slices within the blocks are accumulated
+    (first along Y, then along X), which is faster than a reshape and a sum.
+    """
+    def take(arr, axis, start, step):
+        index = [slice(None)] * arr.ndim
+        index[axis] = slice(start, None, step)
+        return arr[tuple(index)]
+
+    fy, fx = factors
+    acc = take(array, ax_y, 0, fy).astype(dtype, copy=True)
+    for i in range(1, fy):
+        acc += take(array, ax_y, i, fy)
+    block_sum = take(acc, ax_y + 1, 0, fx).copy()
+    for i in range(1, fx):
+        block_sum += take(acc, ax_y + 1, i, fx)
+    return block_sum
+
+
+def block_mean(array, factors, nan_aware=False):
+    """
+    Downsample a 2D ndarray [y,x], 3D ndarray [y,x,channels], 4D ndarray 
+    [time,y,x,channels] or 5D ndarray [samples,time,y,x,channels] by averaging
+    non-overlapping blocks of ``factors`` pixels. For integer factors, this is 
+    the same as the ``inter_area`` interpolation.
+
+    Parameters
+    ----------
+    array : numpy ndarray 
+        Input ndarray, with Y,X sizes divisible by ``factors``.
+    factors : int or tuple of int
+        Downsampling factor, or factors in Y,X.
+    nan_aware : bool, optional
+        If True, NaN values are ignored in the average (a block with all the 
+        values missing results in NaN). Otherwise, NaNs are propagated.
+
+    Returns
+    -------
+    coarsened_arr : numpy ndarray
+        Block averaged array, float64 for float64 inputs and float32 otherwise
+        (including float16 and bfloat16 inputs).
+    """
+    if isinstance(factors, int):
+        factors = (factors, factors)
+    fy, fx = factors
+    array = np.asarray(array)
+    if array.ndim not in [2, 3, 4, 5]:
+        raise RuntimeError(f'Wrong dimensions, got {array.ndim}')
+    ax_y = 0 if array.ndim in [2, 3] else array.ndim - 3
+    y, x = array.shape[ax_y], array.shape[ax_y + 1]
+    if y % fy != 0 or x % fx != 0:
+        msg = f'The Y,X sizes ({y}, {x}) must be divisible by the factors {factors}'
+        raise ValueError(msg)
+    dtype = 'float64' if array.dtype == 'float64' else 'float32'
+
+    if nan_aware:
+        isnan = np.isnan(array)
+        total = _block_sum_(np.where(isnan, 0, array), factors, ax_y, dtype)
+        count = _block_sum_(~isnan, factors, ax_y, dtype)
+        with np.errstate(invalid='ignore'):
+            return total / count
+    coarsened_arr = _block_sum_(array, factors, ax_y, dtype)
+    coarsened_arr *= 1. / (fy * fx)
+    return coarsened_arr
+
+
+_RESIZE_POOL_ = None
+_RESIZE_POOL_LOCK_ = threading.Lock()
+# minimum number of output pixels per worker for the thread pool to be used
+_RESIZE_MIN_PIXELS_PER_WORKER_ = 2 ** 16
+
+
 def resize_array(array, newsize, interpolation='inter_area', squeezed=True, 
-                 keep_dynamic_range=False):
+                 keep_dynamic_range=False, out=None, n_workers=None, 
+                 nan_aware=False):
     """
-    Return a resized version of a 2D or [y,x] 3D ndarray [y,x,channels] or
-    4D ndarray [time,y,x,channels] via interpolation.
+    Return a resized version of a 2D or [y,x] 3D ndarray [y,x,channels], 
+    4D ndarray [time,y,x,channels] or 5D ndarray [samples,time,y,x,channels]
+    via interpolation. The frames of 4D and 5D arrays are resized in parallel
+    in a thread pool. 
     
     Parameters
     ----------
@@ -355,6 +524,21 @@ def resize_array(array, newsize, interpolation='inter_area', squeezed=True,
     squeezed : bool, optional
         If True, the output will be squeezed (any dimension with lenght 1 will
         be removed).
+    keep_dynamic_range : bool, optional
+        If True, the output is clipped to the range of values of ``array``.
+    out : numpy ndarray or None, optional
+        Output buffer with the same number of dimensions as ``array`` and the 
+        resized shape. The resized values are cast to its dtype. If None, a new
+        array is allocated with the dtype of ``array`` (float32 for float16 and
+        bfloat16 inputs). Float32 inputs are never promoted to float64.
+    n_workers : int or None, optional
+        Number of threads used for resizing the frames of 4D and 5D arrays. If
+        None, it is set to the number of CPUs. Small arrays are resized in the
+        calling thread.
+    nan_aware : bool, optional
+        If True, NaN values are ignored when averaging, computing a block mean
+        (see ``block_mean``). Only supported for downsampling with 
+        ``inter_area`` by integer factors.
 
     Returns
     -------
@@ -363,6 +547,9 @@ def resize_array(array, newsize, interpolation='inter_area', squeezed=True,
     """
     if interpolation not in INTERPOLATION_METHODS:
         raise ValueError(f'`interpolation` must be one of {INTERPOLATION_METHODS}. Received {interpolation}')
+    array = np.asarray(array)
+    if _is_half_float_(array.dtype):
+        array = array.astype('float32')  # float16/bfloat16 are not supported in opencv
     if array.dtype in ['bool', 'int', 'int64']:
         array = array.astype('int')
         interpolation = 'nearest'  # only nearest is supported in opencv for int
@@ -379,25 +566,71 @@ def resize_array(array, newsize, interpolation='inter_area', squeezed=True,
         intmethod = cv2.INTER_LANCZOS4
 
     size_x, size_y = newsize
+    if nan_aware:
+        ax_y = 0 if array.ndim in [2, 3] else array.ndim - 3
+        factors = None
+        if interpolation == 'inter_area' and array.dtype.kind == 'f':
+            factors = _get_block_factors_(array.shape[ax_y: ax_y + 2], newsize)
+        if factors is None:
+            msg = '`nan_aware` is only supported for `inter_area` downsampling by integer factors'
+            raise ValueError(msg)
     
-    if array.ndim in [2, 3]:
+    if nan_aware:
+        # block mean ignoring NaNs, vectorized over the whole array
+        resized_arr = block_mean(array, factors, nan_aware=True)
+        if out is not None:
+            if out.shape != resized_arr.shape:
+                msg = f'`out` must have shape {resized_arr.shape}, got {out.shape}'
+                raise ValueError(msg)
+            out[...] = resized_arr
+            resized_arr = out
+    elif array.ndim in [2, 3]:
         resized_arr = cv2.resize(array, (size_x, size_y), interpolation=intmethod)
         if resized_arr.ndim == 2 and array.ndim == 3:
             resized_arr = np.expand_dims(resized_arr, -1)
-    elif array.ndim == 4:
+        if out is not None:
+            out[...] = resized_arr
+            resized_arr = out
+    elif array.ndim in [4, 5]:
+        shape = array.shape[:-3] + (size_y, size_x, array.shape[-1])
+        if out is None:
+            out = np.empty(shape, dtype=array.dtype)
+        elif out.shape != shape:
+            msg = f'`out` must have shape {shape}, got {out.shape}'
+            raise ValueError(msg)
+        resized_arr = out
+        # 5D arrays are resized as a sequence of [y,x,channels] frames
+        if array.ndim == 5:
+            array = array.reshape((-1,) + array.shape[2:])
+            # a view of ``out``, unless ``out`` is not contiguous
+            frames_out = out.reshape((-1,) + out.shape[2:])
+        else:
+            frames_out = out
+
         n = array.shape[0]
-        n_ch = array.shape[-1]
-        resized_arr = np.zeros((n, size_y, size_x, n_ch))
-        for i in range(n):
-            ti = cv2.resize(array[i], (size_x, size_y), interpolation=intmethod)                
-            resized_arr[i] = np.expand_dims(ti, -1) if n_ch ==1 else ti
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        n_workers = int(max(1, min(n_workers, n, 
+            out.size // _RESIZE_MIN_PIXELS_PER_WORKER_)))
+        if n_workers == 1:
+            _resize_frames_(array, frames_out, 0, n, (size_x, size_y), intmethod)
+        else:
+            bounds = np.linspace(0, n, n_workers + 1).astype(int)
+            pool = _get_resize_pool_()
+            futures = [pool.submit(_resize_frames_, array, frames_out, start, stop, 
+                                   (size_x, size_y), intmethod)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+        if not np.shares_memory(frames_out, out):
+            out[...] = frames_out.reshape(out.shape)
     else:
         raise RuntimeError(f'Wrong dimensions, got {array.ndim}')
 
+    if keep_dynamic_range:
+        np.clip(resized_arr, a_min=array.min(), a_max=array.max(), out=resized_arr)
     if squeezed:
         resized_arr = np.squeeze(resized_arr)
-    if keep_dynamic_range:
-        resized_arr = np.clip(resized_arr, a_min=array.min(), a_max=array.max())
     return resized_arr
 
 
@@ -56,6 +56,9 @@ setup(
     extras_require={
         'horovod':['horovod'] 
     },
+    entry_points={
+        'console_scripts': ['dl4ds-serve = dl4ds.serve:main']
+    },
     classifiers=[
         'Intended Audience :: Science/Research',
         'Operating System :: POSIX :: Linux',
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from dl4ds.dataloader import (create_batch_hr_lr, create_lr_cache, StaticVarsCache,
+                              PatchSampler, EpochSampler, DataGenerator,
+                              SharedMemoryLoader)
+
+
+@pytest.fixture
+def arrays():
+    rng = np.random.default_rng(0)
+    return dict(
+        hr=rng.random((20, 32, 32, 1)).astype('float32'),
+        lr=rng.random((20, 8, 8, 1)).astype('float32'),
+        predictors_hr=rng.random((20, 32, 32, 1)).astype('float32'),
+        predictors_lr=rng.random((20, 8, 8, 1)).astype('float32'),
+        static_vars=[rng.random((32, 32)), rng.random((32, 32))])
+
+
+def _create_batches_(arrays, upsampling, explicit_lr, patch_size):
+    """ Batch created with the vectorized and the per-sample paths. """
+    if patch_size is not None:
+        # a single valid patch, so that both paths crop at the same position
+        mask = np.zeros((32, 32))
+        mask[8:24, 16:32] = 1
+        patch_sampler = PatchSampler(mask, patch_size, min_valid_fraction=1)
+    else:
+        patch_sampler = None
+    kwargs = dict(
+        batch_size=5,
+        patch_size=patch_size,
+        static_vars=StaticVarsCache(arrays['static_vars'], upsampling, 4),
+        predictors=arrays['predictors_lr'] if explicit_lr else arrays['predictors_hr'],
+        patch_sampler=patch_sampler)
+    array_lr = arrays['lr'] if explicit_lr else None
+    batches = [create_batch_hr_lr(np.arange(20), 1, arrays['hr'], array_lr, upsampling, 4,
+                                  rng=np.random.default_rng(1), vectorized=vectorized, **kwargs)
+               for vectorized in [True, False]]
+    return batches
+
+
+@pytest.mark.parametrize('upsampling', ['spc', 'pin'])
+@pytest.mark.parametrize('explicit_lr', [False, True])
+@pytest.mark.parametrize('patch_size', [None, 16])
+def test_vectorized_batch_matches_loop(arrays, upsampling, explicit_lr, patch_size):
+    (x_vec, y_vec), (x_loop, y_loop) = _create_batches_(
+        arrays, upsampling, explicit_lr, patch_size)
+    assert len(x_vec) == len(x_loop) and len(y_vec) == len(y_loop)
+    for a, b in zip(list(x_vec) + list(y_vec), list(x_loop) + list(y_loop)):
+        assert a.shape == b.shape
+        np.testing.assert_allclose(a, b, rtol=0, atol=1e-6)
+
+
+def test_vectorized_batch_crop_position(arrays):
+    (_, (y_vec,)), _ = _create_batches_(arrays, 'spc', False, 16)
+    np.testing.assert_array_equal(y_vec, arrays['hr'][5:10, 8:24, 16:32])
+
+
+def test_epoch_sampler_determinism():
+    a, b = EpochSampler(50, seed=3), EpochSampler(50, seed=3)
+    # the same indices and batch generators for the same seed and epoch,
+    # regardless of the order in which they are requested
+    assert np.array_equal(a.get_indices(1), b.get_indices(1))
+    assert np.array_equal(a.get_indices(0), b.get_indices(0))
+    assert a.get_rng(4, epoch=1).integers(1000) == b.get_rng(4, epoch=1).integers(1000)
+    # a permutation, reshuffled every epoch
+    assert np.array_equal(np.sort(a.get_indices(0)), np.arange(50))
+    assert not np.array_equal(a.get_indices(0), a.get_indices(1))
+    assert not np.array_equal(a.get_indices(0), EpochSampler(50, seed=4).get_indices(0))
+    # no shuffling
+    assert np.array_equal(EpochSampler(50, seed=3, shuffle=False).get_indices(2), np.arange(50))
+
+
+def test_datagenerator_batches_are_reproducible(arrays):
+    def batch(index, epoch):
+        datagen = DataGenerator(arrays['hr'], None, 'resnet', 'spc', 4, batch_size=4,
+                                patch_size=16, seed=7)
+        return datagen.get_batch(index, epoch=epoch)
+
+    (x1, y1), (x2, y2) = batch(2, 1), batch(2, 1)
+    for a, b in zip(list(x1) + list(y1), list(x2) + list(y2)):
+        np.testing.assert_array_equal(a, b)
+    (_, y3) = batch(2, 0)
+    assert not np.array_equal(y1[0], y3[0])
+
+
+def test_shared_memory_loader_early_stop(arrays):
+    datagen = DataGenerator(arrays['hr'], None, 'resnet', 'spc', 4, batch_size=4,
+                            patch_size=16, seed=7)
+    loader = SharedMemoryLoader(datagen, num_workers=2, queue_depth=3)
+    try:
+        for i, _ in enumerate(loader):
+            if i == 1:
+                break
+        # no slot is lost, and the next epoch is complete and in order
+        epoch = datagen.sampler.epoch
+        batches = [(list(map(np.copy, x)), list(map(np.copy, y))) for x, y in loader]
+        assert len(batches) == len(datagen)
+        for index, (x, y) in enumerate(batches):
+            x_ref, y_ref = datagen.get_batch(index, epoch=epoch)
+            for a, b in zip(x + y, list(x_ref) + list(y_ref)):
+                np.testing.assert_array_equal(a, b)
+        assert sorted(loader._free_slots) == list(range(loader.queue_depth))
+    finally:
+        loader.close()
+
+
+def test_lr_cache_max_memory_fallback_warns(arrays):
+    with pytest.warns(UserWarning, match='max_memory'):
+        datagen = DataGenerator(arrays['hr'], None, 'resnet', 'spc', 4, batch_size=4,
+                                lr_cache=True, lr_cache_max_memory=1e-6)
+    assert datagen.array_lr is None
+    assert create_lr_cache(arrays['hr'], 4, max_memory=1).shape == (20, 8, 8, 1)
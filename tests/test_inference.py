@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import tensorflow as tf
+import pytest
+
+import dl4ds as dds
+from dl4ds.inference import blending_weights
+
+
+def _pixelwise_model_(upsampling, scale=4, n_channels=1):
+    """ Fixed model without spatial context (1x1 convolutions), so the tiled
+    inference must give the same output as the full-domain one. """
+    x_in = tf.keras.layers.Input(shape=(None, None, n_channels))
+    if upsampling == 'spc':
+        x = tf.keras.layers.Conv2D(scale ** 2, 1)(x_in)
+        x = tf.nn.depth_to_space(x, scale)
+    else:
+        x = tf.keras.layers.Conv2D(1, 1)(x_in)
+    return tf.keras.Model(x_in, x, name=f'pixelwise_{upsampling}')
+
+
+@pytest.mark.parametrize('upsampling', ['spc', 'pin'])
+@pytest.mark.parametrize('tile_size,tile_overlap', [(16, 4), (24, 8), (20, 0)])
+@pytest.mark.parametrize('blending', ['cosine', 'linear'])
+def test_tiled_inference_matches_full_domain(upsampling, tile_size, tile_overlap, blending):
+    model = _pixelwise_model_(upsampling)
+    lr = np.random.default_rng(0).random((5, 13, 11, 1)).astype('float32')
+    kwargs = dict(array_in_hr=False, batch_size=4, device='CPU')
+    full = dds.predict(model, lr, 4, **kwargs)
+    tiled = dds.predict(model, lr, 4, tile_size=tile_size, tile_overlap=tile_overlap,
+                        blending=blending, **kwargs)
+    assert tiled.shape == full.shape == (5, 52, 44, 1)
+    np.testing.assert_allclose(tiled, full, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize('blending', ['cosine', 'linear'])
+def test_blending_weights_partition_of_unity(blending):
+    tile, overlap = 16, 6
+    weights = blending_weights(tile, overlap, blending)
+    assert weights.shape == (tile, tile)
+    np.testing.assert_allclose(weights[tile // 2, tile // 2], 1)
+    # the ramps of two tiles overlapping by ``overlap`` pixels sum to one
+    row = weights[tile // 2]
+    np.testing.assert_allclose(row[-overlap:] + row[:overlap], 1, rtol=1e-6)
+
+
+@pytest.mark.parametrize('calendar', ['noleap', '360_day', None])
+def test_stream_time_encoding_and_single_step_chunks(tmp_path, calendar):
+    model = _pixelwise_model_('spc')
+    lr = np.random.default_rng(0).random((5, 6, 6, 1)).astype('float32')
+    if calendar is None:
+        times = pd.date_range('2000-02-27', periods=5, freq='12h')
+    else:
+        pytest.importorskip('cftime')
+        times = xr.cftime_range('2000-02-27', periods=5, freq='12h', calendar=calendar)
+    array = xr.DataArray(lr, dims=('time', 'lat', 'lon', 'var'),
+                         coords={'time': times, 'var': [0]})
+    scaler = dds.StandardScaler(axis=None).fit(lr)
+    full = dds.predict(model, lr, 4, array_in_hr=False, device='CPU')
+    # the last chunk has a single time step
+    out = dds.predict_stream(model, array, 4, str(tmp_path / 'y_hat.nc'), chunk_size=2,
+                             array_in_hr=False, scaler=scaler, device='CPU')
+    np.testing.assert_allclose(out.values, scaler.inverse_transform(full), rtol=0, atol=1e-4)
+    assert out.indexes['time'].equals(array.indexes['time'])
@@ -0,0 +1,114 @@
+import asyncio
+import numpy as np
+import pytest
+
+import dl4ds as dds
+from dl4ds.models import net_postupsampling
+from dl4ds.serve import ModelServer
+
+
+@pytest.fixture(scope='module')
+def model():
+    return net_postupsampling('resnet', 'spc', scale=4, n_channels=3, n_aux_channels=2,
+                              n_filters=4, n_blocks=1, lr_size=(8, 8))
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    return dict(lr=rng.random((24, 8, 8, 1)).astype('float32'),
+                static_vars=[rng.random((32, 32)), rng.random((32, 32))])
+
+
+def test_concurrent_requests_are_batched(model, data):
+    server = ModelServer({'m': model}, 4, static_vars=data['static_vars'],
+                         max_batch_size=12, max_latency=0.5, device='CPU',
+                         verbose=False)
+
+    async def run():
+        requests = [server.predict('m', data['lr'][i * 3:(i + 1) * 3]) for i in range(8)]
+        return await asyncio.gather(*requests)
+
+    outputs = asyncio.run(run())
+    expected = dds.predict(model, data['lr'], 4, array_in_hr=False,
+                           static_vars=data['static_vars'], device='CPU')
+    np.testing.assert_allclose(np.concatenate(outputs), expected, rtol=0, atol=1e-5)
+
+    stats = server.stats()
+    assert stats['n_requests'] == 8 and stats['n_errors'] == 0
+    assert stats['queue_depth'] == 0
+    # 8 requests of 3 samples in batches of up to 12 samples
+    assert stats['n_batches'] < 8
+    assert stats['mean_batch_size'] > 3
+    assert max(server._batch_sizes) <= 12
+
+    # the server can be used again from another event loop
+    out = asyncio.run(server.predict('m', data['lr'][:3]))
+    np.testing.assert_allclose(out, expected[:3], rtol=0, atol=1e-5)
+
+
+def test_region_requests_and_errors(model, data):
+    server = ModelServer({'m': model}, 4, static_vars=data['static_vars'],
+                         max_latency=0.01, device='CPU', region_cache_size=2,
+                         verbose=False)
+
+    async def run(*requests):
+        return await asyncio.gather(*[server.predict('m', lr, offset=offset)
+                                      for lr, offset in requests],
+                                    return_exceptions=True)
+
+    lr = data['lr'][:2, :4, :4]
+    outputs = asyncio.run(run(*[(lr, (y, x)) for y in range(3) for x in range(3)]))
+    assert all(out.shape == (2, 16, 16, 1) for out in outputs)
+    assert len(server._regions) <= 2
+    # region outside the domain of the static variables, unknown model
+    out, = asyncio.run(run((lr, (6, 0))))
+    assert isinstance(out, ValueError)
+    with pytest.raises(KeyError):
+        asyncio.run(server.predict('unknown', lr))
+
+
+def test_failed_batch_does_not_block_the_server(model, data, monkeypatch):
+    server = ModelServer({'m': model}, 4, static_vars=data['static_vars'],
+                         max_latency=0.05, device='CPU', verbose=False)
+    run_batch = server._run_batch_
+    calls = []
+
+    def fail_once(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError('device error')
+        return run_batch(*args)
+
+    monkeypatch.setattr(server, '_run_batch_', fail_once)
+
+    async def run():
+        # every request of the failed batch gets the error, and the
+        # following requests are still served
+        failed = await asyncio.gather(*[server.predict('m', data['lr'][i:i + 2])
+                                        for i in range(0, 6, 2)],
+                                      return_exceptions=True)
+        return failed, await server.predict('m', data['lr'][:2])
+
+    failed, out = asyncio.run(run())
+    assert all(isinstance(e, RuntimeError) for e in failed)
+    assert out.shape == (2, 32, 32, 1)
+    assert server.stats()['n_errors'] == 3
+
+
+def test_request_size_limit(model, data):
+    server = ModelServer({'m': model}, 4, static_vars=data['static_vars'],
+                         device='CPU', max_request_size=1e-3, verbose=False)
+
+    async def respond(request):
+        reader = asyncio.StreamReader()
+        reader.feed_data(request)
+        reader.feed_eof()
+        return await server._respond_(reader)
+
+    status, _, _ = asyncio.run(respond(
+        b'POST /predict/m HTTP/1.1\r\nContent-Length: 4096\r\n\r\n'))
+    assert status == 413
+    status, _, _ = asyncio.run(respond(
+        b'POST /predict/m HTTP/1.1\r\nContent-Length: abc\r\n\r\n'))
+    assert status == 400
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+import dl4ds as dds
+from dl4ds.utils import resize_array
+
+
+def _data_array_(array):
+    n, y, x, _ = array.shape
+    return xr.DataArray(
+        array, dims=('time', 'lat', 'lon', 'var'),
+        coords={'time': pd.date_range('2000-01-01', periods=n), 'lat': np.arange(y),
+                'lon': np.arange(x), 'var': [0]})
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    return dict(
+        train=rng.random((10, 16, 16, 1)).astype('float32'),
+        test=rng.random((6, 16, 16, 1)).astype('float32'),
+        predictors=rng.random((10, 16, 16, 1)).astype('float32'),
+        static_vars=[rng.random((16, 16))],
+        mask=np.ones((16, 16)))
+
+
+@pytest.mark.parametrize('dtype', [None, 'float16', 'bfloat16'])
+@pytest.mark.parametrize('lazy', [False, True])
+def test_shards_round_trip(tmp_path, data, dtype, lazy):
+    splits = dict(
+        train=dict(data=_data_array_(data['train']), predictors=[data['predictors']]),
+        test=dict(data=_data_array_(data['test'])))
+    dds.create_shards(str(tmp_path), splits, static_vars=data['static_vars'],
+                      mask=data['mask'], scale=4, shard_size=3, dtype=dtype,
+                      verbose=False)
+    ds = dds.load_shards(str(tmp_path), lazy=lazy)
+    atol = {None: 0, 'float16': 1e-3, 'bfloat16': 1e-2}[dtype]
+    assert ds.open_array('train', 'hr').dtype.name == (dtype or 'float32')
+
+    train = np.asarray(ds.data_train, dtype='float32')
+    np.testing.assert_allclose(train, data['train'], rtol=0, atol=atol)
+    np.testing.assert_allclose(np.asarray(ds.data_test, dtype='float32'), data['test'],
+                               rtol=0, atol=atol)
+    np.testing.assert_allclose(np.asarray(ds.predictors_train[0], dtype='float32'),
+                               data['predictors'], rtol=0, atol=atol)
+    # precomputed (coarsened) LR data
+    assert ds.lr_kind('train') == 'coarsened'
+    np.testing.assert_allclose(
+        np.asarray(ds.data_train_lr, dtype='float32'),
+        resize_array(data['train'], (4, 4), 'inter_area', squeezed=False),
+        rtol=0, atol=atol)
+    np.testing.assert_array_equal(ds.static_vars[0], data['static_vars'][0])
+    np.testing.assert_array_equal(ds.gt_mask, data['mask'])
+    # the time coordinate is stored with the shards
+    np.testing.assert_array_equal(ds.time('train').values,
+                                  splits['train']['data'].time.values)
+    if lazy:
+        assert isinstance(ds.data_train, dds.LazyArray)
+    else:
+        assert isinstance(ds.data_train, xr.DataArray)
+
+
+def test_sharded_array_slicing(tmp_path, data):
+    dds.create_shards(str(tmp_path), dict(train=dict(data=data['train'])), scale=4,
+                      precompute_lr=False, shard_size=3, verbose=False)
+    array = dds.load_shards(str(tmp_path)).open_array('train', 'hr')
+    assert array.shape == data['train'].shape
+    assert array.chunks[0] == 3
+    # slices across several shards, integers and advanced indexing
+    np.testing.assert_array_equal(array[2:8], data['train'][2:8])
+    np.testing.assert_array_equal(array[4, :3], data['train'][4, :3])
+    np.testing.assert_array_equal(array[[1, 7]], data['train'][[1, 7]])
+
+
+def test_empty_split_raises(tmp_path, data):
+    with pytest.raises(ValueError, match='empty'):
+        dds.create_shards(str(tmp_path), dict(train=dict(data=data['train'][:0])),
+                          scale=4, verbose=False)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from dl4ds.utils import (block_mean, resize_array, spatial_to_spatiotemporal_samples,
+                         spatiotemporal_to_spatial_samples)
+
+
+def _reference_block_mean_(array, fy, fx):
+    """ Block mean of a 2D array with np.nanmean. """
+    y, x = array.shape
+    blocks = array.reshape(y // fy, fy, x // fx, fx)
+    with np.errstate(invalid='ignore'), pytest.warns(RuntimeWarning):
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+def test_block_mean_matches_inter_area():
+    array = np.random.default_rng(0).random((6, 32, 24, 2)).astype('float32')
+    coarsened = block_mean(array, 4)
+    assert coarsened.shape == (6, 8, 6, 2)
+    assert coarsened.dtype == np.float32
+    np.testing.assert_allclose(
+        coarsened, resize_array(array, (6, 8), 'inter_area', squeezed=False),
+        rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('factors', [2, (2, 4)])
+def test_block_mean_nan_aware(factors):
+    fy, fx = (factors, factors) if isinstance(factors, int) else factors
+    array = np.random.default_rng(1).random((8, 16))
+    array[0, 0] = np.nan
+    array[2:4, 4:8] = np.nan        # a block with all the values missing
+    array[5, :] = np.nan
+    coarsened = block_mean(array, factors, nan_aware=True)
+    expected = _reference_block_mean_(array, fy, fx)
+    np.testing.assert_allclose(coarsened, expected, rtol=1e-12)
+    assert np.isnan(coarsened[1, 2 if fx == 2 else 1])
+    # NaNs propagated when not NaN-aware
+    coarsened = block_mean(array, factors)
+    assert np.isnan(coarsened[0, 0]) and np.isnan(coarsened[2, 0])
+    assert not np.isnan(coarsened[3, -1])
+
+
+def test_block_mean_half_precision():
+    array = np.random.default_rng(2).random((4, 8, 8, 1)).astype('float16')
+    coarsened = block_mean(array, 2)
+    assert coarsened.dtype == np.float32
+    np.testing.assert_allclose(coarsened, block_mean(array.astype('float32'), 2), rtol=1e-6)
+
+
+def test_block_mean_wrong_factors():
+    with pytest.raises(ValueError):
+        block_mean(np.zeros((10, 10)), 3)
+
+
+def test_spatiotemporal_samples_round_trip():
+    array = np.random.default_rng(0).random((7, 5, 4, 2)).astype('float32')
+    samples = spatial_to_spatiotemporal_samples(array, 3)
+    assert samples.shape == (5, 3, 5, 4, 2) and samples.dtype == np.float32
+    np.testing.assert_array_equal(samples[2], array[2:5])
+    # a writeable copy, not a view of the input
+    samples[0] = 0
+    assert array[0].any()
+    np.testing.assert_array_equal(spatiotemporal_to_spatial_samples(samples[1:], 3), array[1:])